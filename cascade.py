@@ -0,0 +1,132 @@
+import argparse
+import json
+import os
+os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from torch.utils.data import Dataset
+from model.model_with_prompt import PromptModel
+from model.single_encoder import SingleEncoder
+from datasets import ImageDataset, prepare_data
+from datasets.dataset import get_caption
+from utils import generate, calculate_metrics, get_num_class, load_training_args, make_dataloader
+from utils.cpu_inference import LatencyMeter
+
+
+class CascadeDataset(Dataset):
+    """Decodes every patch once and preprocesses it for both models (their resize/normalization may differ)."""
+    def __init__(self, pair_list, single_args, prompt_args) -> None:
+        self.single = ImageDataset(pair_list, single_args, train=False)
+        self.prompt = ImageDataset(pair_list, prompt_args, train=False)
+
+    def __len__(self) -> int:
+        return len(self.prompt)
+
+    def __getitem__(self, index):
+        image = self.prompt.load_image(index)
+        img_path, img_tensor, hard_text_prompt, caption = self.prompt.make_sample(index, self.prompt.preprocess(image))
+        return self.single.preprocess(image), img_tensor, hard_text_prompt, caption
+
+
+def softmax_margin(logits):
+    # top-1 minus top-2 probability, low margins are escalated to the captioner
+    top2 = logits.softmax(-1).topk(2, dim=-1).values
+    return top2[:, 0] - top2[:, 1]
+
+
+def run_cascade(args, dataloader, single_model, prompt_model, threshold=None):
+    """
+    Classifies every patch with the single encoder and escalates the patches with a softmax margin below `threshold`
+    to `generate`. With `threshold=None` every patch also goes through the captioner (calibration).
+
+    Returns:
+        ground truth captions, cheap predictions, margins, captioner predictions (None where not escalated)
+    """
+    captions, class_ids = get_caption(args.dataset), get_caption(args.dataset, 'class_index')
+    ground_truth, cheap, margins, expensive = [], [], [], []
+    meter = LatencyMeter(args.device)
+    with torch.no_grad():
+        for single_tensor, prompt_tensor, hard_text_prompt, label in tqdm(dataloader):
+            meter.start()
+            logits = single_model(single_tensor.to(args.device, dtype=torch.float32))
+            margin = softmax_margin(logits).cpu()
+            escalate = torch.ones_like(margin, dtype=torch.bool) if threshold is None else margin < threshold
+            gen_cap = [None] * len(label)
+            if escalate.any():
+                index = escalate.nonzero().squeeze(1)
+                escalated_cap = generate(prompt_model, prompt_tensor[index].to(args.device, dtype=torch.float32),
+                                         [hard_text_prompt[i] for i in index.tolist()], args)
+                for i, cap in zip(index.tolist(), escalated_cap):
+                    gen_cap[i] = cap
+            meter.stop(len(label))
+            ground_truth += list(label)
+            cheap += [captions[class_ids.index(c)] for c in logits.argmax(-1).tolist()]
+            margins += margin.tolist()
+            expensive += gen_cap
+    return ground_truth, cheap, np.array(margins), expensive, meter.report()
+
+
+def sweep_thresholds(dataset, ground_truth, cheap, margins, expensive, thresholds):
+    results = []
+    for threshold in thresholds:
+        escalate = margins < threshold
+        prediction = [e if esc else c for c, e, esc in zip(cheap, expensive, escalate)]
+        metrics = calculate_metrics(dataset, ground_truth, prediction)
+        results.append({'threshold': float(threshold), 'escalation_rate': float(escalate.mean()), **metrics})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='prostate-1')
+    parser.add_argument('--split', type=int, default=2)                       # 1 to calibrate on the valid split, 2 for test
+    parser.add_argument('--bs', type=int, default=128)
+    parser.add_argument('--device', type=int, default=0)
+    parser.add_argument('--generate_length', type=int, default=12)
+    parser.add_argument('--single_pth', type=str, required=True)              # SingleEncoder checkpoint (cheap stage)
+    parser.add_argument('--prompt_pth', type=str, required=True)              # PromptModel checkpoint (captioner)
+    parser.add_argument('--threshold', type=float, default=None)              # escalate margins below it, None calibrates
+    parser.add_argument('--max_acc_drop', type=float, default=0.005)          # calibration: allowed accuracy loss vs the captioner
+    parser.add_argument('--out_dir', default='/data4/anhnguyen/experiments/prompt_work/cascade/')
+    overwrite_args = parser.parse_args()
+
+    device = torch.device(f'cuda:{overwrite_args.device}') if overwrite_args.device >= 0 else torch.device('cpu')
+    single_args, args = load_training_args(overwrite_args.single_pth), load_training_args(overwrite_args.prompt_pth)
+    for a in [single_args, args]:
+        a.dataset, a.device, a.bs, a.compile = overwrite_args.dataset, device, overwrite_args.bs, False
+    args.generate_length = overwrite_args.generate_length
+
+    single_model = SingleEncoder(single_args, get_num_class(args.dataset))
+    single_model.load_state_dict(torch.load(single_args.model_pth, map_location=device)['model_state_dict'], strict=True)
+    prompt_model = PromptModel(args)
+    prompt_model.load_state_dict(torch.load(args.model_pth, map_location=device)['model_state_dict'], strict=True)
+    single_model, prompt_model = single_model.to(device).eval(), prompt_model.to(device).eval()
+
+    data = prepare_data(args)
+    pair_list = data[overwrite_args.split] if isinstance(data, tuple) else data
+    dataloader = make_dataloader(args, CascadeDataset(pair_list, single_args, args), shuffle=False, drop_last=False, persistent=False)
+
+    ground_truth, cheap, margins, expensive, latency = run_cascade(args, dataloader, single_model, prompt_model, overwrite_args.threshold)
+    os.makedirs(overwrite_args.out_dir, exist_ok=True)
+    if overwrite_args.threshold is None:
+        # every patch was captioned: accuracy and escalation rate for each candidate threshold
+        thresholds = np.unique(np.concatenate([[0.0, 1.01], np.quantile(margins, np.linspace(0, 1, 51))]))
+        results = sweep_thresholds(args.dataset, ground_truth, cheap, margins, expensive, thresholds)
+        for r in results:
+            print(f"threshold {r['threshold']:.4f}: escalation {r['escalation_rate']:.3f}, acc {r['valid_acc']:.4f}")
+        full_acc = results[-1]['valid_acc']
+        chosen = min((r for r in results if r['valid_acc'] >= full_acc - overwrite_args.max_acc_drop), key=lambda r: r['escalation_rate'])
+        print(f'>>> Calibrated threshold: {chosen}')
+        out = {'sweep': results, 'calibrated': chosen}
+    else:
+        metrics = calculate_metrics(args.dataset, ground_truth, [e if e is not None else c for c, e in zip(cheap, expensive)])
+        escalation_rate = float((margins < overwrite_args.threshold).mean())
+        print(f'>>> Threshold {overwrite_args.threshold}: escalation {escalation_rate:.3f}, {metrics}, latency {latency}')
+        out = {'threshold': overwrite_args.threshold, 'escalation_rate': escalation_rate, 'latency': latency, **metrics}
+    with open(os.path.join(overwrite_args.out_dir, f'{args.dataset}-cascade.json'), 'w') as file:
+        json.dump(out, file)
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,4 @@
 from .dataset import ImageDataset, prepare_data
+from .shards import ShardDataset
+from .aug_bank import AugBankDataset
+from .sampler import LengthBucketBatchSampler
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from .dataset import ImageDataset
+
+
+@torch.no_grad()
+def encoder_fingerprint(encoder):
+    # hash of the frozen encoder weights (prompts, LoRA and head excluded), identifies the init the cache was built from
+    digest = hashlib.sha1()
+    for name, tensor in sorted(encoder.state_dict().items()):
+        if name.startswith(('prompt_layer', 'lora_layer', 'head')):
+            continue
+        digest.update(name.encode())
+        digest.update(tensor.detach().float().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def dataset_fingerprint(dataset):
+    # hash of the ordered image paths and of the preprocessing that produces the encoder input
+    pair_list, args = dataset.pair_list, dataset.args
+    digest = hashlib.sha1()
+    for index in range(len(pair_list)):
+        path = pair_list.get_path(index) if hasattr(pair_list, 'get_path') else pair_list[index][0]
+        digest.update(path.encode('utf-8') + b'\0')
+    preprocessing = {'encoder_type': args.encoder_type, 'encoder_resize': args.encoder_resize,
+                     'encoder_mean': list(args.encoder_mean), 'encoder_std': list(args.encoder_std),
+                     'breakhis_fold': getattr(args, 'breakhis_fold', None),
+                     'reduced_decode': getattr(args, 'reduced_decode', False)}
+    digest.update(json.dumps(preprocessing, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+@torch.no_grad()
+def prefix_shape(encoder, resize, start_block, device='cuda'):
+    # per-item (L, C) of the tokens entering `start_block`
+    was_training = encoder.training
+    encoder.eval()
+    shape = tuple(encoder.forward_prefix(torch.zeros(1, 3, resize, resize, device=device), start_block).shape[1:])
+    encoder.train(was_training)
+    return shape
+
+
+@torch.no_grad()
+def build_activation_cache(encoder, dataset, path, start_block, batch_size=64, num_workers=10, device='cuda'):
+    """
+    Runs the frozen swin prefix (patch embedding + blocks before `start_block`) once over the unaugmented images of
+    `dataset` and stores its output as fp16 in the .npy memmap `path`, shape (num_items, L, C). An existing cache is
+    reused only if it was built from the same images (ordered paths), preprocessing, start block and encoder weights
+    and has the expected per-item shape.
+    """
+    item_shape = prefix_shape(encoder, dataset.resize, start_block, device)
+    meta = {'num_items': len(dataset), 'start_block': start_block, 'item_shape': list(item_shape),
+            'encoder': encoder_fingerprint(encoder), 'data': dataset_fingerprint(dataset)}
+    meta_path = path.replace('.npy', '.json')
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path) as file:
+            if json.load(file) == meta and np.load(path, mmap_mode='r').shape == (len(dataset), *item_shape):
+                return path, item_shape
+
+    was_training = encoder.training
+    encoder.eval()
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, drop_last=False, num_workers=num_workers)
+    cache, start = None, 0
+    for img_path, img_tensor, hard_text_prompt, label in loader:
+        x = encoder.forward_prefix(img_tensor.to(device, dtype=torch.float32), start_block)
+        if cache is None:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            cache = np.lib.format.open_memmap(path, mode='w+', dtype=np.float16, shape=(len(dataset), *x.shape[1:]))
+        cache[start:start + x.shape[0]] = x.half().cpu().numpy()
+        start += x.shape[0]
+    cache.flush()
+    encoder.train(was_training)
+
+    with open(meta_path, 'w') as file:
+        json.dump(meta, file)
+    return path, item_shape
+
+
+class ActivationCacheDataset(Dataset):
+    """Samples of an `ImageDataset` whose image tensor is replaced by the cached fp16 swin activations of the image."""
+    def __init__(self, dataset, path, item_shape=None) -> None:
+        self.dataset = dataset
+        self.cache = np.load(path, mmap_mode='r')
+        assert len(self.cache) == len(dataset), f'activation cache {path} does not match the dataset'
+        assert item_shape is None or self.cache.shape[1:] == tuple(item_shape), \
+            f'activation cache {path} holds {self.cache.shape[1:]} tokens, expected {tuple(item_shape)}'
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return self.dataset.make_sample(index, torch.from_numpy(np.array(self.cache[index])))
+
+
+def cache_encoder_prefix(model, datasets, cache_dir, args):
+    """
+    Caches the activations entering the first adapted swin block for each split of `datasets` ({split: ImageDataset})
+    and sets the encoder to start cached tokens there; uncached splits keep feeding images through the whole encoder.
+    The caches hold unaugmented images, so training splits lose the online augmentation (and the stochastic depth of
+    the frozen blocks).
+    """
+    start_block = model.get_first_adapted_block()
+    if start_block == 0:
+        print('>>> Encoder activation cache: the first block is adapted, nothing to cache')
+        return datasets
+    model = model.to(args.device)
+    cached = {}
+    for split, dataset in datasets.items():
+        eval_dataset = ImageDataset(dataset.pair_list, args, train=False)
+        path = os.path.join(cache_dir, f'{args.dataset}-{args.encoder_type}-{split}-block{start_block}.npy')
+        path, item_shape = build_activation_cache(model.encoder, eval_dataset, path, start_block, args.bs, args.num_workers, args.device)
+        cached[split] = ActivationCacheDataset(eval_dataset, path, item_shape)
+    model.encoder.set_start_block(start_block)
+    print(f'>>> Encoder activation cache: cached splits ({", ".join(cached)}) enter the encoder at block {start_block}')
+    return cached
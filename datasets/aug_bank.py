@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import random
+from multiprocessing import Pool
+import cv2
+import imgaug
+import numpy as np
+from torch.utils.data import Dataset, Sampler
+from .dataset import ImageDataset, prepare_data
+
+
+def _fill_chunk(job):
+    dataset, bank_path, indices, num_variants, seed = job
+    imgaug.seed(seed)
+    bank = np.load(bank_path, mmap_mode='r+')
+    augmentors = dataset.train_augmentors()
+    for index in indices:
+        image = cv2.resize(dataset.load_image(index), (dataset.resize, dataset.resize))
+        for variant in range(num_variants):
+            bank[index, variant] = augmentors.augment_image(image)
+    bank.flush()
+    return len(indices)
+
+
+def build_aug_bank(dataset, out_dir, num_variants=8, num_workers=10, chunk_size=256, seed=0):
+    """
+    Precomputes `num_variants` outputs of `ImageDataset.train_augmentors` for every image of `dataset` into
+    `{out_dir}/bank.npy`, a uint8 array of shape (num_items, num_variants, resize, resize, 3), and describes it in
+    `{out_dir}/bank.json`.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    bank_path = os.path.join(out_dir, 'bank.npy')
+    shape = (len(dataset), num_variants, dataset.resize, dataset.resize, 3)
+    bank = np.lib.format.open_memmap(bank_path, mode='w+', dtype=np.uint8, shape=shape)
+    del bank
+
+    jobs = [(dataset, bank_path, range(start, min(start + chunk_size, len(dataset))), num_variants, seed + start)
+            for start in range(0, len(dataset), chunk_size)]
+    with Pool(num_workers) as pool:
+        num_done = sum(pool.imap_unordered(_fill_chunk, jobs))
+    assert num_done == len(dataset)
+
+    meta = {'dataset': dataset.args.dataset, 'encoder_resize': dataset.resize,
+            'num_items': len(dataset), 'num_variants': num_variants}
+    with open(os.path.join(out_dir, 'bank.json'), 'w') as file:
+        json.dump(meta, file)
+    return meta
+
+
+class AugBankSampler(Sampler):
+    """Shuffled (index, variant) pairs, a new random variant of every image in each epoch."""
+    def __init__(self, num_items, num_variants, seed=0) -> None:
+        self.num_items = num_items
+        self.num_variants = num_variants
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self) -> int:
+        return self.num_items
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        self.epoch += 1
+        indices = list(range(self.num_items))
+        rng.shuffle(indices)
+        return iter([(index, rng.randrange(self.num_variants)) for index in indices])
+
+
+class AugBankDataset(Dataset):
+    """
+    Training samples read from an augmentation bank instead of decoding and augmenting online. Indexed by the
+    (index, variant) pairs of `sampler`; with `online_flips` a random horizontal/vertical flip is added on top.
+    """
+    def __init__(self, dataset, bank_dir, online_flips=True) -> None:
+        with open(os.path.join(bank_dir, 'bank.json')) as file:
+            meta = json.load(file)
+        assert meta['num_items'] == len(dataset) and meta['encoder_resize'] == dataset.resize, \
+            f'augmentation bank {bank_dir} was built for another split or encoder_resize'
+        self.dataset = dataset
+        self.bank = np.load(os.path.join(bank_dir, 'bank.npy'), mmap_mode='r')
+        self.online_flips = online_flips
+        self.sampler = AugBankSampler(meta['num_items'], meta['num_variants'])
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, index_variant):
+        index, variant = index_variant
+        image = self.bank[index, variant]
+        if self.online_flips:
+            if random.random() < 0.5:
+                image = image[:, ::-1]
+            if random.random() < 0.5:
+                image = image[::-1]
+        return self.dataset.make_sample(index, self.dataset.to_tensor(image))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='prostate-1')
+    parser.add_argument('--type', type=str, default='lora')
+    parser.add_argument('--breakhis_fold', type=int, default=1)
+    parser.add_argument('--encoder_type', type=str, default='ctranspath')
+    parser.add_argument('--encoder_resize', type=int, default=224)
+    parser.add_argument('--encoder_mean', default=(0.485, 0.456, 0.406))
+    parser.add_argument('--encoder_std', default=(0.229, 0.224, 0.225))
+    parser.add_argument('--reduced_decode', action='store_true')
+    parser.add_argument('--num_variants', type=int, default=8)           # augmented copies per training image
+    parser.add_argument('--num_workers', type=int, default=10)
+    parser.add_argument('--out_dir', type=str, required=True)
+    args = parser.parse_args()
+
+    data = prepare_data(args)
+    if not isinstance(data, tuple):
+        raise ValueError('Not contains a splitted training data')
+    train_dataset = ImageDataset(data[0], args)
+    meta = build_aug_bank(train_dataset, args.out_dir, args.num_variants, args.num_workers)
+    print(f'>>> Augmentation bank: {meta}')
+
+if __name__ == '__main__':
+    main()
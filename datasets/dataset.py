@@ -7,7 +7,9 @@ import cv2
 import pandas as pd
 import random
 import json
+import numpy as np
 from torchvision.transforms import Normalize
+from .image_cache import SharedImageCache
 
 class ImageDataset(Dataset):
     def __len__(self) -> int:
@@ -53,24 +55,65 @@ class ImageDataset(Dataset):
         )
         return input_augs
 
-    def __getitem__(self, index):
-        img_path, label = self.pair_list[index]
-        if self.args.type != 'single_encoder':
-            caption = combine_hard_prompt_with_label(self.hard_text_prompt, label)
-        image = cv2.imread(img_path)
-        image = cv2.resize(image, (self.resize,self.resize))
+    def get_read_flag(self, num_probes=8):
+        # largest IMREAD_REDUCED_COLOR_{2,4,8} that still decodes at least encoder_resize pixels per side, probed on the
+        # first readable of the first files (jpeg is then decoded at reduced scale in the DCT domain); None when the
+        # images are too small or no probe could be read, which keeps the plain full decode
+        for index in range(min(num_probes, len(self.pair_list))):
+            probe = cv2.imread(self.pair_list[index][0])
+            if probe is None:
+                continue
+            for factor, flag in [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]:
+                if min(probe.shape[:2]) // factor >= self.resize:
+                    return flag
+            return None
+        return None
+
+    def read_image(self, img_path):
+        if self.read_flag is not None:
+            image = cv2.imread(img_path, self.read_flag)
+            if image is not None and min(image.shape[:2]) >= self.resize:
+                return image
+            # unreadable at reduced scale, or a file smaller than the probe: decode it in full
+        return cv2.imread(img_path)
+
+    def preprocess(self, image):
+        # BGR uint8 image (as read by cv2) -> model input tensor
+        if image.shape[:2] != (self.resize, self.resize):
+            image = cv2.resize(image, (self.resize,self.resize))
         if self.train == True:
             train_augmentors = self.train_augmentors()
             image = train_augmentors.augment_image(image)
+        return self.to_tensor(image)
+
+    def to_tensor(self, image):
         img_tensor = torch.tensor(image.copy(), dtype=torch.float32).permute(2,0,1) # C,H,W
         if self.args.encoder_type == 'ctranspath':
             img_tensor = Normalize(mean=self.mean, std=self.std)(img_tensor)
-
+        return img_tensor
+
+    def load_image(self, index):
+        img_path = self.pair_list[index][0]
+        if self.cache is not None:
+            image = self.cache.get(index)
+            if image is None:
+                image = cv2.resize(self.read_image(img_path), (self.resize,self.resize))
+                self.cache.put(index, image)
+            return image
+        return self.read_image(img_path)
+
+    def make_sample(self, index, img_tensor):
+        img_path, label = self.pair_list[index]
         if self.args.type == 'single_encoder':
             return img_path, img_tensor, 'no_hard_prompt', label
         else:
+            caption = combine_hard_prompt_with_label(self.hard_text_prompt, label)
             return img_path, img_tensor, self.hard_text_prompt, caption
 
+    def __getitem__(self, index):
+        img_tensor = self.preprocess(self.load_image(index))
+        return self.make_sample(index, img_tensor)
+
     def __init__(self, pair_list, args, train=True):
         self.args = args
         self.pair_list = pair_list
@@ -79,6 +122,57 @@ class ImageDataset(Dataset):
         self.mean = args.encoder_mean
         self.std = args.encoder_std
         self.train = train
+        self.read_flag = self.get_read_flag() if getattr(args, 'reduced_decode', False) else None   # probed before the workers fork
+        self.cache = None
+
+    def enable_cache(self, max_gb):
+        # resized images shared by all workers and epochs, created before the workers fork
+        self.cache = SharedImageCache(len(self.pair_list), (self.resize, self.resize, 3), int(max_gb * 1024**3))
+        return self.cache
+
+class CompactPairList():
+    """
+    Read-only (path, label) list kept in a few numpy arrays: the utf-8 paths in one byte buffer with an offsets
+    array, and the labels as int ids (into a small table of distinct captions for caption labels).
+
+    A list of 100k tuples of python objects gets its pages copied into every forked dataloader worker as soon as the
+    workers touch the reference counts; the numpy buffers stay shared. Paths and labels are decoded on access.
+    """
+    def __init__(self, pair_list) -> None:
+        paths = [str(p).encode('utf-8') for p, _ in pair_list]
+        labels = [l for _, l in pair_list]
+        self.offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(p) for p in paths])
+        self.buffer = np.frombuffer(b''.join(paths), dtype=np.uint8)
+        if all(isinstance(l, (int, np.integer)) for l in labels):
+            self.label_table = None                                     # class index labels are stored directly
+            self.labels = np.array(labels, dtype=np.int64)
+        else:
+            self.label_table = sorted(set(labels))
+            label_ids = {l: i for i, l in enumerate(self.label_table)}
+            self.labels = np.array([label_ids[l] for l in labels], dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def get_path(self, index):
+        return self.buffer[self.offsets[index]:self.offsets[index+1]].tobytes().decode('utf-8')
+
+    def get_label(self, index):
+        if self.label_table is None:
+            return int(self.labels[index])
+        return self.label_table[self.labels[index]]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.get_path(index), self.get_label(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
 
 def prepare_panda_512_data(label_type='caption'):
     def map_label_caption(path):
@@ -879,6 +973,13 @@ def prepare_luad(label_type='caption'):
 prepare_luad()
 
 def prepare_data(args):
+    # every split as a CompactPairList, so that forked dataloader workers share it instead of copying it
+    data = prepare_pair_lists(args)
+    if isinstance(data, tuple):
+        return tuple(CompactPairList(split) for split in data)
+    return CompactPairList(data)
+
+def prepare_pair_lists(args):
     if args.type != 'single_encoder':
         dataset_type = 'caption'
     else:
@@ -0,0 +1,46 @@
+import atexit
+import os
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SharedImageCache():
+    """
+    Resized uint8 images of a dataset in one shared-memory slab (/dev/shm), filled on first access by whichever
+    dataloader worker decodes the image and read by all workers in the following epochs.
+
+    Slot `i` belongs to dataset index `i`. Admission is size-capped: only the first `capacity` indices that fit into
+    `max_bytes` are cached, the rest is decoded every time. A per-index flag marks the filled slots; it is set after
+    the image is written, and one index is loaded by a single worker per epoch, so no lock is needed.
+    """
+    def __init__(self, num_items, shape, max_bytes) -> None:
+        self.shape = tuple(shape)
+        self.item_bytes = int(np.prod(self.shape))
+        self.capacity = int(min(num_items, max_bytes // self.item_bytes))
+        self.owner_pid = os.getpid()
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, self.capacity * (self.item_bytes + 1)))
+        self.filled = np.ndarray((self.capacity,), dtype=np.uint8, buffer=self.shm.buf)
+        self.filled[:] = 0
+        self.images = np.ndarray((self.capacity, *self.shape), dtype=np.uint8, buffer=self.shm.buf, offset=self.capacity)
+        self.hits, self.misses = 0, 0                    # per process
+        atexit.register(self.close)
+
+    def get(self, index):
+        if index < self.capacity and self.filled[index]:
+            self.hits += 1
+            return self.images[index]
+        self.misses += 1
+        return None
+
+    def put(self, index, image):
+        if index < self.capacity and image.shape == self.shape:
+            self.images[index] = image
+            self.filled[index] = 1
+
+    def close(self):
+        if self.images is None:
+            return
+        self.filled, self.images = None, None           # release the views before closing the mapping
+        self.shm.close()
+        if os.getpid() == self.owner_pid:                # only the creating process removes the segment
+            self.shm.unlink()
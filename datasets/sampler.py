@@ -0,0 +1,68 @@
+import random
+from collections import defaultdict
+from torch.utils.data import Sampler
+from .dataset import combine_hard_prompt_with_label
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batches of `batch_size` samples whose tokenized captions differ in length by at most `max_padding` tokens, so that
+    `PromptModel.forward` pads them to (almost) nothing; with `max_padding=0` every batch has a single caption length.
+
+    Captions are a function of the label, so a length bucket holds one or a few classes. Inside a bucket the samples
+    of each class are spread evenly, so its batches mix its classes in proportion. Across buckets the batches are
+    interleaved by the same rule: each bucket's batches are spread evenly over the epoch, so any stretch of steps sees
+    the classes at (about) their dataset frequency instead of one bucket after another.
+
+    Each bucket ends with a partial batch when its size is not a multiple of `batch_size`: every sample is seen once
+    per epoch and no batch crosses buckets.
+    """
+    def __init__(self, dataset, tokenizer, batch_size, max_padding=0, seed=0) -> None:
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+
+        # captions are a function of the label, so each distinct label is tokenized once
+        pair_list = dataset.pair_list
+        self.labels = [pair_list.get_label(i) if hasattr(pair_list, 'get_label') else pair_list[i][1] for i in range(len(pair_list))]
+        self.classes = defaultdict(list)                         # label -> indices
+        for index, label in enumerate(self.labels):
+            self.classes[label].append(index)
+        self.lengths = {label: len(tokenizer(combine_hard_prompt_with_label(dataset.hard_text_prompt, label))['input_ids'])
+                        for label in self.classes}
+        self.buckets = _bucket_by_length(self.lengths, max_padding)    # lists of labels batched together
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return sum(-(-sum(len(self.classes[label]) for label in bucket) // self.batch_size) for bucket in self.buckets)
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        self.epoch += 1
+        batches = {}
+        for i, bucket in enumerate(self.buckets):
+            stream = _stratify({label: self.classes[label] for label in bucket}, rng)
+            batches[i] = [stream[start:start + self.batch_size] for start in range(0, len(stream), self.batch_size)]
+        return iter(_stratify(batches, rng))
+
+
+def _bucket_by_length(lengths, max_padding):
+    # adjacent caption lengths spanning at most max_padding tokens share a bucket
+    buckets = []
+    for label in sorted(lengths, key=lambda label: lengths[label]):
+        if buckets and lengths[label] - lengths[buckets[-1][0]] <= max_padding:
+            buckets[-1].append(label)
+        else:
+            buckets.append([label])
+    return buckets
+
+
+def _stratify(groups, rng):
+    # shuffles each group and spreads it evenly over the stream: the k-th of n items sits around position k/n
+    keyed = []
+    for group, items in groups.items():
+        order = rng.sample(range(len(items)), len(items))
+        keyed += [((k + rng.random()) / len(items), rng.random(), items[i]) for k, i in enumerate(order)]
+    return [item for _, _, item in sorted(keyed, key=lambda key: key[:2])]
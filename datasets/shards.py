@@ -0,0 +1,157 @@
+import argparse
+import io
+import itertools
+import json
+import os
+import random
+import tarfile
+import multiprocessing
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from .dataset import ImageDataset, prepare_data, combine_hard_prompt_with_label
+
+
+def write_shards(pair_list, out_dir, split, shard_size=2000):
+    """
+    Packs the (path, label) pairs of a split into `{out_dir}/{split}-{i:05d}.tar`, each holding `shard_size` samples as
+    consecutive `{key}.{ext}` (encoded image bytes) and `{key}.json` ({"path", "label"}) members, and writes the sample
+    count of every shard to `{out_dir}/{split}.json`.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    counts = {}
+    for start in range(0, len(pair_list), shard_size):
+        shard_path = os.path.join(out_dir, f'{split}-{start // shard_size:05d}.tar')
+        with tarfile.open(shard_path, 'w') as tar:
+            for index in range(start, min(start + shard_size, len(pair_list))):
+                img_path, label = pair_list[index]
+                with open(img_path, 'rb') as file:
+                    image_bytes = file.read()
+                meta_bytes = json.dumps({'path': img_path, 'label': label}).encode('utf-8')
+                ext = os.path.splitext(img_path)[1].lstrip('.').lower() or 'png'
+                for name, data in [(f'{index:09d}.{ext}', image_bytes), (f'{index:09d}.json', meta_bytes)]:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+        counts[os.path.basename(shard_path)] = min(shard_size, len(pair_list) - start)
+    with open(os.path.join(out_dir, f'{split}.json'), 'w') as file:
+        json.dump(counts, file)
+    return counts
+
+
+class ShardDataset(IterableDataset):
+    """
+    Streams the tar shards of `write_shards` sequentially, a drop-in alternative to `ImageDataset` (same
+    (img_path, img_tensor, hard_text_prompt, label) samples and preprocessing).
+
+    Shards are assigned to distributed ranks and then to dataloader workers by a fixed round-robin, so every worker
+    streams the same shards each epoch and the number of batches is known up front (`num_batches`, used as the loader
+    length). With several ranks each worker stops at the smallest sample count of its peers on the other ranks, so all
+    ranks run the same number of steps. For training the order of a worker's shards is reshuffled every epoch and
+    samples are drawn from an in-memory shuffle buffer of `shuffle_buffer` samples. The epoch is set from the main
+    process with `set_epoch` (as with `DistributedSampler`) before iterating the loader.
+    """
+    def __init__(self, shard_dir, split, args, train=True, shuffle_buffer=1000, seed=0) -> None:
+        with open(os.path.join(shard_dir, f'{split}.json')) as file:
+            self.counts = json.load(file)
+        self.shards = [os.path.join(shard_dir, name) for name in sorted(self.counts)]
+        self.train = train
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = multiprocessing.Value('i', 0)      # shared with the workers, persistent or not
+        self.image_dataset = ImageDataset([], args, train=train)
+
+    def set_epoch(self, epoch):
+        self.epoch.value = epoch
+
+    def __len__(self) -> int:
+        return self._quota(0, 1)
+
+    def num_batches(self, batch_size, num_workers=0, drop_last=False):
+        # every worker collates its own samples, so each one ends with its own partial batch
+        num_workers = max(num_workers, 1)
+        return sum(self._quota(worker, num_workers) // batch_size if drop_last else -(-self._quota(worker, num_workers) // batch_size)
+                   for worker in range(num_workers))
+
+    def _get_rank(self):
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        return 0, 1
+
+    def _assign(self, rank, world_size, worker, num_workers):
+        return self.shards[rank::world_size][worker::num_workers]
+
+    def _quota(self, worker, num_workers):
+        # samples streamed by `worker`, the same on every rank
+        _, world_size = self._get_rank()
+        return min(sum(self.counts[os.path.basename(shard)] for shard in self._assign(rank, world_size, worker, num_workers))
+                   for rank in range(world_size))
+
+    def _read_samples(self, shards):
+        for shard_path in shards:
+            sample = {}
+            with tarfile.open(shard_path, 'r|') as tar:         # sequential read, no seeks
+                for member in tar:
+                    key, ext = member.name.rsplit('.', 1)
+                    data = tar.extractfile(member).read()
+                    if ext == 'json':
+                        sample['meta'] = json.loads(data)
+                    else:
+                        sample['image'] = data
+                    if 'meta' in sample and 'image' in sample:
+                        yield sample['image'], sample['meta']
+                        sample = {}
+
+    def _shuffle(self, samples, rng):
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            index = rng.randrange(len(buffer))
+            yield buffer[index]
+            buffer[index] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        rank, world_size = self._get_rank()
+        worker_info = get_worker_info()
+        worker, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        shards = self._assign(rank, world_size, worker, num_workers)
+        rng = random.Random(self.seed + self.epoch.value * 1000 + worker)
+        if self.train:
+            rng.shuffle(shards)
+        samples = self._read_samples(shards)
+        if self.train:
+            samples = self._shuffle(samples, rng)
+        samples = itertools.islice(samples, self._quota(worker, num_workers))
+        for image_bytes, meta in samples:
+            image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+            img_tensor = self.image_dataset.preprocess(image)
+            hard_text_prompt = self.image_dataset.hard_text_prompt
+            if self.image_dataset.args.type == 'single_encoder':
+                yield meta['path'], img_tensor, 'no_hard_prompt', meta['label']
+            else:
+                yield meta['path'], img_tensor, hard_text_prompt, combine_hard_prompt_with_label(hard_text_prompt, meta['label'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='prostate-1')
+    parser.add_argument('--type', type=str, default='lora')               # 'single_encoder' stores class indices, captions otherwise
+    parser.add_argument('--breakhis_fold', type=int, default=1)
+    parser.add_argument('--shard_size', type=int, default=2000)
+    parser.add_argument('--out_dir', type=str, required=True)
+    args = parser.parse_args()
+
+    data = prepare_data(args)
+    splits = ['train', 'valid', 'test'] if isinstance(data, tuple) else ['test']
+    data = data if isinstance(data, tuple) else (data,)
+    for split, pair_list in zip(splits, data):
+        counts = write_shards(pair_list, args.out_dir, split, args.shard_size)
+        print(f'>>> {split}: {sum(counts.values())} samples in {len(counts)} shards')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import argparse
+import copy
+import os
+os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from torch.nn import functional as nnf
+from torch.utils.data import Dataset
+from model.model_with_prompt import PromptModel
+from model.single_encoder import SingleEncoder
+from datasets import ImageDataset, prepare_data
+from datasets.dataset import get_caption, get_hard_prompt
+from utils import CosineSchedule, encode_image, score_captions, calculate_metrics, get_optimizer, get_num_class, \
+                  load_training_args, process_args, make_dataloader, DevicePrefetcher
+
+
+class TeacherImages(Dataset):
+    """Unaugmented images of a pair list, preprocessed for the teacher."""
+    def __init__(self, pair_list, args) -> None:
+        self.dataset = ImageDataset(pair_list, args, train=False)
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return index, self.dataset.preprocess(self.dataset.load_image(index))
+
+
+class DistillDataset(Dataset):
+    """Student samples (augmented as in training) with the cached teacher distribution as an extra target."""
+    def __init__(self, dataset, soft_targets) -> None:
+        self.dataset = dataset
+        self.soft_targets = soft_targets
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        img_path, img_tensor, hard_text_prompt, label = self.dataset[index]
+        return img_path, img_tensor, torch.from_numpy(np.array(self.soft_targets[index])), label
+
+
+@torch.no_grad()
+def cache_teacher_targets(teacher, pair_list, teacher_args, path):
+    """
+    Teacher distribution over the classes for every patch of `pair_list`: softmax of the caption log-likelihoods
+    (`score_captions`) of the dataset captions, stored in class-index order as a float32 .npy and reused if present.
+    """
+    if os.path.exists(path):
+        targets = np.load(path, mmap_mode='r')
+        if len(targets) == len(pair_list):
+            return targets
+    captions = get_caption(teacher_args.dataset)
+    class_ids = get_caption(teacher_args.dataset, 'class_index')
+    hard_text_prompt = get_hard_prompt(teacher_args.dataset)
+    targets = np.zeros((len(pair_list), len(class_ids)), dtype=np.float32)
+    loader = make_dataloader(teacher_args, TeacherImages(pair_list, teacher_args), shuffle=False, drop_last=False, persistent=False)
+    teacher.eval()
+    for index, img_tensor in tqdm(loader):
+        img_feature = encode_image(teacher, img_tensor.to(teacher_args.device, dtype=torch.float32), teacher_args)
+        scores = score_captions(teacher, img_feature, captions, hard_text_prompt, teacher_args).cpu().numpy()
+        targets[index.numpy()[:, None], np.array(class_ids)[None, :]] = scores
+    np.save(path, targets)
+    return targets
+
+
+def distillation_loss(logits, soft_targets, label, temperature, alpha):
+    # KL to the teacher at `temperature` (scaled by T^2), plus `alpha` x cross entropy on the labels
+    loss = nnf.kl_div(nnf.log_softmax(logits / temperature, dim=-1),
+                      nnf.softmax(torch.log(soft_targets.clamp(min=1e-8)) / temperature, dim=-1),
+                      reduction='batchmean') * temperature ** 2
+    if alpha > 0:
+        loss = (1 - alpha) * loss + alpha * nnf.cross_entropy(logits, label)
+    return loss
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--teacher_pth', type=str, required=True)          # trained PromptModel checkpoint
+    parser.add_argument('--dataset', type=str, default='prostate-1')
+    parser.add_argument('--student_encoder_type', type=str, default='ctranspath')
+    parser.add_argument('--temperature', type=float, default=2.0)
+    parser.add_argument('--alpha', type=float, default=0.0)                 # weight of the label loss, 0 uses teacher targets only
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--bs', type=int, default=128)
+    parser.add_argument('--lr', type=float, default=1e-4)
+    parser.add_argument('--optimizer_type', type=str, default="AdamW")
+    parser.add_argument('--device', type=int, default=0)
+    parser.add_argument('--out_dir', default='/data4/anhnguyen/experiments/prompt_work/')
+    parser.add_argument('--prefix_outdir', type=str, default="distill")
+    overwrite_args = parser.parse_args()
+
+    teacher_args = load_training_args(overwrite_args.teacher_pth)
+    teacher_args.dataset, teacher_args.bs, teacher_args.compile = overwrite_args.dataset, overwrite_args.bs, False
+    teacher_args.device = torch.device(f'cuda:{overwrite_args.device}')
+    teacher = PromptModel(teacher_args)
+    teacher.load_state_dict(torch.load(teacher_args.model_pth, map_location=teacher_args.device)['model_state_dict'], strict=True)
+    teacher = teacher.to(teacher_args.device).eval()
+
+    # the student is a single_encoder run, so test.py evaluates its checkpoints like any SingleEncoder
+    args = copy.copy(teacher_args)
+    for key in ['dataset', 'epochs', 'bs', 'lr', 'optimizer_type', 'out_dir', 'prefix_outdir', 'device']:
+        setattr(args, key, getattr(overwrite_args, key))
+    args.type, args.encoder_type, args.model_pth = 'single_encoder', overwrite_args.student_encoder_type, None
+    args.scheduler_type = 'cosine'
+    process_args(args)
+
+    train_set, valid_set = prepare_data(args)[:2]          # class-index labels, same patches as the teacher sees
+    soft_targets = cache_teacher_targets(teacher, train_set, teacher_args,
+                                         os.path.join(overwrite_args.out_dir, f'{os.path.basename(overwrite_args.teacher_pth)}-{args.dataset}-targets.npy'))
+
+    student = SingleEncoder(args, get_num_class(args.dataset))
+    del teacher
+    student = student.to(args.device)
+    optimizer = get_optimizer(args, student)
+    scheduler = CosineSchedule(optimizer, K=args.scheduler_k)      # same schedule as a directly trained single_encoder
+
+    train_loader = make_dataloader(args, DistillDataset(ImageDataset(train_set, args), soft_targets), shuffle=True, drop_last=True)
+    valid_loader = make_dataloader(args, ImageDataset(valid_set, args, train=False), shuffle=False, drop_last=False)
+    best_acc = -1
+    for epoch in range(args.epochs):
+        student.train()
+        progress = tqdm(total=len(train_loader))
+        for img_path, img_tensor, target, label in DevicePrefetcher(train_loader, args.device):
+            loss = distillation_loss(student(img_tensor), target.to(args.device), label.to(args.device),
+                                     overwrite_args.temperature, overwrite_args.alpha)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            progress.set_postfix({"loss": loss.item()})
+            progress.update()
+        progress.close()
+        scheduler.step()
+
+        student.eval()
+        ground_truth_list, prediction_list = [], []
+        with torch.no_grad():
+            for img_path, img_tensor, _, label in DevicePrefetcher(valid_loader, args.device):
+                ground_truth_list += label.tolist()
+                prediction_list += student(img_tensor).argmax(-1).tolist()
+        metrics = calculate_metrics(args.dataset, ground_truth_list, prediction_list)
+        print(f'>>> Epoch {epoch}: {metrics}')
+        if metrics['valid_acc'] > best_acc:
+            best_acc = metrics['valid_acc']
+            torch.save({'epoch': epoch, 'model_state_dict': student.state_dict()},
+                       os.path.join(args.out_dir, f"{args.prefix_outdir}-{epoch}.pt"))
+
+if __name__ == '__main__':
+    main()
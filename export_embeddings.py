@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from torch.utils.data import Dataset
+from model.model_with_prompt import PromptModel
+from model.swin_transformer import ctranspath
+from datasets import ImageDataset, prepare_data
+from utils import load_training_args, make_dataloader
+from utils.ann_index import IVFIndex, benchmark_recall
+
+
+class ExportDataset(Dataset):
+    """Unaugmented images of all exported splits, returned with their row id."""
+    def __init__(self, pair_lists, args) -> None:
+        self.datasets = [ImageDataset(pair_list, args, train=False) for pair_list in pair_lists]
+        self.offsets = np.cumsum([0] + [len(d) for d in self.datasets])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, row):
+        split = int(np.searchsorted(self.offsets, row, side='right')) - 1
+        dataset = self.datasets[split]
+        return row, dataset.preprocess(dataset.load_image(row - self.offsets[split]))
+
+
+@torch.no_grad()
+def export_embeddings(encoder, dataset, out_dir, args, adapted=False):
+    """Pooled swin features (`forward_features`) of every image of `dataset` into `{out_dir}/embeddings.npy` (fp16)."""
+    loader = make_dataloader(args, dataset, shuffle=False, drop_last=False, persistent=False)
+    embeddings = None
+    encoder.eval()
+    for row, img_tensor in tqdm(loader):
+        feature = encoder.forward_features(img_tensor.to(args.device, dtype=torch.float32), adapted, adapted,
+                                           (0.0, args.lora_alpha) if adapted else None)
+        if embeddings is None:
+            embeddings = np.lib.format.open_memmap(os.path.join(out_dir, 'embeddings.npy'), mode='w+',
+                                                   dtype=np.float16, shape=(len(dataset), feature.shape[1]))
+        embeddings[row.numpy()] = feature.half().cpu().numpy()
+    embeddings.flush()
+    return embeddings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='prostate-1')
+    parser.add_argument('--splits', type=int, nargs='+', default=[0, 1, 2])      # indices into prepare_data's splits
+    parser.add_argument('--model_pth', type=str, default=None)                  # PromptModel checkpoint, plain ctranspath if None
+    parser.add_argument('--adapted', action='store_true')                        # use the checkpoint's prompts/LoRA in the encoder
+    parser.add_argument('--encoder_ckpt_path', type=str, default='/home/compu/anhnguyen/prompt_works/model/ctranspath.pth')
+    parser.add_argument('--bs', type=int, default=512)
+    parser.add_argument('--num_workers', type=int, default=16)
+    parser.add_argument('--device', type=int, default=0)                        # -1 for CPU
+    parser.add_argument('--out_dir', type=str, required=True)
+
+    # Index
+    parser.add_argument('--num_lists', type=int, default=1024)                   # IVF cells
+    parser.add_argument('--nprobe', type=int, default=16)                        # cells scanned per query
+    parser.add_argument('--benchmark', action='store_true')                      # recall@k and latency against brute force
+    parser.add_argument('--k', type=int, default=10)
+    overwrite_args = parser.parse_args()
+
+    device = torch.device(f'cuda:{overwrite_args.device}') if overwrite_args.device >= 0 else torch.device('cpu')
+    if overwrite_args.model_pth is not None:
+        args = load_training_args(overwrite_args.model_pth)
+        args.device, args.compile = device, False
+        model = PromptModel(args)
+        model.load_state_dict(torch.load(args.model_pth, map_location=device)['model_state_dict'], strict=True)
+        encoder = model.encoder
+    else:
+        args = argparse.Namespace(type='single_encoder', encoder_type='ctranspath', encoder_resize=224,
+                                  encoder_mean=(0.485, 0.456, 0.406), encoder_std=(0.229, 0.224, 0.225), breakhis_fold=1)
+        encoder = ctranspath()
+        encoder.head = torch.nn.Identity()
+        encoder.load_state_dict(torch.load(overwrite_args.encoder_ckpt_path, map_location='cpu')['model'], strict=True)
+    assert args.encoder_type in ['ctranspath', 'swin_tiny'], 'embedding export reads the swin encoder'
+    for key in ['dataset', 'bs', 'num_workers']:
+        setattr(args, key, getattr(overwrite_args, key))
+    args.device = device
+    encoder = encoder.to(device)
+
+    data = prepare_data(args)
+    data = data if isinstance(data, tuple) else (data,)
+    splits = [s for s in overwrite_args.splits if s < len(data)]
+    os.makedirs(overwrite_args.out_dir, exist_ok=True)
+
+    # id table: row -> split, path, label
+    with open(os.path.join(overwrite_args.out_dir, 'ids.tsv'), 'w') as file:
+        row = 0
+        for split in splits:
+            for path, label in data[split]:
+                file.write(f'{row}\t{split}\t{path}\t{label}\n')
+                row += 1
+
+    embeddings = export_embeddings(encoder, ExportDataset([data[s] for s in splits], args), overwrite_args.out_dir, args,
+                                   adapted=overwrite_args.adapted and overwrite_args.model_pth is not None)
+    print(f'>>> Exported {embeddings.shape} embeddings to {overwrite_args.out_dir}')
+
+    index = IVFIndex(overwrite_args.num_lists, overwrite_args.nprobe, device=device).train(embeddings).add(embeddings)
+    index.save(os.path.join(overwrite_args.out_dir, 'ivf.pt'))
+    if overwrite_args.benchmark:
+        results = benchmark_recall(index, embeddings, k=overwrite_args.k)
+        for r in results:
+            print(f"{r['method']}: recall@{overwrite_args.k} {r['recall']:.4f}, {r['latency_per_query_ms']:.3f} ms/query")
+        with open(os.path.join(overwrite_args.out_dir, 'ann_benchmark.json'), 'w') as file:
+            json.dump(results, file)
+
+if __name__ == '__main__':
+    main()
@@ -33,6 +33,7 @@ from transformers.utils import (
     replace_return_docstrings,
 )
 from transformers.models.clip.configuration_clip import CLIPConfig, CLIPTextConfig, CLIPVisionConfig
+from .mask_cache import CausalMaskCache
 
 
 logger = logging.get_logger(__name__)
@@ -261,10 +262,8 @@ class CLIPAttention(nn.Module):
         self,
         hidden_states: torch.Tensor,
         attention_mask: Optional[torch.Tensor] = None,
-        causal_attention_mask: Optional[torch.Tensor] = None,
         output_attentions: Optional[bool] = False,
-        prompt_for_layer = None,
-        proj_encoder_feature = None,
+        prefix_key_value = None,
         lora_for_layer = None,
         lora_config = None,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
@@ -278,7 +277,7 @@ class CLIPAttention(nn.Module):
 
         if lora_for_layer is not None:
             lora_scale = lora_config[1] / lora_for_layer[0].shape[1]
-            lora_dropout = nn.Dropout(lora_config[0])
+            lora_dropout = lambda x: nn.functional.dropout(x, lora_config[0])   # functional: no module created per call
             query_states = torch.add(query_states, torch.matmul(lora_dropout(query_states),torch.matmul(lora_for_layer[0],lora_for_layer[1])*lora_scale))
             key_states = torch.add(key_states, torch.matmul(lora_dropout(key_states),torch.matmul(lora_for_layer[2],lora_for_layer[3])*lora_scale))
             value_states = torch.add(value_states, torch.matmul(lora_dropout(value_states),torch.matmul(lora_for_layer[4],lora_for_layer[5])*lora_scale))
@@ -287,25 +286,10 @@ class CLIPAttention(nn.Module):
         key_states = self._shape(key_states, -1, bsz)          # bs, num_heads (8), seq_len, model_dim//num_head (64)
         value_states = self._shape(value_states, -1, bsz)      # bs, num_heads (8), seq_len, model_dim//num_head (64)
         
-        # prepend visual feature
-        if proj_encoder_feature is not None:
-            proj_encoder_feature = \
-                proj_encoder_feature.reshape(bsz, self.num_heads, -1, embed_dim // self.num_heads)  # bs, num_heads, prompt_len, head_dim
-            key_states = torch.cat((proj_encoder_feature,key_states), dim=2)                        # bs, num_heads, seq_len+prompt_len, head_dim 
-            value_states = torch.cat((proj_encoder_feature,value_states), dim=2)                    # bs, num_heads, seq_len+prompt_len, head_dim
-
-        # prepend prompt
-        if prompt_for_layer is not None:
-            if isinstance(prompt_for_layer,nn.ParameterList):            # distinct prompts for K and V
-                pk = prompt_for_layer[0].expand(bsz,-1,-1)   # bs*num_win, prompt_len, dim
-                pv = prompt_for_layer[1].expand(bsz,-1,-1)
-            else:                                            # unified prompt for K and V
-                pk = prompt_for_layer.expand(bsz,-1,-1)      # bs*num_win, prompt_len, dim
-                pv = prompt_for_layer.expand(bsz,-1,-1) 
-            pk = pk.reshape(bsz, self.num_heads, -1, embed_dim // self.num_heads)        # bs, num_heads, prompt_len, head_dim
-            pv = pv.reshape(bsz, self.num_heads, -1, embed_dim // self.num_heads)        # bs, num_heads, prompt_len, head_dim
-            key_states = torch.cat((pk,key_states), dim=2)                        # bs, num_heads, seq_len+prompt_len, head_dim 
-            value_states = torch.cat((pv,value_states), dim=2)                    # bs, num_heads, seq_len+prompt_len, head_dim
+        # prepend the head-split [prompt, visual feature] prefix prepared once per forward by CLIPEncoder
+        if prefix_key_value is not None:
+            key_states = torch.cat((prefix_key_value[0],key_states), dim=2)                # bs, num_heads, prefix_len+seq_len, head_dim 
+            value_states = torch.cat((prefix_key_value[1],value_states), dim=2)            # bs, num_heads, prefix_len+seq_len, head_dim
             
         proj_shape = (bsz * self.num_heads, -1, self.head_dim)
         query_states = self._shape(query_states, src_len, bsz).view(*proj_shape)   # bs x num_heads, seq_len, model_dim//num_head (64)
@@ -321,26 +305,15 @@ class CLIPAttention(nn.Module):
                 f" {attn_weights.size()}"
             )
 
-        # apply the causal_attention_mask first
-        if causal_attention_mask is not None:                                       # for autoregressive style
-            if causal_attention_mask.size() != (bsz, 1, src_len, src_len):
+        # combined causal + padding mask over [prefix, text] keys, built once per forward by CLIPEncoder.mask_cache
+        if attention_mask is not None:
+            if attention_mask.shape[-2:] != (src_len, src_len+prompt_len):
                 raise ValueError(
-                    f"Attention mask should be of size {(bsz, 1, src_len, src_len)}, but is"
-                    f" {causal_attention_mask.size()}"
+                    f"Attention mask should be of size {(bsz, 1, src_len, src_len+prompt_len)}, but is {attention_mask.size()}"
                 )
-            temp = attn_weights.view(bsz, self.num_heads, src_len, src_len+prompt_len)[:,:,:,prompt_len:] + causal_attention_mask
-            attn_weights.view(bsz, self.num_heads, src_len, src_len+prompt_len)[:,:,:,prompt_len:] = temp
+            attn_weights = attn_weights.view(bsz, self.num_heads, src_len, src_len+prompt_len) + attention_mask
             attn_weights = attn_weights.view(bsz * self.num_heads, src_len, src_len+prompt_len)
 
-        if attention_mask is not None:                                              # for padding position
-            if attention_mask.size() != (bsz, 1, src_len, src_len):
-                raise ValueError(
-                    f"Attention mask should be of size {(bsz, 1, src_len, src_len)}, but is {attention_mask.size()}"
-                )
-            temp =  attn_weights.view(bsz, self.num_heads, src_len, src_len+prompt_len)[:,:,:,prompt_len:] + attention_mask
-            attn_weights.view(bsz, self.num_heads, src_len, src_len+prompt_len)[:,:,:,prompt_len:] =  temp
-            attn_weights = attn_weights.view(bsz * self.num_heads, src_len, -1)
-
         attn_weights = nn.functional.softmax(attn_weights, dim=-1)                  # bs x num_heads, seq_len, seq_len
 
         if output_attentions:
@@ -400,10 +373,8 @@ class CLIPEncoderLayer(nn.Module):
         self,
         hidden_states: torch.Tensor,
         attention_mask: torch.Tensor,
-        causal_attention_mask: torch.Tensor,
-        proj_encoder_feature: torch.Tensor,
         output_attentions: Optional[bool] = False,
-        prompt_for_layer = None,
+        prefix_key_value = None,
         lora_for_layer = None,
         lora_config = None
     ) -> Tuple[torch.FloatTensor]:
@@ -411,8 +382,8 @@ class CLIPEncoderLayer(nn.Module):
         Args:
             hidden_states (`torch.FloatTensor`): input to the layer of shape `(batch, seq_len, embed_dim)`
             attention_mask (`torch.FloatTensor`): attention mask of size
-                `(batch, 1, tgt_len, src_len)` where padding elements are indicated by very large negative values.
-                `(config.encoder_attention_heads,)`.
+                `(batch, 1, tgt_len, prefix_len + src_len)` where masked elements are indicated by very large negative
+                values.
             output_attentions (`bool`, *optional*):
                 Whether or not to return the attentions tensors of all attention layers. See `attentions` under
                 returned tensors for more detail.
@@ -423,10 +394,8 @@ class CLIPEncoderLayer(nn.Module):
         hidden_states, attn_weights = self.self_attn(
             hidden_states=hidden_states,
             attention_mask=attention_mask,
-            causal_attention_mask=causal_attention_mask,
             output_attentions=output_attentions,
-            prompt_for_layer=prompt_for_layer,
-            proj_encoder_feature=proj_encoder_feature,
+            prefix_key_value=prefix_key_value,
             lora_for_layer=lora_for_layer,
             lora_config=lora_config
         )
@@ -628,6 +597,78 @@ class CLIPEncoder(nn.Module):
         self.config = config
         self.layers = nn.ModuleList([CLIPEncoderLayer(config) for _ in range(config.num_hidden_layers)])
         self.gradient_checkpointing = False
+        self.gradient_checkpointing_layers = None    # None: checkpoint every layer when enabled
+        self.mask_cache = CausalMaskCache()          # causal masks shared by all layers
+        self.layer_config = None                     # resolved per-layer prompts/lora/visual usage, see resolve_layer_config
+        self.decoder_skip_layers_for_visual = []
+
+    def _build_layer_config(self):
+        prompts, loras, use_visual = [], [], []
+        visual = True
+        for idx in range(len(self.layers)):
+            prompt_for_layer = getattr(self, f'prompt_layer_{idx}', None)
+            if isinstance(prompt_for_layer,nn.ParameterList):            # distinct prompts for K and V
+                prompt_for_layer = (prompt_for_layer[0], prompt_for_layer[1])
+            elif prompt_for_layer is not None:                           # unified prompt for K and V
+                prompt_for_layer = (prompt_for_layer, prompt_for_layer)
+            prompts.append(prompt_for_layer)
+            loras.append(getattr(self, f'lora_layer_{idx}', None))
+            if idx in self.decoder_skip_layers_for_visual:               # once skipped, the visual feature is dropped for later layers
+                visual = False
+            use_visual.append(visual)
+        return prompts, loras, use_visual
+
+    def resolve_layer_config(self, enable=True):
+        """
+        Looks up the prompt and LoRA weights of every layer and whether it attends to the visual feature once, so that
+        the forward no longer depends on `hasattr`/`isinstance` checks (stable graphs under `torch.compile`). Call it
+        again after replacing prompts or LoRA weights.
+        """
+        self.layer_config = self._build_layer_config() if enable else None
+
+    def get_layer_config(self):
+        return self.layer_config if self.layer_config is not None else self._build_layer_config()
+
+    def get_prefix_key_values(self, proj_encoder_feature, batch_size, use_prompt=True, prompts=None):
+        """
+        Splits the layer prompts and the projected visual feature into heads once, so that every layer only
+        concatenates a ready [prompt, visual feature] prefix onto its keys and values.
+
+        Args:
+            prompts (`list`, *optional*):
+                per-layer prompts (a tensor, a (key, value) pair or None) used instead of the registered ones,
+                e.g. the projected encoder prompts of `PromptModelWithConnection`
+
+        Returns:
+            list with, for each layer, a (prefix_key, prefix_value) pair of shape (bs, num_heads, prefix_len, head_dim)
+            or None when the layer has no prefix
+        """
+        num_heads = self.config.num_attention_heads
+        head_dim = self.config.hidden_size // num_heads
+        if proj_encoder_feature is not None:
+            proj_encoder_feature = proj_encoder_feature.reshape(batch_size, num_heads, -1, head_dim)   # bs, num_heads, visual_len, head_dim
+
+        layer_prompts, _, use_visual = self.get_layer_config()
+        if prompts is not None:
+            layer_prompts = [p if p is None or isinstance(p, (tuple, list)) else (p, p) for p in prompts]
+        prefix_key_values = []
+        for idx in range(len(self.layers)):
+            prefix_key, prefix_value = [], []
+            if use_prompt and layer_prompts[idx] is not None:
+                pk, pv = layer_prompts[idx]
+                prefix_key.append(pk.reshape(1, num_heads, -1, head_dim).expand(batch_size, -1, -1, -1))     # bs, num_heads, prompt_len, head_dim
+                prefix_value.append(pv.reshape(1, num_heads, -1, head_dim).expand(batch_size, -1, -1, -1))
+            if proj_encoder_feature is not None and use_visual[idx]:
+                prefix_key.append(proj_encoder_feature)
+                prefix_value.append(proj_encoder_feature)
+
+            if len(prefix_key) == 0:
+                prefix_key_values.append(None)
+            elif len(prefix_key) == 1:
+                prefix_key_values.append((prefix_key[0], prefix_value[0]))
+            else:
+                prefix_key_values.append((torch.cat(prefix_key, dim=2), torch.cat(prefix_value, dim=2)))
+        return prefix_key_values
 
     def forward(
         self,
@@ -635,12 +676,13 @@ class CLIPEncoder(nn.Module):
         proj_encoder_feature,
         lora_config,
         attention_mask: Optional[torch.Tensor] = None,
-        causal_attention_mask: Optional[torch.Tensor] = None,
+        causal: bool = False,
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         use_lora=True,
         use_prompt=True,
+        prefix_key_values=None,
     ) -> Union[Tuple, BaseModelOutput]:
         r"""
         Args:
@@ -655,13 +697,9 @@ class CLIPEncoder(nn.Module):
                 - 0 for tokens that are **masked**.
 
                 [What are attention masks?](../glossary#attention-mask)
-            causal_attention_mask (`torch.Tensor` of shape `(batch_size, sequence_length)`, *optional*):
-                Causal mask for the text model. Mask values selected in `[0, 1]`:
-
-                - 1 for tokens that are **not masked**,
-                - 0 for tokens that are **masked**.
-
-                [What are attention masks?](../glossary#attention-mask)
+            causal (`bool`, *optional*, defaults to `False`):
+                Whether to apply the causal mask of the text model. It is merged with `attention_mask` into one
+                additive mask per prefix length, shared by all layers.
             output_attentions (`bool`, *optional*):
                 Whether or not to return the attentions tensors of all attention layers. See `attentions` under
                 returned tensors for more detail.
@@ -670,6 +708,8 @@ class CLIPEncoder(nn.Module):
                 for more detail.
             return_dict (`bool`, *optional*):
                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
+            prefix_key_values (`list`, *optional*):
+                Head-split prefixes from [`CLIPEncoder.get_prefix_key_values`], built here when not given.
         """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions   # false by default
         output_hidden_states = (
@@ -681,41 +721,43 @@ class CLIPEncoder(nn.Module):
         all_attentions = () if output_attentions else None
 
         hidden_states = inputs_embeds                                                                               # bs, seq_len, model_dim (512)
+        if prefix_key_values is None:
+            prefix_key_values = self.get_prefix_key_values(proj_encoder_feature, hidden_states.shape[0], use_prompt=use_prompt)
+        layer_attention_masks = self.mask_cache.layer_masks(prefix_key_values, hidden_states.shape[1], hidden_states.dtype,
+                                                            hidden_states.device, padding_mask=attention_mask, causal=causal)
+        layer_loras = self.get_layer_config()[1]
         for idx, encoder_layer in enumerate(self.layers):
             if output_hidden_states:
                 encoder_states = encoder_states + (hidden_states,)
-            if self.gradient_checkpointing and self.training:
+            prefix_key_value = prefix_key_values[idx]
+            lora_for_layer = layer_loras[idx] if use_lora else None
 
-                def create_custom_forward(module):
+            if self.gradient_checkpointing and self.training and \
+                    (self.gradient_checkpointing_layers is None or idx in self.gradient_checkpointing_layers):
+
+                def create_custom_forward(module, prefix_key_value, lora_for_layer):
                     def custom_forward(*inputs):
-                        return module(*inputs, output_attentions)
+                        return module(*inputs,
+                                      output_attentions=output_attentions,
+                                      prefix_key_value=prefix_key_value,
+                                      lora_for_layer=lora_for_layer,
+                                      lora_config=lora_config)
 
                     return custom_forward
 
+                # non-reentrant so that prompts/lora captured by the closure still receive gradients
                 layer_outputs = torch.utils.checkpoint.checkpoint(
-                    create_custom_forward(encoder_layer),
+                    create_custom_forward(encoder_layer, prefix_key_value, lora_for_layer),
                     hidden_states,
-                    attention_mask,
-                    causal_attention_mask,
+                    layer_attention_masks[idx],
+                    use_reentrant=False,
                 )
             else:
-                if idx in self.decoder_skip_layers_for_visual:
-                    proj_encoder_feature = None
-                if not hasattr(self, f'prompt_layer_{idx}') or not use_prompt:
-                    prompt_for_layer = None
-                else:
-                    prompt_for_layer = getattr(self, f'prompt_layer_{idx}')
-                if not hasattr(self, f'lora_layer_{idx}') or not use_lora:
-                    lora_for_layer = None
-                else:
-                    lora_for_layer = getattr(self, f'lora_layer_{idx}')
                 layer_outputs = encoder_layer(
                     hidden_states,
-                    attention_mask,
-                    causal_attention_mask,
+                    layer_attention_masks[idx],
                     output_attentions=output_attentions,
-                    proj_encoder_feature=proj_encoder_feature,
-                    prompt_for_layer=prompt_for_layer,
+                    prefix_key_value=prefix_key_value,
                     lora_for_layer=lora_for_layer,
                     lora_config=lora_config
                 )
@@ -777,6 +819,7 @@ class CLIPTextTransformer(nn.Module):
         return_dict: Optional[bool] = None,
         use_prompt=True,
         use_lora=True,
+        prefix_key_values=None,
     ) -> Union[Tuple, BaseModelOutputWithPooling]:
         r"""
         Returns:
@@ -804,30 +847,24 @@ class CLIPTextTransformer(nn.Module):
             # TODO: forward through positional embedding
             hidden_states = inputs_embeds    # bs, seq_len, emb_dim (512)
         
-        # CLIP's text model uses causal mask, prepare it here.
-        # https://github.com/openai/CLIP/blob/cfcffb90e69f37bf2ff1e988237a0fbe41f33c04/clip/model.py#L324
-        causal_attention_mask = _make_causal_mask(input_shape, hidden_states.dtype, device=hidden_states.device)   # bs, 1, seq_len, seq_len
-        
         # used for produce the pooled output (emb of eos in last layer)
         eos_ids = attention_mask.argmin(dim=-1)-1  
         eos_ids = torch.where(eos_ids<0, input_shape[-1]-1, eos_ids) 
         
-        # expand attention_mask
-        if attention_mask is not None:
-            # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
-            attention_mask = _expand_mask(attention_mask, hidden_states.dtype)           # bsz, 1, src_seq_len, src_seq_len
-
+        # CLIP's text model uses causal mask; the encoder merges it (cached) with the padding attention_mask (bs, seq_len).
+        # https://github.com/openai/CLIP/blob/cfcffb90e69f37bf2ff1e988237a0fbe41f33c04/clip/model.py#L324
         encoder_outputs = self.encoder(
             inputs_embeds=hidden_states,
             proj_encoder_feature=proj_encoder_feature,
             attention_mask=attention_mask,
             lora_config=lora_config,
-            causal_attention_mask=causal_attention_mask,
+            causal=True,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
             use_prompt=use_prompt,
-            use_lora=use_lora
+            use_lora=use_lora,
+            prefix_key_values=prefix_key_values
         )
 
         last_hidden_state = encoder_outputs[0]                            # bs, seq_len, model_dim
@@ -932,6 +969,9 @@ class CLIPVisionTransformer(nn.Module):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        lora_config = None,
+        use_prompt=True,
+        use_lora=True,
     ) -> Union[Tuple, BaseModelOutputWithPooling]:
         r"""
         Returns:
@@ -952,9 +992,12 @@ class CLIPVisionTransformer(nn.Module):
         encoder_outputs = self.encoder(
             inputs_embeds=hidden_states,
             proj_encoder_feature=None,
+            lora_config=lora_config,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            use_prompt=use_prompt,
+            use_lora=use_lora,
         )
 
         last_hidden_state = encoder_outputs[0]
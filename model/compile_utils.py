@@ -0,0 +1,32 @@
+import math
+import torch
+
+
+class CompileCounter():
+    """
+    torch.compile backend that counts the graphs it compiles before handing them to the real backend. Any graph
+    compiled after the warm-up is a recompile (new shape, failed guard) or a graph break.
+    """
+    def __init__(self, backend='inductor') -> None:
+        self.backend = torch._dynamo.lookup_backend(backend) if isinstance(backend, str) else backend
+        self.num_graphs = 0
+        self.num_warmup_graphs = 0
+
+    def __call__(self, gm, example_inputs):
+        self.num_graphs += 1
+        return self.backend(gm, example_inputs)
+
+    def end_warmup(self):
+        self.num_warmup_graphs = self.num_graphs
+
+    @property
+    def num_recompiles(self):
+        return self.num_graphs - self.num_warmup_graphs
+
+    def __repr__(self) -> str:
+        return f'CompileCounter(graphs={self.num_graphs}, warmup={self.num_warmup_graphs}, recompiles={self.num_recompiles})'
+
+
+def bucket_length(seq_len, bucket, max_len):
+    """Rounds a caption length up to a multiple of `bucket` (at most `max_len`) so that only a few shapes occur."""
+    return min(max(bucket, math.ceil(seq_len / bucket) * bucket), max(max_len, seq_len))
@@ -47,6 +47,8 @@ from transformers.utils import (
 )
 from transformers.utils.model_parallel_utils import assert_device_map, get_device_map
 from transformers.models.gpt2.configuration_gpt2 import GPT2Config
+from .mask_cache import CausalMaskCache
+from .kv_cache import StaticKVCache
 
 
 logger = logging.get_logger(__name__)
@@ -183,13 +185,10 @@ class GPT2Attention(nn.Module):
     def _attn(self, query, key, value,  # bs, num_head, seq_len, head_dim
               attention_mask=None, 
               head_mask=None,
-              prompt_for_layer = None,
-              proj_encoder_feature = None,
+              prefix_key_value = None,
               lora_for_layer = None,
               lora_config = None,):
         # TODO: LORA here !!! 
-        bsz = query.shape[0]
-        head_dim = query.shape[-1]
 
         # if lora_for_layer is not None:
         #     lora_scale = lora_config[1] / lora_for_layer[0].shape[1]
@@ -198,20 +197,10 @@ class GPT2Attention(nn.Module):
         #     key = torch.add(key, torch.matmul(lora_dropout(key),torch.matmul(lora_for_layer[2],lora_for_layer[3])*lora_scale))
         #     value = torch.add(value, torch.matmul(lora_dropout(value),torch.matmul(lora_for_layer[4],lora_for_layer[5])*lora_scale))
 
-        if proj_encoder_feature is not None:
-            proj_encoder_feature = \
-                proj_encoder_feature.reshape(bsz, -1, self.num_heads, head_dim).permute(0, 2, 1, 3)    # bs, num_heads, prompt_len, head_dim
-            key = torch.cat((proj_encoder_feature,key), dim=2)                        # bs, num_heads, seq_len+prompt_len, head_dim 
-            value = torch.cat((proj_encoder_feature,value), dim=2)                    # bs, num_heads, seq_len+prompt_len, head_dim
-
-        if prompt_for_layer is not None:
-            assert len(prompt_for_layer.shape)==2, f'Check the shape of prompt for each layer in GPT2 {prompt_for_layer.shape}'
-            prompt_for_layer = prompt_for_layer.expand(bsz,-1,-1)                                      # expand prompt for all data in batch
-            pk, pv = (prompt_for_layer, prompt_for_layer)                                              # bs, prompt_len, dim
-            pk = pk.reshape(bsz, -1, self.num_heads, head_dim).permute(0, 2, 1, 3)  # bs, num_heads, prompt_len, head_dim
-            pv = pv.reshape(bsz, -1, self.num_heads, head_dim).permute(0, 2, 1, 3)  # bs, num_heads, prompt_len, head_dim
-            key = torch.cat((pk,key), dim=2)                        # bs, num_heads, seq_len+prompt_len, head_dim 
-            value = torch.cat((pv,value), dim=2)                    # bs, num_heads, seq_len+prompt_len, head_dim
+        # prepend the head-split [prompt, visual feature] prefix prepared once per forward by GPT2Model
+        if prefix_key_value is not None:
+            key = torch.cat((prefix_key_value[0],key), dim=2)                        # bs, num_heads, prefix_len+seq_len, head_dim 
+            value = torch.cat((prefix_key_value[1],value), dim=2)                    # bs, num_heads, prefix_len+seq_len, head_dim
 
         attn_weights = torch.matmul(query, key.transpose(-1, -2))           
 
@@ -224,19 +213,10 @@ class GPT2Attention(nn.Module):
         if self.scale_attn_by_inverse_layer_idx:
             attn_weights = attn_weights / float(self.layer_idx + 1)
 
-        if not self.is_cross_attention:
-            # if only "normal" attention layer implements causal mask
-            query_length, key_length = query.size(-2), key.size(-2)
-            causal_mask = self.bias[:, :, key_length - query_length : key_length, :key_length]   # TODO: fix causal mask for prompt; 1,1,seq_len,seq_len
-            mask_value = torch.finfo(attn_weights.dtype).min
-            # Need to be a tensor, otherwise we get error: `RuntimeError: expected scalar type float but found double`.
-            # Need to be on the same device, otherwise `RuntimeError: ..., x and y to be on the same device`
-            mask_value = torch.full([], mask_value, dtype=attn_weights.dtype).to(attn_weights.device)
-            attn_weights = torch.where(causal_mask, attn_weights.to(attn_weights.dtype), mask_value)   # bs,num_head,seq_len,seq_len
-
         if attention_mask is not None:
-            # Apply the attention mask
-            attn_weights[:,:,:,key_length - query_length:] = attn_weights[:,:,:,key_length - query_length:] + attention_mask
+            # Apply the attention mask; for self-attention it already combines the causal and padding masks over
+            # [prefix, text] keys (built once per forward by GPT2Model.mask_cache), bs,1,seq_len,prefix_len+seq_len
+            attn_weights = attn_weights + attention_mask
 
         attn_weights = nn.functional.softmax(attn_weights, dim=-1)
 
@@ -330,10 +310,10 @@ class GPT2Attention(nn.Module):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
         use_cache: Optional[bool] = False,
         output_attentions: Optional[bool] = False,
-        prompt_for_layer = None,
-        proj_encoder_feature = None,
+        prefix_key_value = None,
         lora_for_layer = None,
         lora_config = None,
+        static_kv = None,
     ) -> Tuple[Union[torch.Tensor, Tuple[torch.Tensor]], ...]:
         if encoder_hidden_states is not None:
             if not hasattr(self, "q_attn"):
@@ -350,7 +330,7 @@ class GPT2Attention(nn.Module):
         
         if lora_for_layer is not None:
             lora_scale = lora_config[1] / lora_for_layer[0].shape[1]
-            lora_dropout = nn.Dropout(lora_config[0])
+            lora_dropout = lambda x: nn.functional.dropout(x, lora_config[0])   # functional: no module created per call
             query = torch.add(query, torch.matmul(lora_dropout(query),torch.matmul(lora_for_layer[0],lora_for_layer[1])*lora_scale))
             key = torch.add(key, torch.matmul(lora_dropout(key),torch.matmul(lora_for_layer[2],lora_for_layer[3])*lora_scale))
             value = torch.add(value, torch.matmul(lora_dropout(value),torch.matmul(lora_for_layer[4],lora_for_layer[5])*lora_scale))
@@ -364,6 +344,14 @@ class GPT2Attention(nn.Module):
             key = torch.cat((past_key, key), dim=-2)
             value = torch.cat((past_value, value), dim=-2)
 
+        if static_kv is not None:
+            # write into the preallocated cache (prefix already stored in front) and attend to the whole buffer
+            key_buffer, value_buffer, slot_index = static_kv
+            key_buffer.index_copy_(2, slot_index, key)
+            value_buffer.index_copy_(2, slot_index, value)
+            key, value = key_buffer, value_buffer
+            prefix_key_value = None
+
         if use_cache is True:
             present = (key, value)
         else:
@@ -373,8 +361,7 @@ class GPT2Attention(nn.Module):
             attn_output, attn_weights = self._upcast_and_reordered_attn(query, key, value, attention_mask, head_mask)
         else:
             attn_output, attn_weights = self._attn(query, key, value, attention_mask, head_mask, 
-                                                   prompt_for_layer = prompt_for_layer,
-                                                   proj_encoder_feature = proj_encoder_feature,
+                                                   prefix_key_value = prefix_key_value,
                                                    lora_for_layer = lora_for_layer,
                                                    lora_config = lora_config
                                                    )
@@ -433,10 +420,10 @@ class GPT2Block(nn.Module):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
         use_cache: Optional[bool] = False,
         output_attentions: Optional[bool] = False,
-        proj_encoder_feature = None,
-        prompt_for_layer = None,
+        prefix_key_value = None,
         lora_for_layer = None,
         lora_config = None,
+        static_kv = None,
     ) -> Union[Tuple[torch.Tensor], Optional[Tuple[torch.Tensor, Tuple[torch.FloatTensor, ...]]]]:
         residual = hidden_states
         hidden_states = self.ln_1(hidden_states)
@@ -447,10 +434,10 @@ class GPT2Block(nn.Module):
             head_mask=head_mask,
             use_cache=use_cache,
             output_attentions=output_attentions,
-            proj_encoder_feature=proj_encoder_feature,
-            prompt_for_layer=prompt_for_layer,
+            prefix_key_value=prefix_key_value,
             lora_for_layer=lora_for_layer,
             lora_config=lora_config,
+            static_kv=static_kv,
         )
         attn_output = attn_outputs[0]  # output_attn: a, present, (attentions)
         outputs = attn_outputs[1:]
@@ -743,6 +730,10 @@ class GPT2Model(GPT2PreTrainedModel):
         self.model_parallel = False
         self.device_map = None
         self.gradient_checkpointing = False
+        self.gradient_checkpointing_layers = None    # None: checkpoint every layer when enabled
+        self.mask_cache = CausalMaskCache()          # causal masks shared by all layers
+        self.layer_config = None                     # resolved per-layer prompts/lora/visual usage, see resolve_layer_config
+        self.decoder_skip_layers_for_visual = []
 
         # Initialize weights and apply final processing
         self.post_init()
@@ -804,6 +795,71 @@ class GPT2Model(GPT2PreTrainedModel):
         for layer, heads in heads_to_prune.items():
             self.h[layer].attn.prune_heads(heads)
 
+    def _build_layer_config(self):
+        prompts, loras, use_visual = [], [], []
+        visual = True
+        for i in range(len(self.h)):
+            prompts.append(getattr(self, f'prompt_layer_{i}', None))
+            loras.append(getattr(self, f'lora_layer_{i}', None))
+            if i in self.decoder_skip_layers_for_visual:     # once skipped, the visual feature is dropped for later layers
+                visual = False
+            use_visual.append(visual)
+        return prompts, loras, use_visual
+
+    def resolve_layer_config(self, enable=True):
+        """
+        Looks up the prompt and LoRA weights of every layer and whether it attends to the visual feature once, so that
+        the forward no longer depends on `hasattr` checks (stable graphs under `torch.compile`). Call it again after
+        replacing prompts or LoRA weights.
+        """
+        self.layer_config = self._build_layer_config() if enable else None
+
+    def get_layer_config(self):
+        return self.layer_config if self.layer_config is not None else self._build_layer_config()
+
+    def get_prefix_key_values(self, proj_encoder_feature, batch_size, use_prompt=True):
+        """
+        Splits the layer prompts and the projected visual feature into heads once, so that every layer only
+        concatenates a ready [prompt, visual feature] prefix onto its keys and values.
+
+        Returns:
+            list with, for each layer, a (prefix_key, prefix_value) pair of shape (bs, num_heads, prefix_len, head_dim)
+            or None when the layer has no prefix
+        """
+        num_heads = self.config.num_attention_heads
+        head_dim = self.embed_dim // num_heads
+        if proj_encoder_feature is not None:
+            proj_encoder_feature = \
+                proj_encoder_feature.reshape(batch_size, -1, num_heads, head_dim).permute(0, 2, 1, 3)    # bs, num_heads, visual_len, head_dim
+
+        layer_prompts, _, use_visual = self.get_layer_config()
+        prefix_key_values = []
+        for i in range(len(self.h)):
+            prefix = []
+            prompt_for_layer = layer_prompts[i] if use_prompt else None
+            if prompt_for_layer is not None:
+                assert len(prompt_for_layer.shape)==2, f'Check the shape of prompt for each layer in GPT2 {prompt_for_layer.shape}'
+                prompt_for_layer = prompt_for_layer.reshape(1, -1, num_heads, head_dim).permute(0, 2, 1, 3)   # 1, num_heads, prompt_len, head_dim
+                prefix.append(prompt_for_layer.expand(batch_size, -1, -1, -1))
+            if proj_encoder_feature is not None and use_visual[i]:
+                prefix.append(proj_encoder_feature)
+
+            if len(prefix) == 0:
+                prefix_key_values.append(None)
+            else:
+                prefix = prefix[0] if len(prefix) == 1 else torch.cat(prefix, dim=2)   # bs, num_heads, prefix_len, head_dim
+                prefix_key_values.append((prefix, prefix))
+        return prefix_key_values
+
+    def init_static_kv_cache(self, prefix_key_values, batch_size, max_text_len):
+        """
+        Preallocates the key/value buffers for decoding `max_text_len` text tokens after the given prefixes. Pass the
+        cache and the text slots of the new tokens (`cache_position`) to `forward` to decode step by step.
+        """
+        num_heads = self.config.num_attention_heads
+        return StaticKVCache(prefix_key_values, batch_size, max_text_len, num_heads, self.embed_dim // num_heads,
+                             self.dtype, self.wte.weight.device)
+
     @add_start_docstrings_to_model_forward(GPT2_INPUTS_DOCSTRING)
     @add_code_sample_docstrings(
         checkpoint=_CHECKPOINT_FOR_DOC,
@@ -829,6 +885,9 @@ class GPT2Model(GPT2PreTrainedModel):
         return_dict: Optional[bool] = None,
         use_lora = True,
         use_prompt = True,
+        prefix_key_values = None,
+        static_kv_cache = None,
+        cache_position = None,
     ) -> Union[Tuple, BaseModelOutputWithPastAndCrossAttentions]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -861,6 +920,8 @@ class GPT2Model(GPT2PreTrainedModel):
             past_key_values = tuple([None] * len(self.h))
         else:
             past_length = past_key_values[0][0].size(-2)
+        if position_ids is None and static_kv_cache is not None:
+            position_ids = cache_position.unsqueeze(0)                              # text slots of the new tokens
         if position_ids is None:
             position_ids = torch.arange(past_length, input_shape[-1] + past_length, dtype=torch.long, device=device)
             position_ids = position_ids.unsqueeze(0).view(-1, input_shape[-1])     # bs, seq_len: 0 -> seq-1
@@ -870,20 +931,9 @@ class GPT2Model(GPT2PreTrainedModel):
             if batch_size <= 0:
                 raise ValueError("batch_size has to be defined and > 0")
             attention_mask = attention_mask.view(batch_size, -1)
-            # We create a 3D attention mask from a 2D tensor mask.
-            # Sizes are [batch_size, 1, 1, to_seq_length]
-            # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
-            # this attention mask is more simple than the triangular masking of causal attention
-            # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
-            attention_mask = attention_mask[:, None, None, :]
-
-            # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
-            # masked positions, this operation will create a tensor which is 0.0 for
-            # positions we want to attend and the dtype's smallest value for masked positions.
-            # Since we are adding it to the raw scores before the softmax, this is
-            # effectively the same as removing these entirely.
-            attention_mask = attention_mask.to(dtype=self.dtype)  # fp16 compatibility
-            attention_mask = (1.0 - attention_mask) * torch.finfo(self.dtype).min
+            # The 2D padding mask is merged with the causal mask into one additive
+            # [batch_size, 1, seq_length, prefix_length + seq_length] mask per prefix length
+            # once the prefixes are known (see `CausalMaskCache.layer_masks`).
 
         # If a 2D or 3D attention mask is provided for the cross-attention
         # we need to make broadcastable to [batch_size, num_heads, seq_length, seq_length]
@@ -915,6 +965,23 @@ class GPT2Model(GPT2PreTrainedModel):
 
         output_shape = input_shape + (hidden_states.size(-1),)
 
+        if static_kv_cache is not None:
+            # decoding with a preallocated cache (see init_static_kv_cache): the prefixes are already stored in it and
+            # attention_mask (bs, seq_len) only flags which of the new tokens are not padding
+            if attention_mask is None:
+                attention_mask = torch.ones(input_shape, dtype=torch.long, device=device)
+            static_kvs, layer_attention_masks = static_kv_cache.update(cache_position, attention_mask)
+            prefix_key_values = [None] * len(self.h)
+            use_cache = False
+        else:
+            static_kvs = [None] * len(self.h)
+            # head-split prompt/visual prefixes, built once for all layers (and reused across steps by generate)
+            if prefix_key_values is None:
+                prefix_key_values = self.get_prefix_key_values(proj_encoder_feature, batch_size, use_prompt=use_prompt)
+            # one combined causal + padding mask per distinct prefix length, shared by the layers
+            layer_attention_masks = self.mask_cache.layer_masks(prefix_key_values, input_shape[-1], self.dtype, device,
+                                                                padding_mask=attention_mask, past_len=past_length)
+
         if self.gradient_checkpointing and self.training:
             if use_cache:
                 logger.warning_once(
@@ -926,6 +993,7 @@ class GPT2Model(GPT2PreTrainedModel):
         all_self_attentions = () if output_attentions else None
         all_cross_attentions = () if output_attentions and self.config.add_cross_attention else None
         all_hidden_states = () if output_hidden_states else None
+        layer_loras = self.get_layer_config()[1]
         for i, (block, layer_past) in enumerate(zip(self.h, past_key_values)):
             # Model parallel
             if self.model_parallel:
@@ -934,56 +1002,55 @@ class GPT2Model(GPT2PreTrainedModel):
                 if layer_past is not None:
                     layer_past = tuple(past_state.to(hidden_states.device) for past_state in layer_past)
                 # Ensure that attention_mask is always on the same device as hidden_states
-                if attention_mask is not None:
-                    attention_mask = attention_mask.to(hidden_states.device)
+                if layer_attention_masks[i] is not None:
+                    layer_attention_masks[i] = layer_attention_masks[i].to(hidden_states.device)
                 if isinstance(head_mask, torch.Tensor):
                     head_mask = head_mask.to(hidden_states.device)
             if output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
-            if self.gradient_checkpointing and self.training:
+            prefix_key_value = prefix_key_values[i]
+            lora_for_layer = layer_loras[i] if use_lora else None
 
-                def create_custom_forward(module):
+            if self.gradient_checkpointing and self.training and \
+                    (self.gradient_checkpointing_layers is None or i in self.gradient_checkpointing_layers):
+
+                def create_custom_forward(module, prefix_key_value, lora_for_layer):
                     def custom_forward(*inputs):
                         # None for past_key_value
-                        return module(*inputs, use_cache, output_attentions)
+                        return module(*inputs, use_cache, output_attentions,
+                                      prefix_key_value=prefix_key_value,
+                                      lora_for_layer=lora_for_layer,
+                                      lora_config=lora_config)
 
                     return custom_forward
 
+                # non-reentrant checkpointing so that prompts/lora reached through the closure still get gradients
+                # even though the frozen hidden states entering the block do not require grad
                 outputs = torch.utils.checkpoint.checkpoint(
-                    create_custom_forward(block),
+                    create_custom_forward(block, prefix_key_value, lora_for_layer),
                     hidden_states,
                     None,
-                    attention_mask,
+                    layer_attention_masks[i],
                     head_mask[i],
                     encoder_hidden_states,
                     encoder_attention_mask,
+                    use_reentrant=False,
                 )
             else:
-                if i in self.decoder_skip_layers_for_visual:
-                    proj_encoder_feature = None
-                if not hasattr(self, f'prompt_layer_{i}') or not use_prompt:
-                    prompt_for_layer = None
-                else:
-                    prompt_for_layer = getattr(self, f'prompt_layer_{i}')
-                if not hasattr(self, f'lora_layer_{i}') or not use_lora:
-                    lora_for_layer = None
-                else:
-                    lora_for_layer = getattr(self, f'lora_layer_{i}')
-
                 outputs = block(
                     hidden_states,
                     layer_past=layer_past,
-                    attention_mask=attention_mask,
+                    attention_mask=layer_attention_masks[i],
                     head_mask=head_mask[i],
                     encoder_hidden_states=encoder_hidden_states,
                     encoder_attention_mask=encoder_attention_mask,
                     use_cache=use_cache,
                     output_attentions=output_attentions,
-                    proj_encoder_feature=proj_encoder_feature,
-                    prompt_for_layer=prompt_for_layer,
+                    prefix_key_value=prefix_key_value,
                     lora_for_layer=lora_for_layer,
-                    lora_config=lora_config
+                    lora_config=lora_config,
+                    static_kv=static_kvs[i]
                 )
 
             hidden_states = outputs[0]
@@ -1691,6 +1758,7 @@ class GPT2ForQuestionAnswering(GPT2PreTrainedModel):
         self.model_parallel = False
         self.device_map = None
         self.gradient_checkpointing = False
+        self.gradient_checkpointing_layers = None    # None: checkpoint every layer when enabled
 
         # Initialize weights and apply final processing
         self.post_init()
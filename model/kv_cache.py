@@ -0,0 +1,54 @@
+import torch
+import torch.nn as nn
+
+
+class StaticKVCache():
+    """
+    Preallocated key/value buffers for token-by-token GPT-2 decoding.
+
+    Each layer stores its head-split [prompt, visual feature] prefix once at the front of its buffers, followed by
+    `max_text_len` text slots that are written in place as tokens are decoded. All buffers keep their address for the
+    lifetime of the cache, so a decode step that reads and writes them can be captured in a CUDA graph.
+    """
+    def __init__(self, prefix_key_values, batch_size, max_text_len, num_heads, head_dim, dtype, device) -> None:
+        self.batch_size = batch_size
+        self.max_text_len = max_text_len
+        self.prefix_lens, self.layers = [], []
+        for prefix_key_value in prefix_key_values:
+            prefix_len = 0 if prefix_key_value is None else prefix_key_value[0].shape[2]
+            shape = (batch_size, num_heads, prefix_len + max_text_len, head_dim)
+            self.layers.append((torch.zeros(shape, dtype=dtype, device=device), torch.zeros(shape, dtype=dtype, device=device)))
+            self.prefix_lens.append(prefix_len)
+        self.text_valid = torch.zeros(batch_size, max_text_len, dtype=torch.bool, device=device)   # filled, non-pad text slots
+        self.key_pos = torch.arange(max_text_len, device=device)
+        self.set_prefix(prefix_key_values)
+
+    @torch.no_grad()
+    def set_prefix(self, prefix_key_values):
+        """Copies the prefixes of a new batch into the buffers (in place) and clears the text slots."""
+        for (key, value), prefix_key_value, prefix_len in zip(self.layers, prefix_key_values, self.prefix_lens):
+            if prefix_key_value is not None:
+                key[:, :, :prefix_len].copy_(prefix_key_value[0])
+                value[:, :, :prefix_len].copy_(prefix_key_value[1])
+        self.text_valid.zero_()
+
+    def update(self, cache_position, valid):
+        """
+        Marks the text slots at `cache_position` (q_len,) as filled with tokens whose `valid` (bs, q_len) flag is 1, and
+        returns for each layer the (key_buffer, value_buffer, slot_index) used by `GPT2Attention` and an additive mask
+        of shape (bs, 1, q_len, prefix_len+max_text_len).
+        """
+        self.text_valid.index_copy_(1, cache_position, valid.bool())
+        # a query at text position t sees the whole prefix and the filled non-pad text slots up to t
+        allowed = self.text_valid[:, None, None, :] & (self.key_pos[None, None, None, :] <= cache_position[None, None, :, None])
+        dtype = self.layers[0][0].dtype
+        text_mask = (~allowed).to(dtype) * torch.finfo(dtype).min
+
+        masks, static_kvs, layer_masks = {}, [], []
+        for (key, value), prefix_len in zip(self.layers, self.prefix_lens):
+            if prefix_len not in masks:
+                masks[prefix_len] = (nn.functional.pad(text_mask, (prefix_len, 0)), cache_position + prefix_len)
+            mask, slot_index = masks[prefix_len]
+            static_kvs.append((key, value, slot_index))
+            layer_masks.append(mask)
+        return static_kvs, layer_masks
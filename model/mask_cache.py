@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+
+
+class CausalMaskCache():
+    """
+    Additive attention masks over [prefix, text] keys, shared by all layers of a decoder.
+
+    The causal part only depends on (seq_len, prefix_len, dtype, device), so it is built once and cached. The padding
+    part changes with the batch and is merged into the causal part once per forward and per distinct prefix length
+    (layers that skip the visual feature have a shorter prefix), instead of in every attention layer.
+    """
+    def __init__(self, max_entries=64) -> None:
+        self.max_entries = max_entries
+        self.masks = OrderedDict()
+
+    @torch.no_grad()
+    def get(self, seq_len, prefix_len, dtype, device, past_len=0):
+        """
+        Returns:
+            `torch.Tensor` of shape (1, 1, seq_len, prefix_len+past_len+seq_len), 0 where a query can attend and the
+            dtype's smallest value elsewhere. The prefix (prompts and visual feature) is visible to every query.
+        """
+        key = (seq_len, prefix_len+past_len, dtype, device)
+        if key in self.masks:
+            self.masks.move_to_end(key)
+            return self.masks[key]
+
+        key_len = prefix_len + past_len + seq_len
+        query_pos = torch.arange(key_len - seq_len, key_len, device=device)[:, None]   # absolute position of each query
+        key_pos = torch.arange(key_len, device=device)[None, :]
+        mask = torch.zeros(seq_len, key_len, dtype=dtype, device=device)
+        mask.masked_fill_(key_pos > query_pos, torch.finfo(dtype).min)
+        mask = mask[None, None, :, :]                                                  # 1, 1, seq_len, key_len
+
+        self.masks[key] = mask
+        if len(self.masks) > self.max_entries:
+            self.masks.popitem(last=False)
+        return mask
+
+    @torch.no_grad()
+    def layer_masks(self, prefix_key_values, seq_len, dtype, device, padding_mask=None, causal=True, past_len=0):
+        """
+        Args:
+            prefix_key_values (`list`):
+                per-layer (prefix_key, prefix_value) pairs or None, as returned by `get_prefix_key_values`
+            padding_mask (`torch.Tensor` of shape (bs, past_len+seq_len), *optional*):
+                1 for text tokens to attend to and 0 for padding
+
+        Returns:
+            list with one additive mask per layer, broadcastable to (bs, num_heads, seq_len, key_len), or None for a
+            layer that needs no mask. Layers with the same prefix length share the same tensor.
+        """
+        if padding_mask is not None:
+            padding_mask = padding_mask.view(padding_mask.shape[0], -1)[:, None, None, :].to(dtype)
+            padding_mask = (1.0 - padding_mask) * torch.finfo(dtype).min                    # bs, 1, 1, past_len+seq_len
+        elif not causal:
+            return [None] * len(prefix_key_values)
+
+        masks, result = {}, []
+        for prefix_key_value in prefix_key_values:
+            prefix_len = 0 if prefix_key_value is None else prefix_key_value[0].shape[2]
+            if prefix_len not in masks:
+                if padding_mask is None:
+                    mask = self.get(seq_len, prefix_len, dtype, device, past_len)
+                else:
+                    mask = nn.functional.pad(padding_mask, (prefix_len, 0))                  # the prefix is never padded
+                    if causal:
+                        # clamp so that positions masked twice stay finite
+                        mask = (mask + self.get(seq_len, prefix_len, dtype, device, past_len)).clamp(min=torch.finfo(dtype).min)
+                masks[prefix_len] = mask
+            result.append(masks[prefix_len])
+        return result
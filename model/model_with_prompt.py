@@ -6,6 +6,7 @@ from .clip import CLIPModel
 from .gpt2 import GPT2Model
 from .prompt import EncoderPrompt, DecoderPrompt, Lora
 from model.projector import MLP, MLP_for_prompt
+from model.compile_utils import CompileCounter, bucket_length
 
 class PromptModel(nn.Module):
     def __init__(self, args):
@@ -21,16 +22,26 @@ class PromptModel(nn.Module):
             self._freeze_encoder_and_decoder()
             self._init_prompt()
         self._init_tokenizer()
+        self._init_gradient_checkpointing()
+        if getattr(args, 'encoder_prompt_broadcast', False) and args.encoder_type in ['ctranspath','swin_tiny']:
+            self.encoder.set_prompt_attention(broadcast=True)
+        if getattr(args, 'encoder_frozen_tables', False) and args.encoder_type in ['ctranspath','swin_tiny']:
+            self.encoder.set_frozen_tables(True)
+        if getattr(args, 'encoder_fast_partition', False) and args.encoder_type in ['ctranspath','swin_tiny']:
+            self.encoder.set_fast_partition(True)
+        self.compile_mode = False
+        if getattr(args, 'compile', False):
+            self.enable_compile_mode()
 
     def _init_encoder(self):
         if self.args.encoder_type == 'ctranspath':
             self.encoder = ctranspath()
             self.encoder.head = nn.Identity()
-            td = torch.load(self.args.encoder_ckpt_path)
+            td = torch.load(self.args.encoder_ckpt_path, map_location='cpu')
             self.encoder.load_state_dict(td['model'], strict=True)
         elif self.args.encoder_type == 'swin_tiny':
             self.encoder = swinv1()
-            td = torch.load(self.args.encoder_ckpt_path)
+            td = torch.load(self.args.encoder_ckpt_path, map_location='cpu')
             self.encoder.load_state_dict(td['model'], strict=True)
             self.encoder.head = nn.Identity()
         elif self.args.encoder_type == 'e_plip':
@@ -103,12 +114,89 @@ class PromptModel(nn.Module):
     def _init_projector(self):
         self.projector = MLP(self.args)
 
+    def _init_gradient_checkpointing(self):
+        # stages of the swin encoder (layers for e_plip) and layers of the decoder to recompute in backward
+        encoder_stages = [int(i) for i in getattr(self.args, 'encoder_checkpoint_stages', [])]
+        decoder_layers = [int(i) for i in getattr(self.args, 'decoder_checkpoint_layers', [])]
+        if len(encoder_stages) > 0:
+            if self.args.encoder_type in ['ctranspath','swin_tiny']:
+                self.encoder.set_grad_checkpointing(True, stages=encoder_stages)
+            elif self.args.encoder_type == 'e_plip':
+                self.encoder.encoder.gradient_checkpointing = True
+                self.encoder.encoder.gradient_checkpointing_layers = encoder_stages
+        if len(decoder_layers) > 0:
+            if self.args.decoder_type == 'd_plip':
+                decoder = self.decoder.encoder
+            elif self.args.decoder_type == 'gpt2':
+                decoder = self.decoder
+            decoder.gradient_checkpointing = True
+            decoder.gradient_checkpointing_layers = decoder_layers
+
     def _freeze_encoder_and_decoder(self):
         for param in self.encoder.parameters():
             param.requires_grad = False
         for param in self.decoder.parameters():
             param.requires_grad = False
 
+    def enable_compile_mode(self, backend='inductor'):
+        """
+        Static-shape execution for torch.compile: the per-layer prompt/LoRA/visual configuration of the encoder and
+        decoder is resolved once, captions are padded to a bucketed length (multiple of `args.compile_caption_len`)
+        and the encoder, projector and decoder forwards are compiled. `self.compile_counter` counts compiled graphs.
+        """
+        if self.args.encoder_type in ['ctranspath','swin_tiny']:
+            self.encoder.resolve_layer_config()
+        elif self.args.encoder_type == 'e_plip':
+            self.encoder.encoder.resolve_layer_config()
+        if self.args.decoder_type == 'd_plip':
+            self.decoder.encoder.resolve_layer_config()
+        elif self.args.decoder_type == 'gpt2':
+            self.decoder.resolve_layer_config()
+
+        self.compile_counter = CompileCounter(backend)
+        # compile the bound forwards so that parameter names (and saved checkpoints) stay unchanged
+        for module in [self.encoder, self.projector, self.decoder]:
+            module.forward = torch.compile(module.forward, backend=self.compile_counter)
+        self.compile_mode = True
+
+    def get_first_adapted_block(self):
+        """
+        Index of the first swin block with a prompt or LoRA. The patch embedding and all blocks before it are frozen and
+        unadapted, so their output only depends on the image (see `SwinTransformer.set_start_block`).
+        """
+        if self.args.type in ['full_ft', 'single_encoder'] or self.args.encoder_type not in ['ctranspath','swin_tiny']:
+            return 0
+        num_blocks = sum(len(layer.blocks) for layer in self.encoder.layers)
+        for block in range(num_blocks):
+            if getattr(self.encoder, f'prompt_layer_{block}', None) is not None or \
+                    getattr(self.encoder, f'lora_layer_{block}', None) is not None:
+                return block
+        return num_blocks
+
+    def warmup_compile(self, batch_size, steps=2):
+        """Runs dummy batches in the current train/eval mode so that graphs are compiled before the first real step."""
+        img = torch.zeros(batch_size, 3, 224, 224, device=self.device)
+        if self.args.encoder_type in ['ctranspath','swin_tiny'] and self.encoder.start_block > 0:
+            img = self.encoder.forward_prefix(img, self.encoder.start_block)     # cached activations instead of images
+        text = ['a'] * batch_size
+        with torch.set_grad_enabled(self.training):
+            for _ in range(steps):
+                self.forward(img, text)
+        self.compile_counter.end_warmup()
+        return self.compile_counter
+
+    def tokenize(self, text):
+        token = self.tokenizer(text, return_tensors="pt", padding=True)
+        input_ids, attention_mask = token['input_ids'], token['attention_mask']
+        seq_len = input_ids.shape[1]
+        if self.compile_mode:
+            # pad to a bucketed length so that the compiled decoder only sees a few fixed shapes
+            tokenizer = getattr(self.tokenizer, 'tokenizer', self.tokenizer)
+            pad_len = bucket_length(seq_len, getattr(self.args, 'compile_caption_len', 32), tokenizer.model_max_length) - seq_len
+            input_ids = nn.functional.pad(input_ids, (0, pad_len), value=tokenizer.pad_token_id)
+            attention_mask = nn.functional.pad(attention_mask, (0, pad_len), value=0)
+        return input_ids.to(self.device), attention_mask.to(self.device), seq_len
+
     def get_query(self, img, text):
         with torch.no_grad():
             if self.args.encoder_type in ['ctranspath','swin_tiny']:
@@ -132,21 +220,18 @@ class PromptModel(nn.Module):
                                           lora_config=None).last_hidden_state[:,-1,:]
                 query = torch.cat((visual_query, text_query),dim=1)
             elif self.args.encoder_type == 'e_plip':
-                for layer_id in self.encoder_prompt_dict:
-                    setattr(self.encoder.encoder, f'prompt_layer_{layer_id}', None)
-                query = self.encoder(img)[1]
-                for layer_id in self.encoder_prompt_dict:
-                    setattr(self.encoder.encoder, f'prompt_layer_{layer_id}', self.encoder_prompt_dict[layer_id])
+                query = self.encoder(img, use_prompt=False, use_lora=False)[1]
         return query
 
     def forward(self, img, text):
-        assert len(img.shape)==4 and img.shape[1:] == (3,224,224), \
-                    f'Expect img input of shape (bs,3,224,3,224) but got {img.shape}'
+        assert (len(img.shape)==4 and img.shape[1:] == (3,224,224)) or \
+                    (len(img.shape)==3 and getattr(self.encoder, 'start_block', 0) > 0), \
+                    f'Expect img input of shape (bs,3,224,3,224) or cached encoder tokens but got {img.shape}'
         # Forward through an encoder
         if self.args.encoder_type in ['ctranspath','swin_tiny']:
             img = self.encoder(img, lora_config=(self.args.lora_drop_out, self.args.lora_alpha))
         elif self.args.encoder_type == 'e_plip':
-            img = self.encoder(img)[1]
+            img = self.encoder(img, lora_config=(self.args.lora_drop_out, self.args.lora_alpha))[1]
 
         # Forward through a projector
         img = self.projector(img)
@@ -156,26 +241,33 @@ class PromptModel(nn.Module):
             img = img.reshape(img.shape[0], -1, 768)
 
         # Forward though a decoder
-        text = self.tokenizer(text, return_tensors="pt", padding=True)
-        input_ids = text['input_ids'].to(self.device)
-        attention_mask = text['attention_mask'].to(self.device)
+        input_ids, attention_mask, seq_len = self.tokenize(text)
         output = self.decoder(proj_encoder_feature=img, 
                               input_ids=input_ids, 
                               attention_mask=attention_mask,
                               lora_config=(self.args.lora_drop_out, self.args.lora_alpha)
                               )
-        logits = self.decoder_head(output.last_hidden_state)
+        # bucket padding is trailing and causally masked, so the first seq_len positions match the unpadded forward
+        logits = self.decoder_head(output.last_hidden_state[:,:seq_len])
 
         return {
-            'input_ids': input_ids,
+            'input_ids': input_ids[:,:seq_len],
             'last_layer_logits': logits
         }
     
-    def forward_decoder(self, proj_encoder_feature, input_ids, attention_mask):
+    def get_prefix_key_values(self, proj_encoder_feature):
+        # head-split [prompt, visual feature] prefixes, reusable across the decoding steps of a batch
+        decoder = self.decoder.encoder if self.args.decoder_type == 'd_plip' else self.decoder
+        return decoder.get_prefix_key_values(proj_encoder_feature, proj_encoder_feature.shape[0])
+
+    def forward_decoder(self, proj_encoder_feature, input_ids, attention_mask, prefix_key_values=None, **cache_kwargs):
+        # cache_kwargs: static_kv_cache and cache_position for gpt2 static-cache decoding (utils/graph_decode.py)
         output = self.decoder(proj_encoder_feature=proj_encoder_feature,
                               input_ids=input_ids, 
                               attention_mask=attention_mask,
-                              lora_config=(0.0, self.args.lora_alpha))
+                              lora_config=(0.0, self.args.lora_alpha),
+                              prefix_key_values=prefix_key_values,
+                              **cache_kwargs)
         return output
 
 class PromptModelWithConnection(nn.Module):
@@ -240,16 +332,6 @@ class PromptModelWithConnection(nn.Module):
                     f'Expect img input of shape (bs,3,224,3,224) but got {img.shape}'
         img = self.encoder(img, use_prompt=True)
         img = self.projector(img)
-
-        # Forward prompt though connection
-        for layer_id in self.encoder_prompt_dict:
-            if self.encoder_prompt_dict[layer_id] is not None:
-                projector = getattr(self, f'prompt_projector_{layer_id}')
-                proj_prompt = projector(getattr(self.encoder, f'prompt_layer_{layer_id}'))
-                setattr(self.decoder.encoder, f'prompt_layer_{layer_id}', proj_prompt)
-            else:
-                setattr(self.decoder.encoder, f'prompt_layer_{layer_id}', None)
-
         img = img.reshape(img.shape[0], -1, 512)
 
         assert len(text) == img.shape[0], \
@@ -257,7 +339,10 @@ class PromptModelWithConnection(nn.Module):
         text = self.tokenizer(text, return_tensors="pt", padding=True)
         input_ids = text['input_ids'].to(self.device)
         attention_mask = text['attention_mask'].to(self.device)
-        output = self.decoder(proj_encoder_feature=img, input_ids=input_ids, attention_mask=attention_mask)
+        # Forward prompt though connection
+        prefix_key_values = self.get_prefix_key_values(img)
+        output = self.decoder(proj_encoder_feature=img, input_ids=input_ids, attention_mask=attention_mask,
+                              prefix_key_values=prefix_key_values)
         logits = self.decoder_head(output.last_hidden_state)
 
         return {
@@ -265,16 +350,24 @@ class PromptModelWithConnection(nn.Module):
             'last_layer_logits': logits
         }
     
-    def forward_decoder(self, proj_encoder_feature, input_ids, attention_mask):
-        if True or self.args.connection:
-            for layer_id in self.encoder_prompt_dict:
-                if self.encoder_prompt_dict[layer_id] is not None:
-                    projector = getattr(self, f'prompt_projector_{layer_id}')
-                    proj_prompt = projector(getattr(self.encoder, f'prompt_layer_{layer_id}'))
-                    setattr(self.decoder.encoder, f'prompt_layer_{layer_id}', proj_prompt)
-                else:
-                    setattr(self.decoder.encoder, f'prompt_layer_{layer_id}', None)
+    def get_decoder_prompts(self):
+        # project the encoder prompts into decoder prompts; passed explicitly instead of being set on the decoder
+        prompts = [None] * len(self.decoder.encoder.layers)
+        for layer_id in self.encoder_prompt_dict:
+            if self.encoder_prompt_dict[layer_id] is not None:
+                projector = getattr(self, f'prompt_projector_{layer_id}')
+                prompts[layer_id] = projector(getattr(self.encoder, f'prompt_layer_{layer_id}'))
+        return prompts
+
+    def get_prefix_key_values(self, proj_encoder_feature):
+        return self.decoder.encoder.get_prefix_key_values(proj_encoder_feature, proj_encoder_feature.shape[0],
+                                                          prompts=self.get_decoder_prompts())
+
+    def forward_decoder(self, proj_encoder_feature, input_ids, attention_mask, prefix_key_values=None):
+        if prefix_key_values is None:
+            prefix_key_values = self.get_prefix_key_values(proj_encoder_feature)
         output = self.decoder(proj_encoder_feature=proj_encoder_feature,
                               input_ids=input_ids, 
-                              attention_mask=attention_mask)
+                              attention_mask=attention_mask,
+                              prefix_key_values=prefix_key_values)
         return output
\ No newline at end of file
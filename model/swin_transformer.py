@@ -97,6 +97,24 @@ def window_partition(x, window_size: int):
     return windows
 
 
+def window_partition_index(input_resolution, window_size: int, shift_size: int = 0):
+    """
+    Args:
+        input_resolution (tuple[int]): (H, W)
+        window_size (int): window size
+        shift_size (int): cyclic shift applied before partitioning
+
+    Returns:
+        index: (H*W,) such that x.view(B, H*W, C)[:, index] equals window_partition(torch.roll(x, -shift_size))
+            flattened to (B, num_windows*window_size*window_size, C)
+    """
+    H, W = input_resolution
+    rows = (torch.arange(H).view(H // window_size, window_size) + shift_size) % H    # nWh, window_size
+    cols = (torch.arange(W).view(W // window_size, window_size) + shift_size) % W    # nWw, window_size
+    index = rows[:, None, :, None] * W + cols[None, :, None, :]                       # nWh, nWw, window_size, window_size
+    return index.reshape(-1)
+
+
 @register_notrace_function  # reason: int argument is a Proxy
 def window_reverse(windows, window_size: int, H: int, W: int):
     """
@@ -162,6 +180,86 @@ class WindowAttention(nn.Module):
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
 
+        # attend to one shared copy of the prompts instead of concatenating them to every window
+        self.broadcast_prompt = False
+        # eval-time cache of relative position bias + shift mask, keyed by (prompt_len, dtype, device) and valid for
+        # one version of the bias table
+        self.frozen_tables = False
+        self.frozen_tables_cache = {}
+        self.frozen_tables_version = None
+
+    def train(self, mode=True):
+        # the bias table may be updated while training, rebuild the cached tables on the next eval pass
+        self.frozen_tables_cache = {}
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.frozen_tables_cache = {}
+        return super()._load_from_state_dict(*args, **kwargs)
+
+    @torch.no_grad()
+    def get_frozen_tables(self, mask, prompt_len, dtype, device):
+        """
+        Returns the additive attention bias (relative position bias + shift mask), padded with zero
+        columns for the prompts, of shape (num_windows or 1, num_heads, Wh*Ww, prompt_len + Wh*Ww).
+        """
+        # any in-place change of the table (optimizer step, load_state_dict, copy_) bumps its version
+        version = self.relative_position_bias_table._version
+        if version != self.frozen_tables_version:
+            self.frozen_tables_cache = {}
+            self.frozen_tables_version = version
+        key = (prompt_len, dtype, device)
+        if key not in self.frozen_tables_cache:
+            attn_bias = self.get_relative_position_bias().detach().unsqueeze(0)     # 1, nH, 49, 49
+            if mask is not None:
+                attn_bias = attn_bias + mask.unsqueeze(1)                     # nW, nH, 49, 49
+            attn_bias = nn.functional.pad(attn_bias, (prompt_len, 0))         # no bias/mask on the prompt columns
+            self.frozen_tables_cache[key] = attn_bias.to(dtype=dtype, device=device).contiguous()
+        return self.frozen_tables_cache[key]
+
+    def get_relative_position_bias(self):
+        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
+            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH    49 x 49 x 3
+        return relative_position_bias.permute(2, 0, 1).contiguous()                                    # nH, Wh*Ww, Wh*Ww  3 x 49 x 49
+
+    def forward_broadcast_prompt(self, q, k, v, mask, prompt_for_block):
+        """
+        Prompt attention without replicating the prompts over windows: window scores and scores against the
+        shared prompt K/V are computed separately and normalized together with a log-sum-exp merge.
+        Args:
+            q, k, v: (num_windows*B, num_heads, N, head_dim)
+            mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None
+        """
+        B_, _, N, head_dim = q.shape
+        if isinstance(prompt_for_block,nn.ParameterList):           # distinct prompts for K and V
+            pk, pv = prompt_for_block[0], prompt_for_block[1]
+        else:                                                       # unified prompt for K and V
+            pk, pv = prompt_for_block, prompt_for_block
+        pk = pk.reshape(self.num_heads, -1, head_dim)               # num_heads, prompt_len, head_dim (same split as the concat path)
+        pv = pv.reshape(self.num_heads, -1, head_dim)
+
+        q = q * self.scale
+        attn = q @ k.transpose(-2, -1)                                          # bs*num_win, num_heads, 49, 49
+        if self.frozen_tables and not self.training:
+            attn_bias = self.get_frozen_tables(mask, 0, attn.dtype, attn.device)
+            nW = attn_bias.shape[0]
+            attn = (attn.view(B_ // nW, nW, self.num_heads, N, N) + attn_bias).view(-1, self.num_heads, N, N)
+        else:
+            attn = attn + self.get_relative_position_bias().unsqueeze(0)
+            if mask is not None:
+                nW = mask.shape[0]
+                attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
+                attn = attn.view(-1, self.num_heads, N, N)
+        attn_prompt = torch.einsum('bhnd,hpd->bhnp', q, pk)                     # bs*num_win, num_heads, 49, prompt_len
+
+        # joint softmax over [prompt, window] keys
+        lse = torch.logaddexp(torch.logsumexp(attn, dim=-1, keepdim=True),
+                              torch.logsumexp(attn_prompt, dim=-1, keepdim=True))
+        attn = self.attn_drop(torch.exp(attn - lse))
+        attn_prompt = self.attn_drop(torch.exp(attn_prompt - lse))
+
+        return attn @ v + torch.einsum('bhnp,hpd->bhnd', attn_prompt, pv)      # bs*num_win, num_heads, 49, head_dim
+
     def forward(self, x, mask: Optional[torch.Tensor] = None, prompt_for_block = None, 
                 lora_for_block = None, lora_config = None):
         """
@@ -174,13 +272,20 @@ class WindowAttention(nn.Module):
 
         if lora_for_block is not None:
             scale = lora_config[1] / lora_for_block[0].shape[1]
-            lora_dropout = nn.Dropout(lora_config[0])
+            lora_dropout = lambda x: nn.functional.dropout(x, lora_config[0])   # functional: no module created per call
             delta = torch.matmul(lora_dropout(qkv),torch.matmul(lora_for_block[0] ,lora_for_block[1])*scale)
             qkv = torch.add(qkv,delta)
 
         qkv = qkv.reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv.unbind(0)
 
+        if prompt_for_block is not None and self.broadcast_prompt:
+            x = self.forward_broadcast_prompt(q, k, v, mask, prompt_for_block)
+            x = x.transpose(1, 2).reshape(B_, N, C)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x
+
         if prompt_for_block is not None:
             if isinstance(prompt_for_block,nn.ParameterList):           # distinct prompts for K and V
                 pk = prompt_for_block[0].expand(B_,-1,-1)               # bs*num_win, prompt_len, dim
@@ -197,28 +302,32 @@ class WindowAttention(nn.Module):
         attn = (q @ k.transpose(-2, -1))     # bs*num_window, num_head, 49, 49 + prompt_len
         prompt_len = attn.size(-1) - attn.size(-2)
 
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH    49 x 49 x 3
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()                  # nH, Wh*Ww, Wh*Ww  3 x 49 x 49
-
-        if prompt_for_block is not None:
-            attn[:,:,:,prompt_len:] = attn[:,:,:,prompt_len:] + relative_position_bias.unsqueeze(0)  # only add positional bias for window, not prompt => 64, 3, 49, 49 + prompt_len
+        if self.frozen_tables and not self.training:
+            attn_bias = self.get_frozen_tables(mask, prompt_len, attn.dtype, attn.device)             # nW (or 1), nH, 49, prompt_len + 49
+            nW = attn_bias.shape[0]
+            attn = attn.view(B_ // nW, nW, self.num_heads, N, -1) + attn_bias
+            attn = self.softmax(attn.view(-1, self.num_heads, N, prompt_len + N))
         else:
-            attn = attn + relative_position_bias.unsqueeze(0)                                     # 64, 3, 49, 49
+            relative_position_bias = self.get_relative_position_bias()                                     # nH, Wh*Ww, Wh*Ww  3 x 49 x 49
 
-        if mask is not None:
-            nW = mask.shape[0]                                                                    #  num_win, 49, 49 
-            # Do not add mask to prompt in attention matrix
             if prompt_for_block is not None:
-                temp = attn.view(B_ // nW, nW, self.num_heads, N, -1)[:,:,:,:,prompt_len:] + mask.unsqueeze(1).unsqueeze(0)   # slicing to only add mask for window, not for prompts
-                temp = temp.view(-1, self.num_heads, N, N)
-                attn[:,:,:,prompt_len:] = temp                                                                       
+                attn[:,:,:,prompt_len:] = attn[:,:,:,prompt_len:] + relative_position_bias.unsqueeze(0)  # only add positional bias for window, not prompt => 64, 3, 49, 49 + prompt_len
             else:
-                attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)   #  bs, num_win, num_head, 49, 49
-                attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
-        else:
-            attn = self.softmax(attn)
+                attn = attn + relative_position_bias.unsqueeze(0)                                     # 64, 3, 49, 49
+
+            if mask is not None:
+                nW = mask.shape[0]                                                                    #  num_win, 49, 49 
+                # Do not add mask to prompt in attention matrix
+                if prompt_for_block is not None:
+                    temp = attn.view(B_ // nW, nW, self.num_heads, N, -1)[:,:,:,:,prompt_len:] + mask.unsqueeze(1).unsqueeze(0)   # slicing to only add mask for window, not for prompts
+                    temp = temp.view(-1, self.num_heads, N, N)
+                    attn[:,:,:,prompt_len:] = temp                                                                       
+                else:
+                    attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)   #  bs, num_win, num_head, 49, 49
+                    attn = attn.view(-1, self.num_heads, N, N)
+                attn = self.softmax(attn)
+            else:
+                attn = self.softmax(attn)
 
         attn = self.attn_drop(attn)
 
@@ -297,6 +406,12 @@ class SwinTransformerBlock(nn.Module):
 
         self.register_buffer("attn_mask", attn_mask)
 
+        # shift + partition (and its inverse) as a single gather over the flattened token axis
+        self.fast_partition = False
+        partition_index = window_partition_index(self.input_resolution, self.window_size, self.shift_size)
+        self.register_buffer("partition_index", partition_index, persistent=False)
+        self.register_buffer("reverse_index", torch.argsort(partition_index), persistent=False)
+
     def forward(self, x, prompt_for_block=None, lora_for_block=None, lora_config=None):      # bs * 3136 * 96   (3136 = 224/4 * 224/4; 96 = C parameter of Swin-Tiny)
 
         H, W = self.input_resolution
@@ -305,17 +420,22 @@ class SwinTransformerBlock(nn.Module):
 
         shortcut = x
         x = self.norm1(x)      # bs * 3136 * 96
-        x = x.view(B, H, W, C) # bs * 56 * 56 * 96
 
-        # cyclic shift
-        if self.shift_size > 0:
-            shifted_x = torch.roll(x, shifts=(-self.shift_size, -self.shift_size), dims=(1, 2))
+        if self.fast_partition:
+            # cyclic shift + partition windows in one gather
+            x_windows = x.index_select(1, self.partition_index).view(-1, self.window_size * self.window_size, C)
         else:
-            shifted_x = x
+            x = x.view(B, H, W, C) # bs * 56 * 56 * 96
+
+            # cyclic shift
+            if self.shift_size > 0:
+                shifted_x = torch.roll(x, shifts=(-self.shift_size, -self.shift_size), dims=(1, 2))
+            else:
+                shifted_x = x
 
-        # partition windows
-        x_windows = window_partition(shifted_x, self.window_size)  # nW*B, window_size, window_size, C                   64*bs x 7 x 7 x 96     # 64 windows, 7x7 patches in each window, 4x4 pixels in each patch
-        x_windows = x_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C       64*bs x 49 x 96
+            # partition windows
+            x_windows = window_partition(shifted_x, self.window_size)  # nW*B, window_size, window_size, C                   64*bs x 7 x 7 x 96     # 64 windows, 7x7 patches in each window, 4x4 pixels in each patch
+            x_windows = x_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C       64*bs x 49 x 96
 
         # W-MSA/SW-MSA
         attn_windows = self.attn(x_windows, mask=self.attn_mask, 
@@ -323,16 +443,20 @@ class SwinTransformerBlock(nn.Module):
                                  lora_for_block = lora_for_block, # nW*B, window_size*window_size, C
                                  lora_config = lora_config)  
 
-        # merge windows
-        attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
-        shifted_x = window_reverse(attn_windows, self.window_size, H, W)  # B H' W' C
-
-        # reverse cyclic shift
-        if self.shift_size > 0:
-            x = torch.roll(shifted_x, shifts=(self.shift_size, self.shift_size), dims=(1, 2))
+        if self.fast_partition:
+            # merge windows + reverse cyclic shift in one gather
+            x = attn_windows.view(B, H * W, C).index_select(1, self.reverse_index)
         else:
-            x = shifted_x
-        x = x.view(B, H * W, C)
+            # merge windows
+            attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
+            shifted_x = window_reverse(attn_windows, self.window_size, H, W)  # B H' W' C
+
+            # reverse cyclic shift
+            if self.shift_size > 0:
+                x = torch.roll(shifted_x, shifts=(self.shift_size, self.shift_size), dims=(1, 2))
+            else:
+                x = shifted_x
+            x = x.view(B, H * W, C)
 
         # FFN
         x = shortcut + self.drop_path(x)
@@ -434,10 +558,14 @@ class BasicLayer(nn.Module):
         else:
             self.downsample = None
 
-    def forward(self, x, prompt_for_stage=None, lora_for_stage=None, lora_config = None):
+    def forward(self, x, prompt_for_stage=None, lora_for_stage=None, lora_config = None, start=0):
         for i, blk in enumerate(self.blocks):
-            if not torch.jit.is_scripting() and self.use_checkpoint:
-                x = checkpoint.checkpoint(blk, x)
+            if i < start:
+                continue                # already applied, x is the cached input of block `start`
+            if not torch.jit.is_scripting() and self.use_checkpoint and self.training:
+                # non-reentrant so that prompts/lora of the block still get gradients behind the frozen stem
+                x = checkpoint.checkpoint(blk, x, prompt_for_stage[i], lora_for_stage[i], lora_config,
+                                          use_reentrant=False)
             else:
                 x = blk(x, prompt_for_stage[i], lora_for_stage[i], lora_config)
         if self.downsample is not None:
@@ -539,6 +667,8 @@ class SwinTransformer(nn.Module):
                 _init_vit_weights(m, n, head_bias=head_bias, jax_impl=True)
         else:
             self.apply(_init_vit_weights)
+        self.layer_config = None    # resolved per-stage prompts/lora, see resolve_layer_config
+        self.start_block = 0        # > 0: cached tokens enter at this block, see set_start_block
 
     @torch.jit.ignore
     def no_weight_decay(self):
@@ -548,6 +678,80 @@ class SwinTransformer(nn.Module):
     def no_weight_decay_keywords(self):
         return {'relative_position_bias_table'}
 
+    @torch.jit.ignore
+    def set_grad_checkpointing(self, enable=True, stages=None):
+        """
+        Args:
+            enable (bool): Turn activation checkpointing on or off.
+            stages (list[int] | None): Stages to checkpoint, all stages if None.
+        """
+        for i, layer in enumerate(self.layers):
+            layer.use_checkpoint = enable and (stages is None or i in stages)
+
+    def set_prompt_attention(self, broadcast=True):
+        for layer in self.layers:
+            for blk in layer.blocks:
+                blk.attn.broadcast_prompt = broadcast
+
+    def set_frozen_tables(self, enable=True):
+        """
+        In eval mode, attention reuses a cached relative position bias + shift mask table per block
+        instead of gathering and masking it on every call.
+        """
+        for layer in self.layers:
+            for blk in layer.blocks:
+                blk.attn.frozen_tables = enable
+                blk.attn.frozen_tables_cache = {}
+
+    def set_fast_partition(self, enable=True):
+        for layer in self.layers:
+            for blk in layer.blocks:
+                blk.fast_partition = enable
+
+    def set_start_block(self, block=0):
+        """
+        With `block` > 0 a forward on tokens (B, L, C) takes them as the input of that (global) block, as computed by
+        `forward_prefix`, and only runs the remaining blocks. Images (B, 3, H, W) still run the whole encoder.
+        """
+        self.start_block = block
+
+    def get_block_position(self, block):
+        # global block index -> (stage, block index in the stage)
+        for stage, layer in enumerate(self.layers):
+            if block < len(layer.blocks):
+                return stage, block
+            block -= len(layer.blocks)
+        return len(self.layers), 0
+
+    @torch.no_grad()
+    def forward_prefix(self, x, end_block):
+        """Runs the patch embedding and the blocks before `end_block` without prompts or LoRA, (B, 3, H, W) -> (B, L, C)."""
+        x = self.patch_embed(x)
+        if self.absolute_pos_embed is not None:
+            x = x + self.absolute_pos_embed
+        x = self.pos_drop(x)
+        end_stage, end = self.get_block_position(end_block)
+        for i, layer in enumerate(self.layers[:end_stage+1]):
+            num_blocks = len(layer.blocks) if i < end_stage else end
+            for blk in layer.blocks[:num_blocks]:
+                x = blk(x, None, None, None)
+            if i < end_stage and layer.downsample is not None:
+                x = layer.downsample(x)
+        return x
+
+    def _build_layer_config(self):
+        layer_idx = [[0,1],[2,3],[4,5,6,7,8,9],[10,11]]
+        prompts = [[getattr(self, f'prompt_layer_{j}', None) for j in idx] for idx in layer_idx]
+        loras = [[getattr(self, f'lora_layer_{j}', None) for j in idx] for idx in layer_idx]
+        return prompts, loras
+
+    def resolve_layer_config(self, enable=True):
+        """
+        Looks up the prompt and LoRA weights of every block once instead of in each forward (stable graphs under
+        torch.compile). Call it again after replacing prompts or LoRA weights.
+        """
+        self.layer_config = self._build_layer_config() if enable else None
+
     def get_classifier(self):
         return self.head
 
@@ -556,22 +760,28 @@ class SwinTransformer(nn.Module):
         self.head = nn.Linear(self.num_features, num_classes) if num_classes > 0 else nn.Identity()
 
     def forward_features(self, x, use_prompt, use_lora, lora_config):
-        x = self.patch_embed(x)         # H/4 * W/4 * C   (Swin-T: C=96)
-        if self.absolute_pos_embed is not None:
-            x = x + self.absolute_pos_embed
-        x = self.pos_drop(x)            # Dropout(p=0.0)     
+        # images (B, 3, H, W) always take the full path, only cached tokens (B, L, C) start at `start_block`
+        start_block = self.start_block if x.dim() == 3 else 0
+        start_stage, start = self.get_block_position(start_block)
+        if start_block == 0:
+            x = self.patch_embed(x)         # H/4 * W/4 * C   (Swin-T: C=96)
+            if self.absolute_pos_embed is not None:
+                x = x + self.absolute_pos_embed
+            x = self.pos_drop(x)            # Dropout(p=0.0)     
         # x = self.layers(x)              # H/32 * W/32 * 8C
-        layer_idx = [[0,1],[2,3],[4,5,6,7,8,9],[10,11]]
+        stage_prompts, stage_loras = self.layer_config if self.layer_config is not None else self._build_layer_config()
         for i, layer in enumerate(self.layers):
-            if use_prompt and hasattr(self, 'prompt_layer_0'):
-                prompt_for_stage = [getattr(self, f'prompt_layer_{j}') for j in layer_idx[i]]
+            if i < start_stage:
+                continue
+            if use_prompt:
+                prompt_for_stage = stage_prompts[i]
             else:
-                prompt_for_stage = [None]*len(layer_idx[i])
-            if use_lora and hasattr(self, 'lora_layer_0'):
-                lora_for_stage = [getattr(self, f'lora_layer_{j}') for j in layer_idx[i]]
+                prompt_for_stage = [None]*len(stage_prompts[i])
+            if use_lora:
+                lora_for_stage = stage_loras[i]
             else:
-                lora_for_stage = [None]*len(layer_idx[i])
-            x = layer(x, prompt_for_stage, lora_for_stage, lora_config)
+                lora_for_stage = [None]*len(stage_loras[i])
+            x = layer(x, prompt_for_stage, lora_for_stage, lora_config, start=start if i == start_stage else 0)
         x = self.norm(x)  # B L C
         x = self.avgpool(x.transpose(1, 2))  # B C 1
         x = torch.flatten(x, 1)         # 8C
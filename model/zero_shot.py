@@ -0,0 +1,76 @@
+import os
+import torch
+import torch.nn as nn
+from transformers import AutoProcessor
+from .clip import CLIPModel
+from datasets.dataset import get_caption
+
+
+class ZeroShotClassifier(nn.Module):
+    """
+    CLIP-style classification with the PLIP towers: the candidate captions of a dataset (`get_caption`) are encoded
+    once by the text tower, and a batch is classified by one vision-tower pass and a product with the normalized
+    caption embeddings, without any decoding.
+
+    The towers run without prompts and LoRA. They are taken from a `PromptModel` with e_plip/d_plip when given, and
+    loaded from `args.decoder_ckpt_path` otherwise; the projections and logit scale always come from the checkpoint.
+    """
+    def __init__(self, args, vision_model=None, text_model=None, tokenizer=None, cache_dir=None) -> None:
+        super().__init__()
+        self.args = args
+        clip = CLIPModel.from_pretrained(args.decoder_ckpt_path)
+        self.vision_model = vision_model if vision_model is not None else clip.vision_model
+        self.text_model = text_model if text_model is not None else clip.text_model
+        self.visual_projection = clip.visual_projection
+        self.text_projection = clip.text_projection
+        self.logit_scale = clip.logit_scale
+        self.tokenizer = tokenizer if tokenizer is not None else AutoProcessor.from_pretrained(args.tokenizer_type)
+
+        # ImageDataset yields BGR pixels in [0, 255] for e_plip, PLIP was trained on CLIP-normalized RGB
+        image_processor = getattr(self.tokenizer, 'image_processor', None)
+        mean = getattr(image_processor, 'image_mean', [0.48145466, 0.4578275, 0.40821073])
+        std = getattr(image_processor, 'image_std', [0.26862954, 0.26130258, 0.27577711])
+        self.register_buffer('pixel_mean', torch.tensor(mean).view(1, 3, 1, 1) * 255, persistent=False)
+        self.register_buffer('pixel_std', torch.tensor(std).view(1, 3, 1, 1) * 255, persistent=False)
+
+        self.cache_dir = cache_dir
+        self.text_embeddings = {}       # dataset -> normalized caption embeddings (num_classes, projection_dim)
+
+    @torch.no_grad()
+    def get_text_embeddings(self, dataset):
+        if dataset in self.text_embeddings:
+            return self.text_embeddings[dataset]
+        cache_path = None if self.cache_dir is None else os.path.join(self.cache_dir, f'{dataset}-plip-text.pt')
+        device = self.logit_scale.device
+        if cache_path is not None and os.path.exists(cache_path):
+            text_embeds = torch.load(cache_path, map_location=device)
+        else:
+            token = self.tokenizer(get_caption(dataset), return_tensors="pt", padding=True)
+            text_embeds = self.text_model(input_ids=token['input_ids'].to(device),
+                                          attention_mask=token['attention_mask'].to(device),
+                                          proj_encoder_feature=None,
+                                          use_prompt=False,
+                                          use_lora=False,
+                                          lora_config=None).pooler_output
+            text_embeds = nn.functional.normalize(self.text_projection(text_embeds), dim=-1)
+            if cache_path is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                torch.save(text_embeds.cpu(), cache_path)
+        self.text_embeddings[dataset] = text_embeds
+        return text_embeds
+
+    @torch.no_grad()
+    def forward(self, img, dataset):
+        """
+        Returns:
+            (bs, num_classes) logits over the captions of `get_caption(dataset)`, in the same order.
+        """
+        pixel_values = (img.flip(1) - self.pixel_mean) / self.pixel_std       # BGR -> RGB, normalize
+        image_embeds = self.vision_model(pixel_values, use_prompt=False, use_lora=False)[1]
+        image_embeds = nn.functional.normalize(self.visual_projection(image_embeds), dim=-1)
+        return self.logit_scale.exp() * image_embeds @ self.get_text_embeddings(dataset).t()
+
+    def predict(self, img, dataset, type='caption'):
+        # argmax caption, or its class index with type='class_index'
+        labels = get_caption(dataset, type)
+        return [labels[i] for i in self.forward(img, dataset).argmax(-1).tolist()]
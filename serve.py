@@ -0,0 +1,309 @@
+import argparse
+import asyncio
+import glob
+import json
+import os
+import time
+os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import torch
+from model.model_with_prompt import PromptModel
+from model.single_encoder import SingleEncoder
+from datasets import ImageDataset
+from datasets.dataset import get_caption, get_hard_prompt
+from utils import encode_image, decode_captions, score_captions, get_num_class, GraphDecoder, load_training_args
+from utils.cpu_inference import quantize_int8, set_cpu_threads
+
+
+class Predictor():
+    """Runs one micro-batch: encoder + projector once, then greedy decoding and caption scoring (or the classifier head)."""
+    def __init__(self, model, args) -> None:
+        self.model = model
+        self.args = args
+        self.hard_text_prompt = get_hard_prompt(args.dataset)
+        try:
+            self.captions = get_caption(args.dataset)
+            self.class_ids = get_caption(args.dataset, 'class_index')
+        except ValueError:
+            self.captions, self.class_ids = None, None    # open-vocabulary dataset, captions are returned without class id
+        self.graph_decoder = None
+        if getattr(args, 'graph_decode', False) and args.type != 'single_encoder':
+            self.graph_decoder = GraphDecoder(model, args, buckets=(1, 2, 4, 8, 16, 32, args.max_batch_size))
+
+    @torch.no_grad()
+    def __call__(self, img_tensor):
+        img_tensor = img_tensor.to(self.args.device, dtype=torch.float32)
+        if self.args.type == 'single_encoder':
+            scores = self.model(img_tensor).softmax(-1).cpu()
+            class_ids = torch.argmax(scores, dim=1).tolist()
+            gen_cap = [None if self.captions is None else self.captions[self.class_ids.index(c)] for c in class_ids]
+            scores = scores.tolist()
+        else:
+            img_feature = encode_image(self.model, img_tensor, self.args)
+            gen_cap = decode_captions(self.model, img_feature, [self.hard_text_prompt]*img_tensor.shape[0],
+                                      self.args, self.graph_decoder)
+            if self.captions is None:
+                return [{'caption': c} for c in gen_cap]
+            scores = score_captions(self.model, img_feature, self.captions, self.hard_text_prompt, self.args).cpu()
+            # the decoded caption decides the class, the caption likelihoods break the tie for unknown captions
+            class_ids = [self.class_ids[self.captions.index(c)] if c in self.captions else self.class_ids[int(s.argmax())]
+                         for c, s in zip(gen_cap, scores)]
+            scores = [dict(zip(map(str, self.class_ids), s.tolist())) for s in scores]
+        return [{'caption': c, 'class_id': i, 'scores': s} for c, i, s in zip(gen_cap, class_ids, scores)]
+
+
+class MicroBatcher():
+    """
+    Collects queued requests into batches of at most `max_batch_size`. A batch is closed when it is full or when
+    `max_latency_ms` have passed since its first request, and runs in a single worker thread so that the event loop
+    keeps accepting requests meanwhile.
+    """
+    def __init__(self, run_batch, max_batch_size=32, max_latency_ms=20) -> None:
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue_depth_hist = Counter()       # queue depth seen by each incoming request
+        self.batch_size_hist = Counter()
+        self.num_requests, self.busy_time = 0, 0.0
+
+    async def submit(self, img_tensor):
+        future = asyncio.get_running_loop().create_future()
+        self.queue_depth_hist[self.queue.qsize()] += 1
+        self.num_requests += 1
+        await self.queue.put((img_tensor, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_size_hist[len(batch)] += 1
+
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, torch.stack([b[0] for b in batch]))
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            self.busy_time += time.perf_counter() - start
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'requests': self.num_requests,
+            'batches': sum(self.batch_size_hist.values()),
+            'busy_time_s': self.busy_time,
+            'queue_depth_hist': {str(k): v for k, v in sorted(self.queue_depth_hist.items())},
+            'batch_size_hist': {str(k): v for k, v in sorted(self.batch_size_hist.items())},
+        }
+
+
+class BadRequest(ValueError):
+    pass
+
+
+async def read_http_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, value = line.decode('latin-1').split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        content_length = int(headers.get('content-length', 0))
+        if content_length < 0:
+            raise ValueError(content_length)
+    except ValueError as e:
+        raise BadRequest(f'malformed request: {e}')
+    body = await reader.readexactly(content_length)
+    return method, path, headers, body
+
+
+def http_response(status, payload):
+    body = json.dumps(payload).encode()
+    head = f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'
+    return head.encode() + body
+
+
+def make_handler(batcher, preprocessor):
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_http_request(reader)
+                except BadRequest as e:
+                    # the rest of the stream cannot be framed, answer and close the connection
+                    writer.write(http_response('400 Bad Request', {'error': str(e)}))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if method == 'GET' and path == '/stats':
+                    response = http_response('200 OK', batcher.stats())
+                elif method == 'POST' and path == '/predict':
+                    # raw encoded image bytes (png/jpg), decoded like cv2.imread in ImageDataset
+                    image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+                    if image is None:
+                        response = http_response('400 Bad Request', {'error': 'cannot decode image'})
+                    else:
+                        try:
+                            result = await batcher.submit(preprocessor.preprocess(image))
+                            response = http_response('200 OK', result)
+                        except Exception as e:
+                            response = http_response('500 Internal Server Error', {'error': repr(e)})
+                else:
+                    response = http_response('404 Not Found', {'error': f'{method} {path}'})
+                writer.write(response)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+async def serve(args, predictor, preprocessor):
+    batcher = MicroBatcher(predictor, args.max_batch_size, args.max_latency_ms)
+    handler = make_handler(batcher, preprocessor)
+    if args.unix_socket:
+        server = await asyncio.start_unix_server(handler, path=args.unix_socket)
+        print(f'>>> Serving on unix://{args.unix_socket}')
+    else:
+        server = await asyncio.start_server(handler, args.host, args.port)
+        print(f'>>> Serving on http://{args.host}:{args.port}')
+    batch_task = asyncio.create_task(batcher.run())
+    async with server:
+        await server.serve_forever()
+    batch_task.cancel()
+
+
+async def client(args):
+    """Sends the images of `--images` concurrently to a running server and reports latency and the server stats."""
+    image_paths = sorted(glob.glob(args.images))[:args.num_requests]
+    assert len(image_paths) > 0, f'no image matches {args.images}'
+
+    async def open_connection():
+        if args.unix_socket:
+            return await asyncio.open_unix_connection(args.unix_socket)
+        return await asyncio.open_connection(args.host, args.port)
+
+    async def request(method, path, body=b''):
+        reader, writer = await open_connection()
+        writer.write(f'{method} {path} HTTP/1.1\r\nHost: {args.host}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+        status = (await reader.readline()).decode().strip()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, value = line.decode().split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        payload = json.loads(await reader.readexactly(int(headers['content-length'])))
+        writer.close()
+        return status, payload
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    async def predict(path):
+        with open(path, 'rb') as file:
+            body = file.read()
+        async with semaphore:
+            start = time.perf_counter()
+            status, payload = await request('POST', '/predict', body)
+            latencies.append((time.perf_counter() - start) * 1000)
+        print(f'{os.path.basename(path)}: {status} {payload}')
+
+    start = time.perf_counter()
+    await asyncio.gather(*[predict(path) for path in image_paths])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies)
+    print(f'>>> {len(latencies)} requests in {elapsed:.2f}s ({len(latencies)/elapsed:.1f} req/s), '
+          f'latency p50 {np.percentile(latencies, 50):.1f}ms, p95 {np.percentile(latencies, 95):.1f}ms')
+    print(f'>>> Server stats: {(await request("GET", "/stats"))[1]}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    # Server configuration
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix_socket', type=str, default=None)          # serve on a unix socket instead of tcp
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_latency_ms', type=float, default=20)       # a batch waits at most this long for more requests
+
+    # Model configuration
+    parser.add_argument('--dataset', type=str, default='prostate-1')      # decides the hard prompt and the class captions
+    parser.add_argument('--device', type=int, default=0)                  # -1 for CPU
+    parser.add_argument('--quantize', action='store_true')                 # int8 dynamic quantization (CPU)
+    parser.add_argument('--num_threads', type=int, default=0)              # intra-op CPU threads, 0 keeps the torch default
+    parser.add_argument('--generate_length', type=int, default=12)
+    parser.add_argument('--graph_decode', action='store_true')             # static kv cache + CUDA-graph decode steps (gpt2)
+    parser.add_argument('--model_pth', type=str, default=None)
+
+    # Client mode
+    parser.add_argument('--client', action='store_true')                   # send requests to a running server
+    parser.add_argument('--images', type=str, default='*.png')             # glob of images to send
+    parser.add_argument('--num_requests', type=int, default=256)
+    parser.add_argument('--concurrency', type=int, default=64)
+
+    overwrite_args = parser.parse_args()
+    if overwrite_args.client:
+        asyncio.run(client(overwrite_args))
+        return
+
+    args = load_training_args(overwrite_args.model_pth)
+    args.dataset = overwrite_args.dataset
+    args.generate_length = overwrite_args.generate_length
+    args.compile = False
+    args.graph_decode = overwrite_args.graph_decode
+    args.max_batch_size = overwrite_args.max_batch_size
+    if overwrite_args.device < 0 or overwrite_args.quantize:
+        args.device = torch.device('cpu')
+        print(f'>>> CPU threads (intra-op, inter-op): {set_cpu_threads(overwrite_args.num_threads)}')
+    else:
+        args.device = torch.device(f'cuda:{overwrite_args.device}')
+
+    if args.type == 'single_encoder':
+        model = SingleEncoder(args, get_num_class(args.dataset))
+    else:
+        model = PromptModel(args)
+    td = torch.load(args.model_pth, map_location=args.device)
+    model.load_state_dict(td['model_state_dict'], strict=True)
+    model = model.to(args.device).eval()
+    if overwrite_args.quantize:
+        model = quantize_int8(model)
+
+    preprocessor = ImageDataset([], args, train=False)
+    asyncio.run(serve(overwrite_args, Predictor(model, args), preprocessor))
+
+if __name__ == '__main__':
+    main()
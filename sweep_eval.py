@@ -0,0 +1,132 @@
+import argparse
+import csv
+import os
+os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+import torch
+from tqdm import tqdm
+from model.model_with_prompt import PromptModel
+from datasets import ImageDataset, prepare_data
+from utils import encode_features, project_features, decode_captions, calculate_metrics, GraphDecoder, \
+                  load_training_args, make_dataloader
+
+
+class CheckpointBank():
+    """
+    The trainable tensors (prompts, LoRA, projector, heads) of several checkpoints of the same architecture. The frozen
+    encoder/decoder are loaded once with the model, and `swap` copies one checkpoint's tensors into it in place, so
+    parameter addresses (and captured CUDA graphs) stay valid.
+    """
+    def __init__(self, model, model_pths, device, max_gb=4.0) -> None:
+        self.params = {name: param for name, param in model.named_parameters() if param.requires_grad}
+        size = sum(p.numel() * p.element_size() for p in self.params.values()) * len(model_pths)
+        # kept on the device when they fit, in pinned memory otherwise (full fine-tuning)
+        self.device = device if size <= max_gb * 1024**3 else torch.device('cpu')
+        self.model_pths = model_pths
+        self.states = [self._load(model_pth) for model_pth in model_pths]
+        # the encoder feature only has to be recomputed per checkpoint if the encoder itself is adapted
+        self.encoder_adapted = any(name.startswith(('encoder.', 'encoder_prompt.', 'encoder_lora.')) for name in self.params)
+
+    def _load(self, model_pth):
+        state_dict = torch.load(model_pth, map_location='cpu')['model_state_dict']
+        state = {}
+        for name, param in self.params.items():
+            if name not in state_dict or state_dict[name].shape != param.shape:
+                raise ValueError(f'{model_pth} does not match the architecture of {self.model_pths[0]} ({name})')
+            tensor = state_dict[name]
+            state[name] = tensor.to(self.device) if self.device.type != 'cpu' else \
+                          (tensor.pin_memory() if torch.cuda.is_available() else tensor)
+        return state
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    @torch.no_grad()
+    def swap(self, index):
+        for name, tensor in self.states[index].items():
+            self.params[name].copy_(tensor, non_blocking=True)
+
+
+def sweep(args, dataloader, model, bank, graph_decoder=None):
+    """
+    Evaluates every checkpoint of `bank` on each batch as it is decoded: the images are read and moved to the device
+    once, and the encoder runs once per batch when it is unadapted. With an adapted swin encoder only the frozen leading
+    blocks (`forward_prefix`) are shared, and each checkpoint runs the remaining blocks.
+
+    Returns:
+        ground truth captions and the predictions of every checkpoint
+    """
+    ground_truth_list, prediction_lists = [], [[] for _ in range(len(bank))]
+    start_block = model.get_first_adapted_block() if bank.encoder_adapted else 0
+    if start_block > 0:
+        model.encoder.set_start_block(start_block)
+    with torch.no_grad():
+        for img_path, img_tensor, hard_text_prompt, label in tqdm(dataloader):
+            img_tensor = img_tensor.to(args.device, dtype=torch.float32)
+            if not bank.encoder_adapted:
+                feature = encode_features(model, img_tensor, args)
+            elif start_block > 0:
+                img_tensor = model.encoder.forward_prefix(img_tensor, start_block)
+            for i in range(len(bank)):
+                bank.swap(i)
+                if bank.encoder_adapted:
+                    feature = encode_features(model, img_tensor, args)
+                img = project_features(model, feature, args)
+                prediction_lists[i] += decode_captions(model, img, hard_text_prompt, args, graph_decoder)
+            ground_truth_list += label
+    if start_block > 0:
+        model.encoder.set_start_block(0)
+    return ground_truth_list, prediction_lists
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_pths', type=str, nargs='+', required=True)    # checkpoints of one run, e.g. <prefix>-*.pt
+    parser.add_argument('--dataset', type=str, default=None)                 # defaults to the training dataset
+    parser.add_argument('--split', type=int, default=2)                      # 1 for the valid split, 2 for test
+    parser.add_argument('--bs', type=int, default=256)
+    parser.add_argument('--device', type=int, default=0)                     # -1 for CPU
+    parser.add_argument('--generate_length', type=int, default=12)
+    parser.add_argument('--graph_decode', action='store_true')               # static kv cache + CUDA-graph decode steps (gpt2)
+    parser.add_argument('--max_ckpt_gb', type=float, default=4.0)            # device memory for the swapped tensors
+    parser.add_argument('--out_dir', default='/data4/anhnguyen/experiments/prompt_work/testing/')
+    overwrite_args = parser.parse_args()
+
+    # <prefix>-<epoch>.pt, sorted by epoch
+    model_pths = sorted(overwrite_args.model_pths, key=lambda p: (p.rsplit('-', 1)[0], int(p.rsplit('-', 1)[1].split('.')[0])))
+    args = load_training_args(model_pths[0])
+    if args.type == 'single_encoder':
+        raise ValueError('sweep_eval.py evaluates captioning checkpoints, use test.py for single_encoder runs')
+    args.dataset = overwrite_args.dataset or args.dataset
+    args.bs, args.generate_length, args.compile = overwrite_args.bs, overwrite_args.generate_length, False
+    args.device = torch.device(f'cuda:{overwrite_args.device}') if overwrite_args.device >= 0 else torch.device('cpu')
+
+    # frozen base (and any saved buffers) from the first checkpoint, then only the trainable tensors of each
+    model = PromptModel(args)
+    model.load_state_dict(torch.load(model_pths[0], map_location='cpu')['model_state_dict'], strict=True)
+    model = model.to(args.device).eval()
+    bank = CheckpointBank(model, model_pths, args.device, overwrite_args.max_ckpt_gb)
+    print(f'>>> {len(bank)} checkpoints, encoder {"adapted" if bank.encoder_adapted else "shared"}, tensors on {bank.device}')
+
+    data = prepare_data(args)
+    pair_list = data[overwrite_args.split] if isinstance(data, tuple) else data
+    dataloader = make_dataloader(args, ImageDataset(pair_list, args, train=False), shuffle=False, drop_last=False, persistent=False)
+    graph_decoder = GraphDecoder(model, args, buckets=(8, 16, 32, args.bs)) if overwrite_args.graph_decode else None
+
+    ground_truth_list, prediction_lists = sweep(args, dataloader, model, bank, graph_decoder)
+    rows = []
+    for model_pth, prediction_list in zip(model_pths, prediction_lists):
+        metrics = calculate_metrics(args.dataset, ground_truth_list, prediction_list)
+        print(model_pth, metrics)
+        rows.append({'model_pth': model_pth, **metrics})
+
+    os.makedirs(overwrite_args.out_dir, exist_ok=True)
+    out_path = os.path.join(overwrite_args.out_dir, f'{os.path.basename(model_pths[0]).rsplit("-", 1)[0]}-{args.dataset}-sweep.csv')
+    with open(out_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f'>>> Metrics table: {out_path}')
+
+if __name__ == '__main__':
+    main()
@@ -1,53 +1,98 @@
 import argparse
-from argparse import Namespace
 import os 
 os.environ['TOKENIZERS_PARALLELISM'] = 'false'
 
 import torch
-import json
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 from model.model_with_prompt import PromptModel
 from model.single_encoder import SingleEncoder
-from datasets import ImageDataset, prepare_data
-from utils import generate, calculate_metrics, save_config_and_metric, get_num_class
+from model.zero_shot import ZeroShotClassifier
+from datasets import ImageDataset, ShardDataset, prepare_data
+from utils import generate, calculate_metrics, save_config_and_metric, get_num_class, GraphDecoder, load_training_args, \
+                  pipelined_generate, make_dataloader
+from utils.cpu_inference import quantize_int8, set_cpu_threads, LatencyMeter
+
+
+def predict(args, test_dataloader, model, meter=None):
+    ground_truth_list = []
+    prediction_list = []
+    graph_decoder = None
+    if getattr(args, 'graph_decode', False) and args.type != 'single_encoder' and not getattr(args, 'zero_shot', False):
+        graph_decoder = GraphDecoder(model, args, buckets=(8, 16, 32, args.bs))
+
+    with torch.no_grad():
+        progress = tqdm(total=len(test_dataloader))
+        if getattr(args, 'pipeline_eval', False) and args.type != 'single_encoder' and not getattr(args, 'zero_shot', False):
+            # the encoder runs ahead in a worker thread, so the meter records the time between finished batches
+            if meter is not None:
+                meter.start()
+            for gen_cap, label in pipelined_generate(model, test_dataloader, args, graph_decoder=graph_decoder):
+                ground_truth_list += label
+                prediction_list += gen_cap
+                if meter is not None:
+                    meter.stop(len(gen_cap))
+                    meter.start()
+                progress.update()
+        else:
+            for idx, (img_path, img_tensor, hard_text_prompt, label) in enumerate(test_dataloader):
+                img_tensor = img_tensor.to(args.device, dtype=torch.float32)  # bs x 3 x 512 x 512               
+                if meter is not None:
+                    meter.start()
+                if getattr(args, 'zero_shot', False):
+                    gen_cap = model.predict(img_tensor, args.dataset)       # nearest caption embedding, no decoding
+                    ground_truth_list += label
+                    prediction_list += gen_cap
+                elif args.type != 'single_encoder':                    
+                    gen_cap = generate(model, img_tensor, hard_text_prompt, args, graph_decoder=graph_decoder)
+                    ground_truth_list += label
+                    prediction_list += gen_cap
+                else:
+                    outputs = model(img_tensor)
+                    ground_truth_list += list(label)
+                    prediction_list += torch.argmax(outputs, dim=1).tolist()
+                if meter is not None:
+                    meter.stop(img_tensor.shape[0])
+                progress.update()
+        progress.close()
+    assert len(ground_truth_list) == len(prediction_list)
+    return ground_truth_list, prediction_list
 
 
 def test(args, test_dataset, model):
     #print(args)
     batch_size = args.bs
     device = args.device
+    if getattr(args, 'zero_shot', False):
+        # PLIP towers of the model, caption embeddings cached per dataset in out_dir
+        model = ZeroShotClassifier(args, model.encoder, model.decoder, model.tokenizer, cache_dir=args.out_dir)
     model = model.to(device)
     
     model.eval()
-    test_dataloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, drop_last=False, num_workers=40)
+    test_dataloader = make_dataloader(args, test_dataset, shuffle=False, drop_last=False, persistent=False, num_workers=40)   # single pass
+    fp32_model = model
+    if getattr(args, 'quantize', False):
+        model = quantize_int8(model)    # int8 dynamic quantization of the linear layers, CPU only
 
     # TESTING LOOP 
-    ground_truth_list = []
-    prediction_list = []
-
-    with torch.no_grad():
-        print(f">>> Testing")
-        progress = tqdm(total=len(test_dataloader))
-        for idx, (img_path, img_tensor, hard_text_prompt, label) in enumerate(test_dataloader):
-            img_tensor = img_tensor.to(device, dtype=torch.float32)  # bs x 3 x 512 x 512               
-            if args.type != 'single_encoder':                    
-                gen_cap = generate(model, img_tensor, hard_text_prompt, args)
-                ground_truth_list += label
-                prediction_list += gen_cap
-            else:
-                outputs = model(img_tensor)
-                ground_truth_list += list(label)
-                prediction_list += torch.argmax(outputs, dim=1).tolist()
-            progress.update()
-        progress.close()
+    print(f">>> Testing")
+    meter = LatencyMeter(device)
+    ground_truth_list, prediction_list = predict(args, test_dataloader, model, meter)
+    metrics = calculate_metrics(args.dataset, ground_truth_list, prediction_list)
     
-        assert len(ground_truth_list) == len(prediction_list)
-        metrics = calculate_metrics(args.dataset, ground_truth_list, prediction_list)
-        
-        print(args.model_pth)
-        print(metrics)
-        save_config_and_metric(args, metrics, best_epoch=None, run_type='test')
+    print(args.model_pth)
+    print(metrics)
+    print(f'>>> Latency on {device} ({torch.get_num_threads()} threads, bs {batch_size}): {meter.report()}')
+
+    if getattr(args, 'quantize', False) and getattr(args, 'compare_fp32', False):
+        print(f">>> Testing fp32 reference")
+        fp32_ground_truth, fp32_prediction_list = predict(args, test_dataloader, fp32_model)
+        fp32_metrics = calculate_metrics(args.dataset, fp32_ground_truth, fp32_prediction_list)
+        agreement = sum(p == q for p, q in zip(prediction_list, fp32_prediction_list)) / len(prediction_list)
+        print(f'fp32: {fp32_metrics}')
+        print(f'int8 - fp32: { {k: metrics[k] - fp32_metrics[k] for k in metrics} }, prediction agreement: {agreement:.4f}')
+
+    run_type = 'test-zero-shot' if getattr(args, 'zero_shot', False) else 'test'
+    save_config_and_metric(args, metrics, best_epoch=None, run_type=run_type + '-int8' if getattr(args, 'quantize', False) else run_type)
     return model
 
 
@@ -64,8 +109,18 @@ def main():
 
     # Testing configuaration
     parser.add_argument('--bs', type=int, default=256)
-    parser.add_argument('--device', type=int, default=0)
+    parser.add_argument('--device', type=int, default=0)                  # -1 for CPU
+    parser.add_argument('--quantize', action='store_true')                 # int8 dynamic quantization (CPU)
+    parser.add_argument('--compare_fp32', action='store_true')             # also run the fp32 model and report the metric gap
+    parser.add_argument('--num_threads', type=int, default=0)              # intra-op CPU threads, 0 keeps the torch default
     parser.add_argument('--generate_length', type=int, default=12)
+    parser.add_argument('--encoder_frozen_tables', action='store_true')    # cache swin bias + shift mask tables
+    parser.add_argument('--reduced_decode', action='store_true')           # decode large patches at 1/2, 1/4 or 1/8 scale
+    parser.add_argument('--shard_dir', type=str, default=None)             # read the test split from tar shards instead of files
+    parser.add_argument('--image_cache_gb', type=float, default=0)         # shared-memory cache of resized images, 0 disables
+    parser.add_argument('--graph_decode', action='store_true')             # static kv cache + CUDA-graph decode steps (gpt2)
+    parser.add_argument('--pipeline_eval', action='store_true')            # overlap the encoder of batch n+1 with the decoding of batch n
+    parser.add_argument('--zero_shot', action='store_true')                # e_plip/d_plip: classify by caption embedding similarity
     parser.add_argument('--model_pth', type=str, default='/data4/anhnguyen/experiments/prompt_work/single_encoder/kidney-AdamW-cosine-resnet50--474/kidney-AdamW-cosine-resnet50--474-5.pt')
     
     # Saving configuration
@@ -73,14 +128,7 @@ def main():
 
     overwrite_args = parser.parse_args()
 
-    last_ext = '-' + overwrite_args.model_pth.split('-')[-1]
-    training_config_file = overwrite_args.model_pth.replace(last_ext, '.json')
-    with open(training_config_file) as file:
-        args = json.load(file)
-        args['model_pth'] = None
-        args = Namespace(**args)
-    
-    file.close()
+    args = load_training_args(overwrite_args.model_pth)
 
     args.dataset = overwrite_args.dataset
     # args.device = overwrite_args.device
@@ -88,15 +136,28 @@ def main():
     args.generate_length = overwrite_args.generate_length
     args.model_pth = overwrite_args.model_pth
     args.out_dir = overwrite_args.out_dir
-    args.device = torch.device(f'cuda:{args.device}')
-    if 'type' not in args:
-        args.type = args.prompt_type
-    
-    data = prepare_data(args)
-    if isinstance(data,tuple):
-        test_set = data[2]
+    args.encoder_frozen_tables = overwrite_args.encoder_frozen_tables or getattr(args, 'encoder_frozen_tables', False)
+    args.compile = False    # compile mode targets fixed-length teacher forcing, generation runs eagerly
+    args.graph_decode = overwrite_args.graph_decode
+    args.pipeline_eval = overwrite_args.pipeline_eval
+    args.reduced_decode = overwrite_args.reduced_decode
+    args.zero_shot = overwrite_args.zero_shot
+    if args.zero_shot and (args.encoder_type != 'e_plip' or args.decoder_type != 'd_plip'):
+        raise ValueError('--zero_shot needs encoder_type e_plip and decoder_type d_plip')
+    args.quantize = overwrite_args.quantize
+    args.compare_fp32 = overwrite_args.compare_fp32
+    if overwrite_args.device < 0 or args.quantize:
+        args.device = torch.device('cpu')
+        print(f'>>> CPU threads (intra-op, inter-op): {set_cpu_threads(overwrite_args.num_threads)}')
     else:
-        test_set = data
+        args.device = torch.device(f'cuda:{overwrite_args.device}')
+    
+    if overwrite_args.shard_dir is None:
+        data = prepare_data(args)
+        if isinstance(data,tuple):
+            test_set = data[2]
+        else:
+            test_set = data
     
     if args.type == 'single_encoder':
         model = SingleEncoder(args, get_num_class(args.dataset))
@@ -108,7 +169,12 @@ def main():
         model.load_state_dict(td['model_state_dict'], strict=True)
 
     print(args.model_pth)
-    test_dataset = ImageDataset(test_set, args, train=False)
+    if overwrite_args.shard_dir is not None:
+        test_dataset = ShardDataset(overwrite_args.shard_dir, 'test', args, train=False)
+    else:
+        test_dataset = ImageDataset(test_set, args, train=False)
+        if overwrite_args.image_cache_gb > 0:
+            test_dataset.enable_cache(overwrite_args.image_cache_gb)   # reused by the --compare_fp32 pass
     test(args, test_dataset, model)
 
 if __name__ == '__main__':
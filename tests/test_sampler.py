@@ -0,0 +1,84 @@
+import random
+
+import pytest
+from datasets.dataset import get_caption, get_hard_prompt
+from datasets.sampler import LengthBucketBatchSampler
+
+
+class CaptionDataset():
+    def __init__(self, name, counts) -> None:
+        self.hard_text_prompt = get_hard_prompt(name)
+        self.pair_list = [(f'{i}.png', caption) for i, (caption, count) in enumerate(zip(get_caption(name), counts))
+                          for _ in range(count)]
+        random.Random(0).shuffle(self.pair_list)
+
+
+def whitespace_tokenizer(text):
+    return {'input_ids': text.split(' ')}
+
+
+def mean_padding(batches, sampler):
+    # padded tokens per batch: every caption is padded to the longest of its batch
+    padding = []
+    for batch in batches:
+        lengths = [sampler.lengths[sampler.labels[i]] for i in batch]
+        padding.append(sum(max(lengths) - length for length in lengths))
+    return sum(padding) / len(padding)
+
+
+DATASETS = [('prostate-1', [700, 300, 250, 55]), ('gastric', [900, 120, 400, 33])]
+
+
+@pytest.mark.parametrize('name, counts', DATASETS)
+def test_padding_drops_against_shuffled_batches(name, counts):
+    dataset = CaptionDataset(name, counts)
+    sampler = LengthBucketBatchSampler(dataset, whitespace_tokenizer, batch_size=32, max_padding=0)
+    indices = list(range(len(dataset.pair_list)))
+    random.Random(1).shuffle(indices)
+    shuffled = [indices[start:start + 32] for start in range(0, len(indices), 32)]
+    assert mean_padding(shuffled, sampler) > 0
+    assert mean_padding(list(sampler), sampler) == 0
+
+
+@pytest.mark.parametrize('name, counts', DATASETS)
+@pytest.mark.parametrize('max_padding', [0, 1, 2])
+def test_coverage_and_label_mix(name, counts, max_padding):
+    dataset = CaptionDataset(name, counts)
+    sampler = LengthBucketBatchSampler(dataset, whitespace_tokenizer, batch_size=32, max_padding=max_padding)
+    for epoch in range(2):
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        # every sample exactly once per epoch, at most one partial batch per bucket
+        assert sorted(i for batch in batches for i in batch) == list(range(len(dataset.pair_list)))
+        assert sum(len(batch) < 32 for batch in batches) <= len(sampler.buckets)
+        for batch in batches:
+            span = [sampler.lengths[sampler.labels[i]] for i in batch]
+            assert max(span) - min(span) <= max_padding
+            # full batches of a multi-class bucket mix its classes
+            bucket = next(b for b in sampler.buckets if sampler.labels[batch[0]] in b)
+            if len(batch) == 32 and len(bucket) > 1:
+                assert len({sampler.labels[i] for i in batch}) >= 2
+
+
+@pytest.mark.parametrize('name, counts', DATASETS)
+def test_buckets_interleave_over_the_epoch(name, counts):
+    dataset = CaptionDataset(name, counts)
+    sampler = LengthBucketBatchSampler(dataset, whitespace_tokenizer, batch_size=32, max_padding=0)
+    assert len(sampler.buckets) == 2                   # the one-token caption and the rest
+    batches = list(sampler)
+    # every quarter of the epoch sees each bucket at about its share of the batches
+    for quarter in range(4):
+        part = batches[quarter * len(batches) // 4:(quarter + 1) * len(batches) // 4]
+        for bucket in sampler.buckets:
+            share = sum(sampler.labels[b[0]] in bucket for b in batches) / len(batches)
+            assert abs(sum(sampler.labels[b[0]] in bucket for b in part) / len(part) - share) < 0.15
+
+
+def test_epochs_differ():
+    dataset = CaptionDataset('prostate-1', [200, 100, 100, 50])
+    sampler = LengthBucketBatchSampler(dataset, whitespace_tokenizer, batch_size=16)
+    assert list(sampler) != list(sampler)
+    sampler.set_epoch(0)
+    first = list(sampler)
+    sampler.set_epoch(0)
+    assert list(sampler) == first
@@ -0,0 +1,60 @@
+from argparse import Namespace
+
+import cv2
+import numpy as np
+import pytest
+from torch.utils.data import DataLoader
+from datasets.shards import ShardDataset, write_shards
+from utils.loader import StreamingDataLoader
+
+
+@pytest.fixture
+def shard_dir(tmp_path):
+    pair_list = []
+    for index in range(48):
+        img_path = str(tmp_path / f'{index}.png')
+        cv2.imwrite(img_path, np.full((8, 8, 3), index, dtype=np.uint8))
+        pair_list.append((img_path, 'benign.'))
+    write_shards(pair_list, str(tmp_path / 'shards'), 'train', shard_size=4)
+    return str(tmp_path / 'shards')
+
+
+def make_args():
+    return Namespace(dataset='prostate-1', type='lora', encoder_type='ctranspath', encoder_resize=8,
+                     encoder_mean=(0.485, 0.456, 0.406), encoder_std=(0.229, 0.224, 0.225))
+
+
+@pytest.mark.parametrize('persistent_workers', [False, True])
+def test_epochs_reshuffle_with_workers(shard_dir, persistent_workers):
+    dataset = ShardDataset(shard_dir, 'train', make_args(), shuffle_buffer=8)
+    loader = DataLoader(dataset, batch_size=4, num_workers=2, persistent_workers=persistent_workers)
+    orders = []
+    for epoch in range(2):
+        dataset.set_epoch(epoch)
+        orders.append([path for img_path, _, _, _ in loader for path in img_path])
+    for order in orders:
+        assert len(order) == 48 and len(set(order)) == 48
+    assert orders[0] != orders[1]
+
+    # the same epoch replays the same order
+    dataset.set_epoch(0)
+    assert [path for img_path, _, _, _ in loader for path in img_path] == orders[0]
+
+
+@pytest.mark.parametrize('drop_last', [False, True])
+def test_loader_length_matches_batches(shard_dir, drop_last):
+    # 12 shards of 4 over 5 workers: 12, 12, 8, 8, 8 samples, each worker ends with its own partial batch
+    dataset = ShardDataset(shard_dir, 'train', make_args(), shuffle_buffer=8)
+    loader = StreamingDataLoader(dataset, batch_size=5, num_workers=5, drop_last=drop_last)
+    assert len(loader) == (7 if drop_last else 12)
+    assert len(list(loader)) == len(loader)
+
+
+def test_ranks_run_the_same_number_of_steps(shard_dir, monkeypatch):
+    # 12 shards over 5 ranks hold 12, 12, 8, 8, 8 samples, every rank streams 8
+    dataset = ShardDataset(shard_dir, 'train', make_args(), shuffle_buffer=8)
+    lengths = []
+    for rank in range(5):
+        monkeypatch.setattr(dataset, '_get_rank', lambda: (rank, 5))
+        lengths.append((len(dataset), len(list(dataset)), dataset.num_batches(3)))
+    assert lengths == [(8, 8, 3)] * 5
@@ -11,10 +11,12 @@ from torch.nn import functional as nnf
 
 from model.model_with_prompt import PromptModel
 from model.single_encoder import SingleEncoder
-from datasets import ImageDataset, prepare_data
+from datasets import ImageDataset, ShardDataset, AugBankDataset, LengthBucketBatchSampler, prepare_data
+from datasets.activation_cache import cache_encoder_prefix
 from utils import CosineSchedule, generate, calculate_metrics, save_info, \
                 save_config_and_metric, get_optimizer, get_dataloader, \
-                process_args, loss_key, loss_caption, get_num_class
+                process_args, loss_key, loss_caption, get_num_class, pipelined_generate, \
+                DevicePrefetcher
 from transformers import get_linear_schedule_with_warmup
 
 def train(args, train_dataset, valid_dataset, model):
@@ -23,9 +25,17 @@ def train(args, train_dataset, valid_dataset, model):
     device = args.device
     epochs = args.epochs
     model = model.to(device)
+    if getattr(args, 'compile', False) and args.type != 'single_encoder':
+        model.train()
+        print(f'>>> Compile warm-up: {model.warmup_compile(batch_size)}')
     
     optimizer = get_optimizer(args,model)
-    train_dataloader, valid_dataloader = get_dataloader(args, train_dataset, valid_dataset)
+    train_batch_sampler = None
+    if args.length_bucket >= 0 and args.type != 'single_encoder' and isinstance(train_dataset, ImageDataset):
+        # batches of (almost) equal caption length, so the decoder runs over little padding
+        train_batch_sampler = LengthBucketBatchSampler(train_dataset, model.tokenizer, batch_size, max_padding=args.length_bucket)
+    train_dataloader, valid_dataloader = get_dataloader(args, train_dataset, valid_dataset, train_batch_sampler)
+    train_dataloader = DevicePrefetcher(train_dataloader, device)     # copies the next batch while the current one trains
     if args.scheduler_type == 'cosine':
         scheduler = CosineSchedule(optimizer, K=args.scheduler_k)
     elif args.scheduler_type == 'linear':
@@ -44,9 +54,11 @@ def train(args, train_dataset, valid_dataset, model):
     highest_avg = -1
     best_metrics = None
     for epoch in range(epochs):
-        for param_group in optimizer.param_groups:
-            lr = param_group["lr"]
-            print(f'>>> Training epoch {epoch} - LR: {lr}')
+        for epoch_source in [train_dataset, train_batch_sampler]:
+            if hasattr(epoch_source, 'set_epoch'):
+                epoch_source.set_epoch(epoch)    # shuffling state lives in the main process, the workers only read it
+        lr = optimizer.param_groups[0]["lr"]     # all groups share the same schedule
+        print(f'>>> Training epoch {epoch} - LR: {lr}')
         progress = tqdm(total=len(train_dataloader))
         total_train_loss = 0
 
@@ -63,7 +75,7 @@ def train(args, train_dataset, valid_dataset, model):
             
             # get similarity loss
             if args.type not in ['full_ft', 'single_encoder']:
-                loss_1 = loss_key(model,img_tensor, hard_text_prompt, batch_size)
+                loss_1 = loss_key(model,img_tensor, hard_text_prompt, img_tensor.shape[0])     # the last batch may be partial
             
             # forward
             if args.type != 'single_encoder':
@@ -94,6 +106,8 @@ def train(args, train_dataset, valid_dataset, model):
         if args.scheduler_type in ['cosine','cosine_restart']:
             scheduler.step()
         progress.close()
+        if getattr(model, 'compile_mode', False):
+            print(f'>>> {model.compile_counter}')
 
         torch.save({
             'epoch': epoch,
@@ -114,17 +128,24 @@ def train(args, train_dataset, valid_dataset, model):
             print(f">>> Evaluating epoch {epoch}")
             progress = tqdm(total=len(valid_dataloader))
             with torch.no_grad():
-                for _, (img_path, img_tensor, hard_text_prompt, label) in enumerate(valid_dataloader):
-                    img_tensor = img_tensor.to(device, dtype=torch.float32)  # bs x 3 x 512 x 512
-                    if args.type != 'single_encoder':                    
-                        gen_cap = generate(model, img_tensor, hard_text_prompt, args)
+                if args.pipeline_eval and args.type != 'single_encoder':
+                    # the encoder of the next batches runs on a side stream while the current batch decodes
+                    for gen_cap, label in pipelined_generate(model, valid_dataloader, args):
                         ground_truth_list += label
                         prediction_list += gen_cap
-                    else:
-                        outputs = model(img_tensor)
-                        ground_truth_list += label.tolist()
-                        prediction_list += torch.argmax(outputs, dim=1).tolist()
-                    progress.update()
+                        progress.update()
+                else:
+                    for _, (img_path, img_tensor, hard_text_prompt, label) in enumerate(DevicePrefetcher(valid_dataloader, device)):
+                        img_tensor = img_tensor.to(device, dtype=torch.float32)  # bs x 3 x 512 x 512
+                        if args.type != 'single_encoder':                    
+                            gen_cap = generate(model, img_tensor, hard_text_prompt, args)
+                            ground_truth_list += label
+                            prediction_list += gen_cap
+                        else:
+                            outputs = model(img_tensor)
+                            ground_truth_list += label.tolist()
+                            prediction_list += torch.argmax(outputs, dim=1).tolist()
+                        progress.update()
             progress.close()
         
             assert len(ground_truth_list) == len(prediction_list)
@@ -170,10 +191,18 @@ def main():
     parser.add_argument('--betas', type=tuple, default=(0.9, 0.999))
     parser.add_argument('--valid_every', type=int, default=1)
     parser.add_argument('--num_workers', type=int, default=10)
+    parser.add_argument('--prefetch_factor', type=int, default=4)       # batches loaded ahead by each worker
+    parser.add_argument('--no_persistent_workers', dest='persistent_workers', action='store_false')   # re-fork workers every epoch
+    parser.add_argument('--no_pin_memory', dest='pin_memory', action='store_false')
     parser.add_argument('--scheduler_type', type=str, default="cosine")
     parser.add_argument('--warmup_ratio', type=float, default=0.1)
     parser.add_argument('--scheduler_k', type=int, default=50)
     parser.add_argument('--generate_length', type=int, default=12)
+    parser.add_argument('--encoder_checkpoint_stages', type=list, default=[])   # activation checkpointing, swin stages (layers for e_plip)
+    parser.add_argument('--decoder_checkpoint_layers', type=list, default=[])   # activation checkpointing, decoder layers
+    parser.add_argument('--compile', action='store_true')                       # torch.compile with static shapes
+    parser.add_argument('--compile_caption_len', type=int, default=32)          # compile mode pads captions to a multiple of this
+    parser.add_argument('--pipeline_eval', action='store_true')                 # overlap the encoder of batch n+1 with the decoding of batch n
 
     # Adapt methods
     parser.add_argument('--type', type=str, choices=['basic', 'distinct',
@@ -190,6 +219,7 @@ def main():
     # Prompt
     parser.add_argument('--encoder_prompt_len', type=int, default=10)
     parser.add_argument('--encoder_skip_layers', type=list, default=[6,7,8,9,10,11])
+    parser.add_argument('--encoder_prompt_broadcast', action='store_true')   # share swin prompts across windows instead of concatenating
     parser.add_argument('--decoder_prompt_len', type=int, default=10)
     parser.add_argument('--decoder_skip_layers', type=list, default=[6,7,8,9,10,11]) # skip for prompt
     parser.add_argument('--decoder_skip_layers_for_visual', type=list, default=[6,7,8,9,10,11])   # skip for visual feature
@@ -201,7 +231,17 @@ def main():
     parser.add_argument('--encoder_type', type=str, default='resnet50')
     parser.add_argument('--encoder_ckpt_path', type=str, default='/home/compu/anhnguyen/prompt_works/model/ctranspath.pth')
 
+    parser.add_argument('--encoder_frozen_tables', action='store_true')    # cache swin bias + shift mask tables at eval time
+    parser.add_argument('--encoder_fast_partition', action='store_true')   # gather-based shifted window partition
     parser.add_argument('--encoder_resize', type=int, default=224)
+    parser.add_argument('--reduced_decode', action='store_true')         # decode large patches at 1/2, 1/4 or 1/8 scale
+    parser.add_argument('--shard_dir', type=str, default=None)           # read train/valid from tar shards instead of files
+    parser.add_argument('--image_cache_gb', type=float, default=0)       # shared-memory cache of resized valid images, 0 disables
+    parser.add_argument('--aug_bank', type=str, default=None)            # directory of a precomputed augmentation bank
+    parser.add_argument('--aug_bank_flips', action='store_true')         # random flips on top of the bank variants
+    parser.add_argument('--length_bucket', type=int, default=-1)         # max caption-length spread (tokens) in a batch, 0 exact lengths, -1 disables
+    parser.add_argument('--encoder_cache_dir', type=str, default=None)   # fp16 cache of the frozen leading swin blocks (valid split)
+    parser.add_argument('--encoder_cache_train', action='store_true')    # also cache the train split, disables its augmentation
     parser.add_argument('--encoder_mean', default=(0.485, 0.456, 0.406))
     parser.add_argument('--encoder_std', default=(0.229, 0.224, 0.225))
 
@@ -225,7 +265,7 @@ def main():
     args = parser.parse_args()
     process_args(args)
     
-    data = prepare_data(args)
+    data = prepare_data(args) if args.shard_dir is None else (None, None)
     if isinstance(data,tuple):
         train_set, valid_set = data[0], data[1]
     else:
@@ -236,8 +276,24 @@ def main():
     elif args.type == 'single_encoder':
         model = SingleEncoder(args, get_num_class(args.dataset))
     
-    train_dataset = ImageDataset(train_set, args)
-    valid_dataset = ImageDataset(valid_set, args, train=False)
+    if args.shard_dir is not None:
+        # sequential tar shards written by `python -m datasets.shards`
+        train_dataset = ShardDataset(args.shard_dir, 'train', args)
+        valid_dataset = ShardDataset(args.shard_dir, 'valid', args, train=False)
+    else:
+        train_dataset = ImageDataset(train_set, args)
+        if args.aug_bank is not None:
+            # precomputed augmentations from `python -m datasets.aug_bank`
+            train_dataset = AugBankDataset(train_dataset, args.aug_bank, online_flips=args.aug_bank_flips)
+        valid_dataset = ImageDataset(valid_set, args, train=False)
+        if args.image_cache_gb > 0:
+            valid_dataset.enable_cache(args.image_cache_gb)     # decoded once, reused by every validation
+
+    if args.encoder_cache_dir is not None and args.shard_dir is None and args.aug_bank is None:
+        # frozen leading swin blocks run once per image of the cached splits, uncached (train) images run the full encoder
+        splits = {'valid': valid_dataset, 'train': train_dataset} if args.encoder_cache_train else {'valid': valid_dataset}
+        splits = cache_encoder_prefix(model, splits, args.encoder_cache_dir, args)
+        valid_dataset, train_dataset = splits['valid'], splits.get('train', train_dataset)
 
     train(args, train_dataset, valid_dataset, model)
 
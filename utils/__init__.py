@@ -1,4 +1,7 @@
 from .generate_cap import *
+from .graph_decode import *
+from .loader import *
 from .metrics import *
+from .pipeline import *
 from .scheduler import *
 from .utils import *
\ No newline at end of file
@@ -0,0 +1,161 @@
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def brute_force_topk(queries, embeddings, k=10, chunk_size=65536):
+    """Exact top-k cosine neighbours of `queries` (Q, D) among `embeddings` (N, D), scanned in chunks of the matrix."""
+    best_scores, best_ids = None, None
+    for start in range(0, embeddings.shape[0], chunk_size):
+        chunk = torch.as_tensor(np.asarray(embeddings[start:start + chunk_size]), device=queries.device).to(queries.dtype)
+        scores = queries @ nn.functional.normalize(chunk, dim=-1).t()
+        scores, ids = scores.topk(min(k, scores.shape[1]), dim=-1)
+        ids = ids + start
+        if best_scores is not None:
+            scores, order = torch.cat((best_scores, scores), dim=1).topk(min(k, best_scores.shape[1] + scores.shape[1]), dim=-1)
+            ids = torch.cat((best_ids, ids), dim=1).gather(1, order)
+        best_scores, best_ids = scores, ids
+    return best_scores, best_ids
+
+
+class IVFIndex():
+    """
+    Inverted-file index for cosine similarity: k-means partitions the normalized embeddings into `num_lists` cells,
+    and a query only scans the `nprobe` cells whose centroids are closest. Everything is plain torch, on any device.
+    """
+    def __init__(self, num_lists=1024, nprobe=16, device='cpu') -> None:
+        self.num_lists = num_lists
+        self.nprobe = nprobe
+        self.device = torch.device(device)
+
+    @torch.no_grad()
+    def train(self, embeddings, num_iters=20, sample_size=262144, seed=0):
+        """Spherical k-means on a random sample of `embeddings` (N, D)."""
+        generator = torch.Generator().manual_seed(seed)
+        sample = torch.randperm(embeddings.shape[0], generator=generator)[:sample_size].sort().values.numpy()
+        x = nn.functional.normalize(torch.as_tensor(np.asarray(embeddings[sample]), dtype=torch.float32, device=self.device), dim=-1)
+        self.num_lists = min(self.num_lists, x.shape[0])
+        centroids = x[torch.randperm(x.shape[0], generator=generator)[:self.num_lists].to(self.device)]
+        for _ in range(num_iters):
+            assign = (x @ centroids.t()).argmax(-1)
+            sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+            counts = torch.bincount(assign, minlength=self.num_lists)
+            # empty cells keep their previous centroid
+            centroids = torch.where(counts[:, None] > 0, nn.functional.normalize(sums, dim=-1), centroids)
+        self.centroids = centroids
+        return self
+
+    @torch.no_grad()
+    def add(self, embeddings, chunk_size=65536):
+        """Assigns every embedding to its cell; the vectors are stored grouped by cell (CSR layout) in fp16."""
+        assign, vectors = [], []
+        for start in range(0, embeddings.shape[0], chunk_size):
+            chunk = nn.functional.normalize(torch.as_tensor(np.asarray(embeddings[start:start + chunk_size]),
+                                                            dtype=torch.float32, device=self.device), dim=-1)
+            assign.append((chunk @ self.centroids.t()).argmax(-1))
+            vectors.append(chunk.half())
+        assign, vectors = torch.cat(assign), torch.cat(vectors)
+        order = assign.argsort()
+        self.ids = order                                              # position in the cell layout -> row id
+        self.vectors = vectors[order]
+        self.offsets = torch.zeros(self.num_lists + 1, dtype=torch.long, device=self.device)
+        self.offsets[1:] = torch.bincount(assign, minlength=self.num_lists).cumsum(0)
+        return self
+
+    @torch.no_grad()
+    def search(self, queries, k=10, max_block_bytes=256 * 1024**2):
+        """
+        Returns:
+            scores and row ids of the approximate top-k neighbours, both (Q, k); ids are -1 where the probed cells hold
+            fewer than k vectors.
+        """
+        queries = nn.functional.normalize(torch.as_tensor(queries, dtype=torch.float32, device=self.device), dim=-1)
+        probes = (queries @ self.centroids.t()).topk(min(self.nprobe, self.num_lists), dim=-1).indices     # Q, nprobe
+        # each sub-batch is padded to its longest candidate list, so the (queries, candidates, dim) block is bounded
+        # by the number of queries times that length (lists are skewed, the mean length would underestimate it)
+        lengths = (self.offsets[probes + 1] - self.offsets[probes]).sum(-1).tolist()
+        row_bytes = self.vectors.shape[1] * (self.vectors.element_size() if self.device.type == 'cuda' else 4)   # fp32 on CPU
+        results, start, width = [], 0, 0
+        for end, length in enumerate(lengths):
+            if end > start and (end - start + 1) * max(width, length) * row_bytes > max_block_bytes:
+                results.append(self._search(queries[start:end], probes[start:end], k))
+                start, width = end, 0
+            width = max(width, length)
+        if start < len(lengths):
+            results.append(self._search(queries[start:], probes[start:], k))
+        scores = torch.full((queries.shape[0], k), float('-inf'), device=self.device)
+        ids = torch.full((queries.shape[0], k), -1, dtype=torch.long, device=self.device)
+        row = 0
+        for s, i in results:
+            scores[row:row + s.shape[0], :s.shape[1]], ids[row:row + s.shape[0], :s.shape[1]] = s, i
+            row += s.shape[0]
+        return scores, ids
+
+    def _search(self, queries, probes, k):
+        starts, ends = self.offsets[probes], self.offsets[probes + 1]
+        sizes = ends - starts
+        max_len = int(sizes.sum(-1).max())
+        # gather the candidates of every query into a padded (Q, max_len) block and score it in one batched product
+        cum = torch.cat((torch.zeros_like(sizes[:, :1]), sizes.cumsum(-1)), dim=-1)                       # Q, nprobe+1
+        pos = torch.arange(max_len, device=self.device)[None, :]
+        cell = torch.searchsorted(cum[:, 1:].contiguous(), pos.expand(queries.shape[0], -1).contiguous(), right=True)
+        valid = cell < probes.shape[1]
+        cell = cell.clamp(max=probes.shape[1] - 1)
+        rows = (starts.gather(1, cell) + pos - cum.gather(1, cell)).clamp(max=self.vectors.shape[0] - 1)
+        candidates = self.vectors[rows]
+        if self.device.type != 'cuda':
+            candidates = candidates.float()                          # fp16 matmuls are slow on CPU
+        scores = torch.einsum('qd,qld->ql', queries.to(candidates.dtype), candidates).float()
+        scores = scores.masked_fill(~valid, float('-inf'))
+        scores, top = scores.topk(min(k, max_len), dim=-1)
+        ids = self.ids[rows.gather(1, top)]
+        ids = ids.masked_fill(torch.isinf(scores), -1)
+        return scores, ids
+
+    def save(self, path):
+        torch.save({'centroids': self.centroids, 'ids': self.ids, 'vectors': self.vectors, 'offsets': self.offsets,
+                    'nprobe': self.nprobe}, path)
+
+    @classmethod
+    def load(cls, path, device='cpu'):
+        state = torch.load(path, map_location=device)
+        index = cls(num_lists=state['centroids'].shape[0], nprobe=state['nprobe'], device=device)
+        index.centroids, index.ids, index.vectors, index.offsets = state['centroids'], state['ids'], state['vectors'], state['offsets']
+        return index
+
+
+def drop_self(ids, rows, k):
+    # removes each query's own row from its neighbour ids (stable, keeps the ranking), then keeps the first k
+    order = (ids == rows[:, None]).to(torch.int8).argsort(dim=1, stable=True)
+    return ids.gather(1, order)[:, :k]
+
+
+def benchmark_recall(index, embeddings, num_queries=1000, k=10, nprobes=(1, 2, 4, 8, 16, 32, 64), batch_size=256, seed=0):
+    """
+    Recall@k and per-query latency of `index` for several nprobe values, against brute force on sampled rows. The
+    queries are rows of the indexed matrix, so both searches ask for k + 1 neighbours and drop the query itself.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    sample = torch.randperm(embeddings.shape[0], generator=generator)[:num_queries].sort().values
+    queries = nn.functional.normalize(torch.as_tensor(np.asarray(embeddings[sample.numpy()]), dtype=torch.float32, device=index.device), dim=-1)
+    sample = sample.to(index.device)
+
+    def timed(fn):
+        if index.device.type == 'cuda':
+            torch.cuda.synchronize(index.device)
+        begin = time.perf_counter()
+        out = [fn(queries[i:i + batch_size]) for i in range(0, len(queries), batch_size)]
+        if index.device.type == 'cuda':
+            torch.cuda.synchronize(index.device)
+        return drop_self(torch.cat([o[1] for o in out]), sample, k), (time.perf_counter() - begin) / len(queries) * 1000
+
+    exact_ids, exact_ms = timed(lambda q: brute_force_topk(q, embeddings, k + 1))
+    results = [{'method': 'brute_force', 'recall': 1.0, 'latency_per_query_ms': exact_ms}]
+    for nprobe in nprobes:
+        index.nprobe = nprobe
+        ids, ms = timed(lambda q: index.search(q, k + 1))
+        hits = (ids[:, :, None] == exact_ids[:, None, :]).any(-1).float().sum(-1)
+        results.append({'method': f'ivf{index.num_lists}-nprobe{nprobe}', 'recall': float((hits / exact_ids.shape[1]).mean()),
+                        'latency_per_query_ms': ms})
+    return results
@@ -0,0 +1,76 @@
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from transformers.pytorch_utils import Conv1D
+
+
+def set_cpu_threads(num_threads=None, num_interop_threads=None):
+    # intra-op threads drive the matmuls of a single batch, inter-op threads run independent ops in parallel
+    if num_threads is not None and num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None and num_interop_threads > 0:
+        torch.set_num_interop_threads(num_interop_threads)
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def conv1d_to_linear(model):
+    """Replaces the GPT-2 `Conv1D` layers (x @ W + b) by equivalent `nn.Linear` layers, in place."""
+    for name, module in model.named_children():
+        if isinstance(module, Conv1D):
+            in_features, out_features = module.weight.shape
+            linear = nn.Linear(in_features, out_features, bias=module.bias is not None)
+            linear.weight.data.copy_(module.weight.data.t())
+            if module.bias is not None:
+                linear.bias.data.copy_(module.bias.data)
+            setattr(model, name, linear)
+        else:
+            conv1d_to_linear(module)
+    return model
+
+
+def quantize_int8(model, skip_modules=()):
+    """
+    Returns an int8 dynamically quantized copy of `model` for CPU inference: the weights of every `nn.Linear`
+    (Swin qkv/proj/mlp, GPT-2 Conv1D, CLIP projections, the MLP projector and heads) are stored in int8 and the
+    activations are quantized on the fly. Modules whose name starts with one of `skip_modules` stay in fp32.
+    """
+    model = conv1d_to_linear(copy.deepcopy(model).cpu().eval())
+    if len(skip_modules) == 0:
+        qconfig_spec = {nn.Linear}
+    else:
+        qconfig_spec = {name for name, module in model.named_modules()
+                        if isinstance(module, nn.Linear) and not name.startswith(tuple(skip_modules))}
+    return torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+class LatencyMeter():
+    """Collects per-batch wall-clock latency and reports latency percentiles and throughput."""
+    def __init__(self, device, warmup=1) -> None:
+        self.device = device
+        self.warmup = warmup
+        self.latencies, self.samples = [], []
+
+    def start(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        self.begin = time.perf_counter()
+
+    def stop(self, num_samples):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        self.latencies.append(time.perf_counter() - self.begin)
+        self.samples.append(num_samples)
+
+    def report(self):
+        latencies = np.array(self.latencies[self.warmup:] or self.latencies) * 1000
+        samples = np.array(self.samples[self.warmup:] or self.samples)
+        return {
+            'batches': int(len(latencies)),
+            'latency_mean_ms': float(latencies.mean()),
+            'latency_p50_ms': float(np.percentile(latencies, 50)),
+            'latency_p95_ms': float(np.percentile(latencies, 95)),
+            'latency_per_sample_ms': float(latencies.sum() / samples.sum()),
+            'throughput_samples_per_s': float(samples.sum() / latencies.sum() * 1000),
+        }
@@ -1,47 +1,74 @@
 import torch
 
+def encode_image(model, img, args):
+    # image -> projected visual feature, reshaped into decoder tokens
+    return project_features(model, encode_features(model, img, args), args)
+
+def encode_features(model, img, args):
+    # image -> pooled encoder feature
+    if args.encoder_type in ['ctranspath','swin_tiny']:
+        return model.encoder(img, lora_config=(0.0, args.lora_alpha))
+    return model.encoder(img, lora_config=(0.0, args.lora_alpha))[1]
+
+def project_features(model, img, args):
+    img = model.projector(img)                  # bs, project_dim
+    if args.decoder_type == 'd_plip':
+        img = img.reshape(img.shape[0], -1, 512)    # bs, project_dim//512, 512
+    elif args.decoder_type == 'gpt2':
+        img = img.reshape(img.shape[0], -1, 768)
+    else:
+        raise ValueError("Wrong decoder type")
+    return img
+
 def generate(
     model,
     img,
     text,
-    args=None
+    args=None,
+    graph_decoder=None
 ):
     model.eval()
 
     with torch.no_grad():
-        if args.encoder_type in ['ctranspath','swin_tiny']:
-            img = model.encoder(img, lora_config=(0.0, args.lora_alpha))
-        else:
-            img = model.encoder(img)[1]
-        img = model.projector(img)                  # bs, project_dim
-        if args.decoder_type == 'd_plip':
-            img = img.reshape(img.shape[0], -1, 512)    # bs, project_dim//512, 512
-        elif args.decoder_type == 'gpt2':
-            img = img.reshape(img.shape[0], -1, 768)
-        else:
-            raise ValueError("Wrong decoder type")
+        img = encode_image(model, img, args)
+    return decode_captions(model, img, text, args, graph_decoder)
+
+def decode_captions(
+    model,
+    img,
+    text,
+    args=None,
+    graph_decoder=None
+):
+    # greedy decoding from the projected visual feature of encode_image
+    with torch.no_grad():
         token = model.tokenizer(text, return_tensors="pt", padding=True)   # bs, seq_len
         if args.decoder_type == 'd_plip':
             input_ids=token['input_ids'][:,:-1].to(args.device)    # skip the eos token
         elif args.decoder_type == 'gpt2':
             input_ids=token['input_ids'].to(args.device) 
+        prefix_key_values = model.get_prefix_key_values(img)    # prompt/visual prefixes are fixed during decoding
+        pad_id = 49407 if args.decoder_type == 'd_plip' else 50257   # eos token for d_plip, [PAD] for gpt2
+        attention_mask = torch.where(input_ids<pad_id,1,0)
+
+        if graph_decoder is not None and graph_decoder.supports(input_ids, args.generate_length+1):
+            # static kv cache + graph-captured single-token steps (gpt2)
+            input_ids = graph_decoder.decode(prefix_key_values, input_ids, attention_mask, args.generate_length+1)
+        else:
+            for _ in range(args.generate_length+1):
+                output = model.forward_decoder(proj_encoder_feature=img,
+                                       input_ids=input_ids,
+                                       attention_mask=attention_mask,
+                                       prefix_key_values=prefix_key_values)
+                logits = model.decoder_head(output.last_hidden_state[:,-1,:])    # forward the last token embedding though a head, bs x 49408
+
+                # Get a token with highest prob, and decode to get a corresponding next word
+                next_token = torch.argmax(logits, -1).unsqueeze(1)               # bs x 1
+                           # bs x 1
 
-        for _ in range(args.generate_length+1):
-            if args.decoder_type == 'd_plip':
-                attention_mask=torch.where(input_ids<49407,1,0).to(args.device)    # skip the eos token
-            elif args.decoder_type == 'gpt2':
-                attention_mask=torch.where(input_ids<50257,1,0).to(args.device) 
-            output = model.forward_decoder(proj_encoder_feature=img,
-                                   input_ids=input_ids,
-                                   attention_mask=attention_mask)
-            logits = model.decoder_head(output.last_hidden_state[:,-1,:])    # forward the last token embedding though a head, bs x 49408
-            
-            # Get a token with highest prob, and decode to get a corresponding next word
-            next_token = torch.argmax(logits, -1).unsqueeze(1)               # bs x 1
-                       # bs x 1
-
-            # Append a next word to current text
-            input_ids = torch.cat((input_ids,next_token),dim=1)
+                # Append a next word to current text
+                input_ids = torch.cat((input_ids,next_token),dim=1)
+                attention_mask = torch.cat((attention_mask,torch.where(next_token<pad_id,1,0)),dim=1)   # extend the mask with the new token only
     result = model.tokenizer.batch_decode(input_ids)
     for i in range(len(result)):
         if args.dataset == 'luad' and args.type == 'lora':
@@ -49,4 +76,32 @@ def generate(
             result[i] = f"the type of this lung patch is {predict}"
         result[i] = result[i].split('.')[0].replace('<|startoftext|>', '').replace('<|endoftext|>', '') + '.'
         result[i] = result[i].replace(' - ', '-')
-    return list(result)
\ No newline at end of file
+    return list(result)
+
+def score_captions(model, img, captions, hard_text_prompt, args):
+    """
+    Scores every candidate caption for every image by its log-likelihood under the decoder (teacher forcing).
+
+    Args:
+        img: projected visual feature from encode_image, (bs, visual_len, dim)
+        captions: list of C candidate captions, each starting with hard_text_prompt
+    Returns:
+        (bs, C) softmax over the caption log-likelihoods
+    """
+    batch_size, num_captions = img.shape[0], len(captions)
+    with torch.no_grad():
+        token = model.tokenizer(list(captions), return_tensors="pt", padding=True)
+        input_ids = token['input_ids'].to(args.device).repeat(batch_size, 1)               # bs*C, seq_len
+        attention_mask = token['attention_mask'].to(args.device).repeat(batch_size, 1)
+        img = img.repeat_interleave(num_captions, dim=0)                                      # bs*C, visual_len, dim
+        output = model.forward_decoder(proj_encoder_feature=img, input_ids=input_ids, attention_mask=attention_mask)
+        logits = model.decoder_head(output.last_hidden_state)
+
+        # only the tokens after the hard prompt are scored, as in loss_caption
+        hard_prompt_len = model.tokenizer(hard_text_prompt, return_tensors="pt").input_ids.shape[1]
+        if args.decoder_type == 'd_plip':
+            hard_prompt_len -= 1
+        log_probs = torch.log_softmax(logits[:, hard_prompt_len-1:-1, :], dim=-1)
+        labels = input_ids[:, hard_prompt_len:]
+        token_log_probs = log_probs.gather(-1, labels.unsqueeze(-1)).squeeze(-1) * attention_mask[:, hard_prompt_len:]
+        return token_log_probs.sum(-1).view(batch_size, num_captions).softmax(-1)
@@ -0,0 +1,87 @@
+import torch
+
+
+class GraphDecoder():
+    """
+    Greedy GPT-2 decoding with a static kv cache, where the single-token step (forward_decoder + decoder_head + argmax)
+    is captured once per batch-size bucket in a CUDA graph and replayed with static input/output buffers.
+
+    The prompt (hard text prompt) is still run eagerly into the cache, since its length varies between batches.
+    Batches are padded up to the nearest bucket. On CPU the same static-cache step runs eagerly.
+    """
+    def __init__(self, model, args, buckets=(8, 16, 32), max_text_len=64, pad_id=50257) -> None:
+        self.model = model
+        self.args = args
+        self.buckets = sorted(set(buckets))
+        self.max_text_len = max_text_len
+        self.pad_id = pad_id
+        self.states = {}
+
+    def supports(self, input_ids, steps):
+        return self.args.decoder_type == 'gpt2' and input_ids.shape[0] <= self.buckets[-1] \
+                    and input_ids.shape[1] + steps - 1 <= self.max_text_len
+
+    def _step(self, state):
+        output = self.model.forward_decoder(proj_encoder_feature=None,
+                                            input_ids=state['next_token'],
+                                            attention_mask=torch.where(state['next_token']<self.pad_id,1,0),
+                                            static_kv_cache=state['cache'],
+                                            cache_position=state['cache_position'])
+        logits = self.model.decoder_head(output.last_hidden_state[:,-1,:])
+        return torch.argmax(logits, -1).unsqueeze(1)                          # bs x 1
+
+    def _get_state(self, bucket, prefix_key_values, device):
+        if bucket in self.states:
+            return self.states[bucket]
+        state = {
+            'cache': self.model.decoder.init_static_kv_cache(prefix_key_values, bucket, self.max_text_len),
+            'next_token': torch.zeros(bucket, 1, dtype=torch.long, device=device),
+            'cache_position': torch.zeros(1, dtype=torch.long, device=device),
+            'graph': None,
+        }
+        if device.type == 'cuda':
+            # warm up on a side stream, then capture the step; the cache is reset by set_prefix before every batch
+            stream = torch.cuda.Stream(device)
+            stream.wait_stream(torch.cuda.current_stream(device))
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self._step(state)
+            torch.cuda.current_stream(device).wait_stream(stream)
+            state['graph'] = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(state['graph']):
+                state['out_token'] = self._step(state)
+        self.states[bucket] = state
+        return state
+
+    @torch.no_grad()
+    def decode(self, prefix_key_values, input_ids, attention_mask, steps):
+        """Appends `steps` greedily decoded tokens to `input_ids`, like the eager loop of `generate`."""
+        batch_size, text_len = input_ids.shape
+        bucket = min(b for b in self.buckets if b >= batch_size)
+        if bucket > batch_size:
+            # pad the batch by repeating the last sample, the extra rows are dropped at the end
+            pad = lambda x: torch.cat((x, x[-1:].expand(bucket - batch_size, *x.shape[1:])), dim=0)
+            input_ids, attention_mask = pad(input_ids), pad(attention_mask)
+            prefix_key_values = [None if p is None else (pad(p[0]), pad(p[1])) for p in prefix_key_values]
+
+        state = self._get_state(bucket, prefix_key_values, input_ids.device)
+        state['cache'].set_prefix(prefix_key_values)
+
+        # the prompt tokens fill the first text slots eagerly
+        output = self.model.forward_decoder(proj_encoder_feature=None,
+                                            input_ids=input_ids,
+                                            attention_mask=attention_mask,
+                                            static_kv_cache=state['cache'],
+                                            cache_position=torch.arange(text_len, device=input_ids.device))
+        next_token = torch.argmax(self.model.decoder_head(output.last_hidden_state[:,-1,:]), -1).unsqueeze(1)
+        tokens = [next_token]
+        for step in range(steps - 1):
+            state['next_token'].copy_(next_token)
+            state['cache_position'].fill_(text_len + step)
+            if state['graph'] is not None:
+                state['graph'].replay()
+                next_token = state['out_token'].clone()
+            else:
+                next_token = self._step(state)
+            tokens.append(next_token)
+        return torch.cat([input_ids] + tokens, dim=1)[:batch_size]
@@ -0,0 +1,69 @@
+import torch
+from torch.utils.data import DataLoader, IterableDataset
+
+
+def make_dataloader(args, dataset, shuffle, drop_last, persistent=True, **kwargs):
+    """
+    DataLoader with pinned memory and a configurable prefetch depth. With `persistent` the workers (and the copies of
+    `args` and the pair list they hold) are forked once and kept alive across epochs instead of re-created per epoch.
+    """
+    num_workers = kwargs.pop('num_workers', args.num_workers)
+    if isinstance(dataset, IterableDataset):
+        shuffle = False                                                      # streamed datasets shuffle themselves
+    pin_memory = getattr(args, 'pin_memory', True) and torch.device(args.device).type == 'cuda'
+    if num_workers > 0:
+        kwargs['persistent_workers'] = persistent and getattr(args, 'persistent_workers', True)
+        kwargs['prefetch_factor'] = getattr(args, 'prefetch_factor', 2)     # batches loaded ahead by each worker
+    if kwargs.get('batch_sampler') is not None:
+        # the batch sampler decides batch size, order and dropping
+        return DataLoader(dataset, num_workers=num_workers, pin_memory=pin_memory, **kwargs)
+    kwargs.pop('batch_sampler', None)
+    loader_class = StreamingDataLoader if hasattr(dataset, 'num_batches') else DataLoader
+    return loader_class(dataset, batch_size=args.bs, shuffle=shuffle, drop_last=drop_last,
+                        num_workers=num_workers, pin_memory=pin_memory, **kwargs)
+
+
+class StreamingDataLoader(DataLoader):
+    """DataLoader whose length is the exact batch count of a streamed dataset, where every worker ends with its own partial batch."""
+    def __len__(self) -> int:
+        return self.dataset.num_batches(self.batch_size, self.num_workers, self.drop_last)
+
+
+class DevicePrefetcher():
+    """
+    Wraps a DataLoader and copies the next batch to `device` on a side CUDA stream while the current batch is used,
+    so the host-to-device copy overlaps with compute (the batch must come from pinned memory). Batches keep the
+    (img_path, img_tensor, hard_text_prompt, label) layout of ImageDataset; on CPU they are passed through.
+    """
+    def __init__(self, dataloader, device) -> None:
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _to_device(self, batch):
+        img_path, img_tensor, hard_text_prompt, label = batch
+        with torch.cuda.stream(self.stream):
+            img_tensor = img_tensor.to(self.device, dtype=torch.float32, non_blocking=True)
+            if isinstance(label, torch.Tensor):
+                label = label.to(self.device, non_blocking=True)
+        return img_path, img_tensor, hard_text_prompt, label
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from self.dataloader
+            return
+        loader = iter(self.dataloader)
+        next_batch = next(loader, None)
+        next_batch = None if next_batch is None else self._to_device(next_batch)
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            batch = next_batch
+            for tensor in batch[1::2]:
+                if isinstance(tensor, torch.Tensor):
+                    tensor.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = next(loader, None)
+            next_batch = None if next_batch is None else self._to_device(next_batch)
+            yield batch
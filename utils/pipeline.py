@@ -0,0 +1,77 @@
+import queue
+import threading
+import torch
+from .generate_cap import encode_image, decode_captions
+
+
+class EncoderPrefetcher():
+    """
+    Runs the encoder + projector of the upcoming batches in a worker thread while the caller decodes the current one.
+
+    On CUDA the worker issues its kernels on a side stream, so the encoder of batch n+1 overlaps with the many small
+    decode kernels of batch n on the default stream; on CPU the two threads overlap since torch ops release the GIL.
+    At most `depth` projected visual features wait in the queue, which bounds the extra memory.
+    """
+    _end = object()
+
+    def __init__(self, model, dataloader, args, depth=2) -> None:
+        self.model = model
+        self.dataloader = dataloader
+        self.args = args
+        self.device = torch.device(args.device)
+        self.queue = queue.Queue(maxsize=depth)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.stop = threading.Event()
+
+    def _produce(self):
+        try:
+            with torch.no_grad():
+                for img_path, img_tensor, hard_text_prompt, label in self.dataloader:
+                    if self.stop.is_set():
+                        return
+                    if self.stream is not None:
+                        with torch.cuda.device(self.device), torch.cuda.stream(self.stream):
+                            img_tensor = img_tensor.to(self.device, dtype=torch.float32, non_blocking=True)
+                            img_feature = encode_image(self.model, img_tensor, self.args)
+                            event = torch.cuda.Event()
+                            event.record(self.stream)
+                    else:
+                        img_tensor = img_tensor.to(self.device, dtype=torch.float32)
+                        img_feature, event = encode_image(self.model, img_tensor, self.args), None
+                    self.queue.put((img_feature, event, hard_text_prompt, label))
+        except Exception as e:
+            self.queue.put(e)
+        self.queue.put(self._end)
+
+    def __iter__(self):
+        self.thread.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is self._end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                img_feature, event, hard_text_prompt, label = item
+                if event is not None:
+                    # decode on the current stream only after the side stream produced the feature
+                    torch.cuda.current_stream(self.device).wait_event(event)
+                    img_feature.record_stream(torch.cuda.current_stream(self.device))
+                yield img_feature, hard_text_prompt, label
+        finally:
+            self.stop.set()
+            while self.thread.is_alive():
+                # unblock a worker waiting on the full queue
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    self.thread.join(timeout=0.1)
+
+
+def pipelined_generate(model, dataloader, args, graph_decoder=None, depth=2):
+    """Like calling `generate` on every batch of `dataloader`, with the encoder of the next batches running ahead."""
+    model.eval()
+    for img_feature, hard_text_prompt, label in EncoderPrefetcher(model, dataloader, args, depth):
+        gen_cap = decode_captions(model, img_feature, hard_text_prompt, args, graph_decoder)
+        yield gen_cap, label
@@ -1,9 +1,12 @@
+import inspect
 import json, os
+from argparse import Namespace
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
 from datetime import datetime
 from torch.nn import functional as nnf
+from .loader import make_dataloader
 
 def save_config(args):
     config = {}
@@ -13,6 +16,18 @@ def save_config(args):
     with open(out_path, 'w') as outfile:
         json.dump(config, outfile)
 
+def load_training_args(model_pth):
+    # the training config is saved next to the checkpoints as <prefix_outdir>.json, checkpoints as <prefix_outdir>-<epoch>.pt
+    last_ext = '-' + model_pth.split('-')[-1]
+    training_config_file = model_pth.replace(last_ext, '.json')
+    with open(training_config_file) as file:
+        args = json.load(file)
+    args['model_pth'] = model_pth
+    args = Namespace(**args)
+    if 'type' not in args:
+        args.type = args.prompt_type
+    return args
+
 def loss_key(model, img_tensor, hard_text_prompt, batch_size):
     q = model.get_query(img_tensor, hard_text_prompt)
     n_K = nn.functional.normalize(model.key, dim=1)
@@ -97,21 +112,56 @@ def save_config_and_metric(args, best_metrics, best_epoch, run_type='valid'):
         f.write("\n")
     return store_str
 
+def get_param_groups(model):
+    # only trainable tensors are handed to the optimizer, grouped by the component they adapt
+    groups = {'prompt': [], 'lora': [], 'key': [], 'projector': [], 'head': [], 'other': []}
+    for name, param in model.named_parameters():
+        if not param.requires_grad:
+            continue
+        if 'prompt_layer_' in name or name.startswith('prompt_projector_'):
+            groups['prompt'].append(param)
+        elif 'lora_layer_' in name:
+            groups['lora'].append(param)
+        elif name == 'key':
+            groups['key'].append(param)
+        elif name.startswith('projector.'):
+            groups['projector'].append(param)
+        elif name.startswith('decoder_head.'):
+            groups['head'].append(param)
+        else:
+            groups['other'].append(param)
+    return [{'name': name, 'params': params} for name, params in groups.items() if len(params) > 0]
+
+def get_multi_tensor_kwargs(optimizer_class, device):
+    # fused kernels need every param on cuda, otherwise fall back to the foreach (multi-tensor) implementation
+    signature = inspect.signature(optimizer_class).parameters
+    if 'fused' in signature and torch.device(device).type == 'cuda':
+        return {'fused': True}
+    elif 'foreach' in signature:
+        return {'foreach': True}
+    return {}
+
 def get_optimizer(args, model):
+    param_groups = get_param_groups(model)
     if args.optimizer_type == 'Adam':
-        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, betas=args.betas)
+        kwargs = get_multi_tensor_kwargs(torch.optim.Adam, args.device)
+        optimizer = torch.optim.Adam(param_groups, lr=args.lr, betas=args.betas, **kwargs)
     elif args.optimizer_type == 'AdamW':
-        optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, betas=args.betas)
+        kwargs = get_multi_tensor_kwargs(torch.optim.AdamW, args.device)
+        optimizer = torch.optim.AdamW(param_groups, lr=args.lr, betas=args.betas, **kwargs)
     elif args.optimizer_type == 'SGD':
-        optimizer = torch.optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum)
+        kwargs = get_multi_tensor_kwargs(torch.optim.SGD, args.device)
+        optimizer = torch.optim.SGD(param_groups, lr=args.lr, momentum=args.momentum, **kwargs)
     else:
         raise NotImplementedError
     
     return optimizer
 
-def get_dataloader(args, train_dataset, valid_dataset):
-    train_dataloader = DataLoader(train_dataset, batch_size=args.bs, shuffle=True, drop_last=True, num_workers=args.num_workers)
-    valid_dataloader = DataLoader(valid_dataset, batch_size=args.bs, shuffle=True, drop_last=False, num_workers=args.num_workers)
+def get_dataloader(args, train_dataset, valid_dataset, train_batch_sampler=None):
+    sampler = getattr(train_dataset, 'sampler', None)      # e.g. the (index, variant) sampler of an augmentation bank
+    train_dataloader = make_dataloader(args, train_dataset, shuffle=sampler is None, drop_last=True, sampler=sampler,
+                                       batch_sampler=train_batch_sampler)
+    valid_dataloader = make_dataloader(args, valid_dataset, shuffle=True, drop_last=False)
 
     return train_dataloader, valid_dataloader
 